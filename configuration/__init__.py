@@ -1,12 +1,57 @@
-from swagger_client import Configuration, ApiClient
 from pathlib import Path
-import yaml
+import json
+import os
+import threading
+
+CONFIG_PATH = Path(__file__).resolve().parent.joinpath("config.yml")
+# Parsed copy of config.yml, which is invalidated as soon as the modification time of config.yml changes.
+CACHE_PATH = CONFIG_PATH.with_name(".config.cache.json")
+
+_lock = threading.Lock()
+_config = None
+_client = None
+_apis = {}
+
+
+def load_config(path=CONFIG_PATH, cache_path=CACHE_PATH):
+    """
+    Loads the configuration file. Parsing YAML is slow compared to JSON, therefore the parsed configuration is cached
+    as JSON next to the config file and only parsed again if the config file has been modified.
+
+    Args:
+        path (Path): Path of the YAML configuration file
+        cache_path (Path): Path of the JSON cache file
+
+    Returns:
+        The configuration as dictionary
+    """
+    mtime = os.stat(path).st_mtime_ns
+    try:
+        with open(cache_path, "r") as cache_file:
+            cache = json.load(cache_file)
+        if cache["mtime"] == mtime and cache["path"] == str(path):
+            return cache["config"]
+    except (OSError, ValueError, KeyError):
+        pass
+
+    # yaml is only imported if the cache is outdated.
+    import yaml
+    with open(path, "r") as configfile:
+        config = yaml.full_load(configfile)
+
+    try:
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as cache_file:
+            json.dump({"mtime": mtime, "path": str(path), "config": config}, cache_file)
+        os.replace(tmp_path, cache_path)
+    except (OSError, TypeError):
+        # The cache is optional, e.g. the configuration directory might be read-only.
+        pass
+    return config
 
-with open(Path(__file__).resolve().parent.joinpath("config.yml"), "r") as configfile:
-    config = yaml.full_load(configfile)
 
 # Initializing the client with data from config.yml
-def init_client(api_key: str, host: str) -> ApiClient:
+def init_client(api_key: str, host: str):
     """
     Initializes PowerBot Client to enable data requests by the API.
 
@@ -17,10 +62,63 @@ def init_client(api_key: str, host: str) -> ApiClient:
     Returns:
         PowerBot ApiClient Object
     """
+    # The generated client is only imported when the first client is created.
+    from swagger_client import Configuration, ApiClient
+
     config = Configuration()
     config.api_key['api_key'] = api_key
     config.host = host
     return ApiClient(config)
 
 
-client = init_client(config['CLIENT_DATA']['API_KEY'], config['CLIENT_DATA']['HOST'])
\ No newline at end of file
+def get_config():
+    """
+    Returns:
+        The configuration from config.yml, which is loaded on first access
+    """
+    global _config
+    if _config is None:
+        with _lock:
+            if _config is None:
+                _config = load_config()
+    return _config
+
+
+def get_client():
+    """
+    Returns:
+        The shared PowerBot ApiClient, which is created on first access
+    """
+    global _client
+    if _client is None:
+        config = get_config()
+        with _lock:
+            if _client is None:
+                _client = init_client(config['CLIENT_DATA']['API_KEY'], config['CLIENT_DATA']['HOST'])
+    return _client
+
+
+def get_api(name: str):
+    """
+    Returns an api object (e.g. "OrdersApi") bound to the shared client. The api modules are imported on first access.
+
+    Args:
+        name (str): Class name of the api in swagger_client.api
+
+    Returns:
+        The api object
+    """
+    api = _apis.get(name)
+    if api is None:
+        import swagger_client.api
+        api = _apis.setdefault(name, getattr(swagger_client.api, name)(get_client()))
+    return api
+
+
+def __getattr__(name):
+    # "from configuration import config, client" keeps working, but the values are only created on first access.
+    if name == "config":
+        return get_config()
+    if name == "client":
+        return get_client()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
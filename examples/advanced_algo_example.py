@@ -9,14 +9,28 @@ if these orders have not been executed after 15min, it will act as aggressor (ex
 current market price).
 """
 
-import logging, schedule, time, json
+import logging, signal, time, json, hashlib
 from pathlib import Path
 from helpers.advanced_algo_helper import create_signals, get_signal_value, get_imbalance
-from datetime import datetime, timedelta
-from dateutil import tz
-from swagger_client import Configuration, ApiClient, rest
-from swagger_client.api import MarketApi, ContractApi, OrdersApi, SignalsApi, LogsApi
-from swagger_client.models import OrderModify, OrderEntry
+from helpers.audit_helper import AuditTrail, LOW
+from helpers.checkpoint_helper import CheckpointWriter, load_checkpoint
+from helpers.client_helper import create_client, get_exchange
+from helpers.conflating_queue_helper import ConflatingQueue
+from helpers.delivery_period_helper import from_minutes, start_of_day, to_minutes
+from helpers.diagnostics_helper import Diagnostics
+from helpers.instrumentation_helper import METRICS
+from helpers.kill_switch_helper import KillSwitch
+from helpers.metadata_cache_helper import MetadataCache
+from helpers.order_manager_helper import OrderManager
+from helpers.otr_helper import OtrTracker, DELETION
+from helpers.rate_limit_helper import CRITICAL
+from helpers.risk_helper import PreTradeRiskEngine
+from helpers.scheduler_helper import CycleBudget, DeadlineScheduler
+from helpers.signal_upload_helper import SignalUploader
+from helpers.websocket_helper import PowerBotWebSocket
+from swagger_client import rest
+from swagger_client.api import MarketApi, ContractApi, OrdersApi, SignalsApi, LogsApi, TradesApi
+from swagger_client.models import OrderEntry
 # Load Config File
 from configuration import config
 
@@ -26,21 +40,31 @@ logging.basicConfig(level=logging.INFO)
 LOGGER = logging.getLogger()
 
 
-def run():
+def run(budget=None):
     """
     The main method that calls our algorithm method, which holds the trading logic.
     It is used for error handling.
+
+    :param budget: CycleBudget of the run (unlimited if None).
     """
 
     LOGGER.info("Starting new run...")
+    budget = budget or CycleBudget()
     retry = True
     retry_counter = 0
 
     # Every time this method is called, it will try to execute the trading logic.
-    # In case the algorithm execution fails because of certain API exceptions, it will retry the execution up to 3 times.
+    # In case the algorithm execution fails because of certain API exceptions, it will retry the execution up to 3 times,
+    # as long as the budget of the run is not exhausted.
     while retry and retry_counter < 3:
+        if budget.exhausted:
+            LOGGER.warning("Budget of the run is exhausted, no further retries.")
+            break
         try:
-            if algorithm():
+            # While the diagnostics are enabled, the memory growth of every cycle is logged.
+            with METRICS.time("powerbot_algo_cycle_seconds"), diagnostics.cycle():
+                successful = algorithm(budget)
+            if successful:
                 LOGGER.info("Algorithm exited without errors.")
             else:
                 LOGGER.warning("Algorithm exited with problems.")
@@ -52,7 +76,10 @@ def run():
                 # 409: may occur when, the backend has another revision number then the one we submitted via OrdrModify
                 # In this case retry the algorithm (max. 3 times).
                 LOGGER.warning("Retrying algorithm after ApiException.")
+                METRICS.increment("powerbot_algo_retries_total", status=str(api_exception.status))
                 retry_counter += 1
+                # Our view of the working orders is outdated, so fetch them once before retrying.
+                order_manager.resync([PORTFOLIO_ID], DELIVERY_AREA)
             else:
                 retry = False
         except Exception as e:
@@ -60,76 +87,108 @@ def run():
             retry = False
 
 
-def calc_trade_factor(time_to_delivery_start, offset=timedelta(minutes=30)):
+def calc_trade_factor(minutes_to_delivery_start, offset=30):
     """
     Method to stepwise increase the traded quantity as the delivery start of a contract comes closer.
 
-    :param time_to_delivery_start: Timedelta object (contract delivery start - now).
+    :param minutes_to_delivery_start: Exact minutes (float) until the delivery start of the contract (contract delivery start - now).
     :param offset: 30min before the delivery start we want the traded quantity to be 100%.
     :return: Trade factor indicating how much of the remaining open position will be placed on the market.
     """
 
-    if time_to_delivery_start <= offset:
+    if minutes_to_delivery_start <= offset:
         trade_factor = 1.0
-    elif time_to_delivery_start >= TRADING_WINDOW:
+    elif minutes_to_delivery_start >= TRADING_WINDOW:
         trade_factor = 0.0
     else:
-        remaining_quarter_hours = int(((time_to_delivery_start.total_seconds()-offset.total_seconds())/60)/15)
+        remaining_quarter_hours = int((minutes_to_delivery_start - offset) / 15)
         trade_factor = (10 - remaining_quarter_hours) / 10
     return trade_factor
 
 
-def algorithm():
+def get_risk_settings():
+    """
+    :return: The cached risk management settings of the portfolio (and the tenant), {owner id: RiskManagementSettings}.
+    """
+
+    # Raises an exception if the settings cannot be read, the algorithm must not trade without its risk checks.
+    settings = {owner_id: metadata.risk_settings(owner_id) for owner_id in (PORTFOLIO_ID, TENANT_ID) if owner_id}
+    return {owner_id: value for owner_id, value in settings.items() if value is not None}
+
+
+def algorithm(budget):
     """
     Method that includes the main logic of the trading strategy.
+    :param budget: CycleBudget of the run. The contracts are processed in the order of their gate closure, contracts that
+                   do not fit into the budget are left for the next run.
     :return: True, if the algorithm exited without any problems; False if there were issues with the market.
     """
 
+    # Never place new orders after the kill switch has been triggered.
+    if kill_switch.triggered.is_set():
+        LOGGER.warning("Kill switch has been triggered, the algorithm is not executed.")
+        return False
+
+    # The websocket only monitors the connection to PowerBot, its pending order book events are discarded. The order book
+    # is requested below anyway, which also covers the contracts whose events have been dropped.
+    websocket_queue.drain()
+    websocket_queue.take_dropped_keys()
+
     # Retrieve the market status and only execute the trading logic if the market is up an running.
-    market_status = market_api.get_status()
+    with METRICS.phase("market_status"):
+        market_status = market_api.get_status()
     if market_status.status != "OK":
         LOGGER.warning(f"Market status is not OK: {market_status}.")
         return False
 
-    # Maximum limit of orders that can be retrieved with a single request is 500.
-    # Therefore, a loop is used to ensure that all orders are fetched.
-    more_orders = True
-    all_own_orders = []
-    offset = 0
-    while more_orders:
-        own_orders = orders_api.get_own_orders(portfolio_id=[PORTFOLIO_ID],
-                                               delivery_area=DELIVERY_AREA,
-                                               offset=offset,
-                                               limit=500)
-        all_own_orders.extend(own_orders)
-        offset += 500
-        more_orders = len(own_orders) == 500
-
-    # Delete all currently active orders to ensure no changes of our net_pos occur, while we execute our trading logic.
-    # In the process of retrieving all current orders and deleting them, the orders might get (partially) executed.
+    # The order manager knows our working orders (and their revision numbers) from the responses of previous requests,
+    # so we don't have to fetch all own orders page by page in every run.
+    # Only the orders of this algorithm are known (tagged with its ALGO_ID). Orders placed by other algorithms or manually
+    # in the same portfolio are no longer deleted, they are left alone. Orders whose submission has not been answered yet
+    # have no order id and cannot be deleted.
+    all_own_orders = [order for order in order_manager.working(delivery_area=DELIVERY_AREA) if order.order_id is not None]
+
+    # Delete all currently active orders of this algorithm to ensure no changes of our net_pos occur, while we execute our
+    # trading logic. In the meantime, the orders might have been (partially) executed.
     # So these orders might no longer exist or have a changed revision number (happens if they get partially executed).
     # In this case deleting them won't work, because we are sending outdated information to the server.
-    # An API exception is thrown and immediately triggers a rerun of the algorithm (up to 3 times).
-    for own_order in all_own_orders:
-        orders_api.modify_order(order_id=own_order.order_id, revision_no=own_order.revision_no, modifications=OrderModify(action="DELE"))
+    # An API exception is thrown and immediately triggers a resync of the orders and a rerun of the algorithm (up to 3 times).
+    with METRICS.phase("delete_orders"):
+        for own_order in all_own_orders:
+            order_manager.delete(own_order)
+            otr_tracker.record(own_order.contract_id, own_order.delivery_area, DELETION)
+
+    # Our trades since the previous run change the cash balance checked by the risk engine and lower the OTR.
+    with METRICS.phase("fetch_trades"):
+        risk_engine.update_trades(trades_api)
+        otr_tracker.update_trades(trades_api)
 
     # Limit the order book to the next 12 quarter hourly products.
-    order_book = contract_api.get_order_books(product=",".join(QUARTER_HOUR_PRODUCTS),
-                                              portfolio_id=[PORTFOLIO_ID],
-                                              delivery_area=DELIVERY_AREA,
-                                              limit=12)
+    with METRICS.phase("fetch_order_book"):
+        order_book = contract_api.get_order_books(product=",".join(QUARTER_HOUR_PRODUCTS),
+                                                  portfolio_id=[PORTFOLIO_ID],
+                                                  delivery_area=DELIVERY_AREA,
+                                                  limit=12)
+    risk_engine.seed_from_order_book(order_book, DELIVERY_AREA)
+    # The exchange_otr of the order book is the base of the local OTR count.
+    for contract in order_book.contracts:
+        otr_tracker.sync(contract.contract_id, DELIVERY_AREA, contract.exchange_otr, contract.delivery_end)
 
     # Define a list object, in which we will store all our newly created orders.
     # This allows us to bulk submit them at the end, which increases the performance.
     to_be_placed = []
 
-    for contract in order_book.contracts:
-        # Calculate the remaining time till the delivery start of the contract.
+    # The strategy phase also contains the public order requests of the aggressor logic, which are measured separately per endpoint.
+    strategy_start = time.perf_counter()
+    # The delivery starts are integer minutes since the epoch, the current time is kept exact (with seconds), otherwise the
+    # trade factor would step up to a minute early.
+    now = time.time() / 60
+    for contract in budget.by_gate_closure(order_book.contracts, int(now)):
+        # Calculate the remaining minutes till the delivery start of the contract.
         # We will use this to adjust the trading factor as well as to evaluate if the contract is within our predefined trading window.
-        now = datetime.utcnow().replace(tzinfo=tz.tzutc())
-        time_to_delivery_start = contract.delivery_start - now
+        minutes_to_delivery_start = to_minutes(contract.delivery_start) - now
 
-        if time_to_delivery_start < TRADING_WINDOW:
+        if minutes_to_delivery_start < TRADING_WINDOW:
 
             # Imbalance is the sum of position long/short signal submitted to PowerBot.
             imbalance = get_imbalance(contract)
@@ -137,7 +196,7 @@ def algorithm():
             net_pos = next(portfolio_info.net_pos for portfolio_info in contract.portfolio_information if portfolio_info.portfolio_id == PORTFOLIO_ID)
 
             # Every quarter hour 10 percent points are added to the trade factor.
-            trade_factor = calc_trade_factor(time_to_delivery_start)
+            trade_factor = calc_trade_factor(minutes_to_delivery_start)
             # Aggressor imbalance
             agg_imbalance = imbalance * (trade_factor - 0.1) if trade_factor - 0.1 > 0 else 0
             # Originator imbalance
@@ -222,6 +281,8 @@ def algorithm():
 
                                 total_aggressor_quantity += aggressor_quantity
                                 to_be_placed.append(aggressor_order)
+                                audit.record_order(aggressor_order, "aggressor", imbalance=imbalance, net_pos=net_pos,
+                                                   max_price=max_price, min_price=min_price, spread=spread)
 
                 # Create orders for the open originator position.
                 if orig_open_pos != 0:
@@ -250,9 +311,51 @@ def algorithm():
                                                                   "algo_id": ALGO_ID}))
 
                     to_be_placed.append(originator_order)
-
-    # Send our newly created orders to the exchange.
-    orders_api.add_orders(to_be_placed, async_req=True)
+                    # Originator orders are replaced in every run, under backpressure their entries are dropped first.
+                    audit.record_order(originator_order, "originator", LOW, imbalance=imbalance, net_pos=net_pos,
+                                       max_price=max_price, min_price=min_price, margin=margin)
+
+    METRICS.histogram("powerbot_algo_phase_seconds", phase="strategy").record(time.perf_counter() - strategy_start)
+
+    # Check the orders against the position and cash limits locally. Orders violating a limit are trimmed or rejected
+    # before they are sent, instead of being rejected by the server after a full round trip.
+    # The settings come from the metadata cache, so changed limits are picked up without a request in every run.
+    with METRICS.phase("risk_check"):
+        risk_engine.set_settings(get_risk_settings())
+        # The client ids are assigned before the check, so the risk engine can match the orders with their order events.
+        for order in to_be_placed:
+            order_manager.tag(order)
+        to_be_placed, rejected = risk_engine.check(to_be_placed)
+        # Only as many orders per contract are placed as the OTR limit of the risk management settings allows,
+        # aggressor orders first.
+        otr_limit = risk_engine.otr_limit(DELIVERY_AREA, PORTFOLIO_ID)
+        if otr_limit is not None:
+            by_contract = {}
+            for order in to_be_placed:
+                by_contract.setdefault(order.contract_id, []).append(order)
+            to_be_placed = []
+            for contract_id, orders in by_contract.items():
+                selected, skipped = otr_tracker.select_within_limit(contract_id, DELIVERY_AREA, otr_limit, orders)
+                to_be_placed.extend(selected)
+                # The skipped orders are not sent, so they must not count as working orders.
+                risk_engine.release(skipped)
+                rejected.extend((order, f"OTR limit {otr_limit}") for order in skipped)
+    for order, reason in rejected:
+        LOGGER.warning(f"Rejected {order.side} order for {order.contract_id} ({order.quantity} MW @ {order.price}): {reason}")
+        audit.record_order(order, "risk_rejected", risk_reason=reason)
+
+    # Send our newly created orders to the exchange (unless the kill switch has been triggered in the meantime).
+    if to_be_placed and not kill_switch.triggered.is_set():
+        # The batch contains aggressor orders, so it jumps ahead of signal uploads and history downloads in the rate limiter.
+        # The order manager tags every order with a client id and tracks its state from the response, so the next run
+        # knows which orders are working without asking the server.
+        # As before, the batch is sent asynchronously and the run does not wait for the response.
+        with METRICS.phase("submit"), client.priority(CRITICAL):
+            submitted = order_manager.submit(to_be_placed, async_req=True)
+        otr_tracker.record_orders(to_be_placed)
+        # Once the response has been processed, the orders are tracked by their order ids (via the order manager's listeners).
+        placed = list(to_be_placed)
+        submitted.add_done_callback(lambda future: risk_engine.release(placed))
 
     # Exit the algorithm and let the calling "run" method know that everything went fine.
     return True
@@ -265,46 +368,136 @@ if __name__ == "__main__":
     URL = config['CLIENT_DATA']['HOST']
     DELIVERY_AREA = config['CONTRACT_DATA']['DELIVERY_AREA']
     PORTFOLIO_ID = config['CONTRACT_DATA']['PORTFOLIO_ID']
+    TENANT_ID = config['CONTRACT_DATA'].get('TENANT_ID')
 
     # Specify the list of products, for which the order book shall be retrieved.
     # Possible values for EPEX: Intraday_Hour_Power, XBID_Hour_Power, Intraday_Quarter_Hour_Power, XBID_Quarter_Hour_Power
     QUARTER_HOUR_PRODUCTS = ["Intraday_Quarter_Hour_Power", "XBID_Quarter_Hour_Power"]
 
     # Specify a time frame in which orders can be placed.
-    # We only want to consider the next 12 upcoming quarter hour contracts.
-    TRADING_WINDOW = timedelta(hours=3)
+    # We only want to consider the next 12 upcoming quarter hour contracts (3 hours, in minutes).
+    TRADING_WINDOW = 180
 
     # Specify an ID for the algorithm, so we can trace orders back to it.
     ALGO_ID = "ALGO1"
 
-    # PowerBot api client setup
-    config = Configuration()
-    config.api_key["api_key"] = API_KEY
-    config.host = URL
+    # File of the periodically written algorithm state, used for warm restarts.
+    CHECKPOINT_PATH = str(Path(__file__).parent / f"{ALGO_ID}.checkpoint")
 
-    client = ApiClient(config)
+    # PowerBot api client setup.
+    # The client limits the request rate on the client side (adapting to 429/503 responses) and records the latency
+    # and the http status of every request per endpoint.
+    client = create_client(API_KEY, URL)
     market_api = MarketApi(client)
     contract_api = ContractApi(client)
     orders_api = OrdersApi(client)
     signals_api = SignalsApi(client)
     logs_api = LogsApi(client)
 
-    # Schedule the execution of the example strategy to run every 15min.
-    schedule.every().hour.at(":00").do(run)
-    schedule.every().hour.at(":15").do(run)
-    schedule.every().hour.at(":30").do(run)
-    schedule.every().hour.at(":45").do(run)
+    # Every order decision is recorded in memory and written in batches by a background thread to a local rotating audit
+    # file, so the trading loop never waits for I/O.
+    audit = AuditTrail(file_path=str(Path(__file__).parent / f"{ALGO_ID}_audit.log"))
+    audit.start()
+
+    # Tenants, portfolios, the permissions of the API key and the risk management settings are loaded once (in parallel)
+    # and cached for an hour; changes made through the client reload them. Unknown or inaccessible portfolios stop the
+    # algorithm, checks the API key is not allowed to run are skipped with a warning.
+    metadata = MetadataCache(client, ttl=3600, portfolio_ids=[PORTFOLIO_ID], tenant_ids=[TENANT_ID])
+    metadata.validate_portfolios([PORTFOLIO_ID])
+
+    # The risk management settings are evaluated locally before every order submission.
+    risk_engine = PreTradeRiskEngine([PORTFOLIO_ID], tenant_id=TENANT_ID)
+    risk_engine.set_settings(get_risk_settings())
+
+    # Warm restart: restore the state of the previous run from its checkpoint (if it is not older than an hour). The
+    # sections are decoded right away, so the file is closed before the checkpoint writer replaces it.
+    checkpoint = load_checkpoint(CHECKPOINT_PATH, max_age=3600)
+    restored = {}
+    if checkpoint:
+        try:
+            restored = {name: checkpoint.section(name) for name in ("orders", "positions", "signals")}
+        finally:
+            checkpoint.close()
+
+    # Own trades are booked in the position book of the risk engine, so the cash limits consider them. At startup, the
+    # trades of all deliveries since midnight (UTC) are loaded, afterwards every run only loads the new ones. After a warm
+    # restart the positions of the checkpoint are restored and only the trades since then are loaded.
+    trades_api = TradesApi(client)
+    risk_engine.position_book.restore_state(restored.get("positions"))
+    risk_engine.update_trades(trades_api, delta=bool(restored.get("positions")),
+                              delivery_within_start=from_minutes(start_of_day()))
+
+    # Our own order actions and trades are counted locally between two order book requests.
+    otr_tracker = OtrTracker([PORTFOLIO_ID])
+
+    # SIGTERM (e.g. when the algo is stopped) or SIGUSR1 delete all orders of the algorithm in parallel bulk requests.
+    kill_switch = KillSwitch(orders_api, [PORTFOLIO_ID], [DELIVERY_AREA])
+    kill_switch.arm_signals()
+
+    # Cancel on disconnect: the orders are deleted as well, if the websocket connection to PowerBot is lost or does not
+    # receive anything (not even a heartbeat) for 30 seconds. The conflating queue keeps only the latest event per
+    # contract, so the pending events cannot pile up between two runs.
+    websocket_queue = ConflatingQueue(maxsize=1000)
+    websocket = PowerBotWebSocket(api_key=API_KEY, base_url=URL,
+                                  subscriptions={f"orderbook_event_{PORTFOLIO_ID}": f"/topic/orderbookchangedevent-{get_exchange(URL)}.{PORTFOLIO_ID}"},
+                                  data_queue=websocket_queue, on_disconnect=kill_switch.on_disconnect)
+    websocket.start()
+    kill_switch.watch_heartbeat(websocket, timeout=30)
+
+    # Every order update processed by the order manager is passed on to the risk engine and the kill switch.
+    order_manager = OrderManager(orders_api, ALGO_ID)
+    order_manager.listeners.extend([risk_engine.on_order, kill_switch.on_order])
+    order_manager.restore_state(restored.get("orders"))
+    # Take over the working orders of a previous run of this algorithm once. All own orders are fetched again in any case,
+    # the restored orders which are no longer working are finished.
+    order_manager.resync([PORTFOLIO_ID], DELIVERY_AREA)
+
+    # The state is written atomically every 10 seconds and when the algorithm stops.
+    uploaded = {"signals": restored.get("signals")}
+    checkpoint_writer = CheckpointWriter(CHECKPOINT_PATH)
+    checkpoint_writer.register("orders", order_manager.checkpoint_state)
+    checkpoint_writer.register("positions", risk_engine.position_book.checkpoint_state)
+    checkpoint_writer.register("signals", lambda: uploaded["signals"])
+    checkpoint_writer.start(interval=10)
+
+    # Schedule the execution of the example strategy to run every 15min (at :00, :15, :30 and :45).
+    # Every run has to finish within 5 minutes, the last 20 seconds are reserved for the risk checks and the submission of
+    # the orders. Runs never overlap, a run that cannot be started in time is skipped.
+    scheduler = DeadlineScheduler(run, interval=900, budget=300, reserve=20)
+
+    # Expose the collected latency histograms and counters for Prometheus under http://127.0.0.1:9100/metrics.
+    # Alternatively, METRICS.start_snapshot_writer("metrics.json") writes them to a file periodically.
+    METRICS.start_http_server(port=9100)
+
+    # The sampling profiler and the allocation tracker can be switched on at runtime with "kill -USR2 <pid>" or with
+    # curl -X POST "http://127.0.0.1:9101/diagnostics/start?duration=300", the results are written to examples/diagnostics.
+    diagnostics = Diagnostics(output_dir=Path(__file__).parent / "diagnostics")
+    if hasattr(signal, "SIGUSR2"):
+        diagnostics.install_signal_handler()
+    diagnostics.start_http_server(port=9101)
 
     LOGGER.info("Starting algo against {} with api_key {}*****".format(URL, API_KEY[:5]))
 
     # Uncomment these two lines to send the proper signals to PowerBot
+    # The signals are uploaded in compressed chunks in parallel, failed chunks can be sent again with uploader.retry(failed).
+    # The signals of a day are always the same, so signals that have already been uploaded before a restart are not sent
+    # again.
     signals = create_signals(0, 7.5, [DELIVERY_AREA], [PORTFOLIO_ID])
-    signals_api.update_signals(signals)
+    signals_hash = hashlib.sha1(json.dumps(client.sanitize_for_serialization(signals), sort_keys=True).encode()).hexdigest()
+    if signals_hash != uploaded["signals"]:
+        failed = SignalUploader(client).upload(signals)
+        if not failed:
+            uploaded["signals"] = signals_hash
 
     # Uncomment this line to run the example strategy directly, without waiting for the scheduled jobs (only runs once).
-    run()
-
-    # Start the scheduled jobs
-    while True:
-        schedule.run_pending()
-        time.sleep(1)
+    scheduler.run_cycle()
+
+    # Start the scheduled jobs (until the kill switch has been triggered)
+    scheduler.run_forever(stop_event=kill_switch.triggered)
+    LOGGER.info(f"Scheduler statistics: {scheduler.stats}")
+    # Writes the profile, if the diagnostics are still enabled.
+    diagnostics.disable()
+    checkpoint_writer.stop()
+    audit.stop()
+    if websocket.is_active:
+        websocket.close()
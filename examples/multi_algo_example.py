@@ -0,0 +1,80 @@
+"""
+PowerBot multi algo script.
+(c) 2020 PowerBot GmbH
+
+This example runs several instances of a simple strategy for different portfolios and delivery areas in a single process.
+The instances are listed under ALGO_INSTANCES in the config file. All of them share one api client, one websocket
+connection and one order book per delivery area, instead of running one process per portfolio and delivery area.
+"""
+
+import json
+import logging
+from swagger_client.models import OrderEntry, OrderModify
+from helpers.algo_host_helper import AlgorithmHost
+from helpers.simple_algo_helper import get_signal_value, get_position_info
+# Load Config File
+from configuration import config
+
+# Setting up logging for commandline output
+logging.basicConfig(level=logging.INFO)
+LOGGER = logging.getLogger()
+
+
+def close_position(context):
+    """
+    Simple strategy, which places one order per contract to close the gap between the position signal and the net position.
+    Previously placed orders of the instance are replaced if the gap has changed.
+
+    :param context: AlgoContext of the instance, which is currently running.
+    """
+
+    # Websocket events are only used as a trigger here, the order book replica has already been invalidated by them.
+    context.drain_events()
+
+    for contract in context.contracts():
+        marginal_price = get_signal_value(contract, "OptSystem", "marginal_price")
+        position_long, position_short = get_position_info(contract)
+        if marginal_price is None or position_long is None:
+            continue
+
+        # The shared order book contains the portfolio information of all portfolios in this delivery area.
+        net_position = next((info.net_pos for info in contract.portfolio_information if info.portfolio_id == context.portfolio_id), 0)
+        delta_q = round(position_long - position_short + net_position, 1)
+
+        # The own orders of the instance are fetched once per run, not per contract.
+        own_orders = context.own_orders(contract.contract_id)
+        working_q = sum(o.quantity if o.buy else -o.quantity for o in own_orders)
+        if round(working_q + delta_q, 1) == 0:
+            continue
+
+        for o in own_orders:
+            context.orders_api.modify_order(order_id=o.order_id, revision_no=o.revision_no, modifications=OrderModify(action="DELE"))
+
+        if delta_q != 0:
+            new_order = OrderEntry(contract_id=contract.contract_id,
+                                   portfolio_id=context.portfolio_id,
+                                   delivery_area=context.delivery_area,
+                                   clearing_acct_type="P",
+                                   ordr_exe_restriction="NON",
+                                   type="O",
+                                   validity_res="GFS",
+                                   state="ACTI",
+                                   side="BUY" if delta_q < 0 else "SELL",
+                                   quantity=abs(delta_q),
+                                   price=round(marginal_price, 2),
+                                   txt=json.dumps({"type": "demo", "algo_id": context.instance.name}))
+            context.orders_api.add_orders([new_order])
+            LOGGER.info(f"{context.instance.name}: {new_order.side} {new_order.quantity} MW of {contract.name} @ {new_order.price}")
+
+
+if __name__ == '__main__':
+
+    # Strategies that can be referenced by the STRATEGY field of an instance in the config file.
+    STRATEGIES = {"close_position": close_position}
+
+    host = AlgorithmHost.from_config(config, STRATEGIES, workers=8)
+    LOGGER.info(f"Starting {len(host.instances)} algo instances against {host.host_url}")
+
+    # A single websocket connection for all portfolios; its events invalidate the shared order books.
+    host.start_websocket()
+    host.run_forever()
@@ -17,9 +17,11 @@ from pathlib import Path
 # PowerBot API generated automatically from the open-api specification using
 # https://swagger.io/swagger-codegen/
 from swagger_client import Configuration, ApiClient, SignalsApi
-from swagger_client.api import MarketApi,  OrdersApi, LogsApi, ContractApi
+from swagger_client.api import MarketApi,  OrdersApi, LogsApi, ContractApi, PortfoliosApi, TradesApi
 from swagger_client.models import OrderEntry
 from helpers.simple_algo_helper import get_previous_values, get_signal_value, get_position_info, delete_orders, create_signals
+from helpers.otr_helper import OtrTracker, DELETION, ENTRY
+from helpers.risk_helper import PreTradeRiskEngine
 # Load Config File
 from configuration import config
 
@@ -43,6 +45,11 @@ def algorithm():
         order_book = contract_api.get_order_books(product=",".join(PRODUCTS), limit=6, delivery_area=DELIVERY_AREA, with_signals=True, portfolio_id=[PORTFOLIO_ID])
         hour_counter = 0
 
+        # Count our own trades since the last run, they lower the OTR of their contracts.
+        otr_tracker.update_trades(trades_api)
+        # The OTR limit of the portfolio's risk management settings (the exchange default, if none is configured).
+        otr_limit = risk_engine.otr_limit(DELIVERY_AREA, PORTFOLIO_ID) or DEFAULT_OTR_LIMIT
+
         # Now that we have the order book, iterate over each contract and perform the desired calculations.
         for contract in order_book.contracts:
             hour_counter += 1
@@ -63,6 +70,10 @@ def algorithm():
             # Place a BUY order if the imbalance is negative; place a SELL order if the imbalance is positive.
             imbalance = position_long - position_short
 
+            # The exchange_otr is only as fresh as the order book request, so it is the base of our local OTR count,
+            # our own order actions during this run are added on top.
+            otr_tracker.sync(contract.contract_id, DELIVERY_AREA, contract.exchange_otr, contract.delivery_end)
+
             # Get the current net position for this contract, i.e. the actual volume that we have already traded at the exchange.
             # The 'abs_pos' element shows the absolute traded quantity (quantity of all BUY and SELL trades for this contract).
             net_position = next(portfolio_info.net_pos for portfolio_info in contract.portfolio_information if portfolio_info.portfolio_id == PORTFOLIO_ID)
@@ -102,54 +113,67 @@ def algorithm():
                 # If the quantity, that needs to be traded, has changed or the marginal price is not the same anymore, then we want to place new orders.
                 if (current_quantity + net_position != imbalance) or marginal_price_changed:
 
-                    # Only do modifications if the OTR is not above 60
-                    if (contract.exchange_otr <= 60):
-
-                        # Delete previously placed orders with our self defined "delete_orders()" method, since we will replace them with new ones.
-                        # If desired, orders can also just be modified instead.
-                        delete_orders(orders_api, to_be_deleted, contract.contract_id, PORTFOLIO_ID, DELIVERY_AREA)
-
-                        # Prepare a new order.
-                        # Every order needs to be associated with exactly one portfolio.
-                        # The fields that need to be set might change depending on the exchange the algorithm is trading at.
-                        new_order = OrderEntry(prod=contract.product,
-                                               contract_id=contract.contract_id,
-                                               portfolio_id=PORTFOLIO_ID,
-                                               delivery_area=DELIVERY_AREA,
-                                               clearing_acct_type="P",
-                                               ordr_exe_restriction="NON",
-                                               type="O",
-                                               validity_res="GFS",
-                                               state="ACTI",
-                                               quantity=0,
-                                               price=0)
-
-                        # Calculate quantity and price
-                        delta_q = imbalance + net_position
-                        quantity = 0
-                        price_premium = 0
-                        if delta_q < 0:
-                            new_order.side = "BUY"
-                            quantity = abs(delta_q)
-                            price_premium = - (hour_counter * 2 - 2)
-                        elif delta_q > 0:
-                            new_order.side = "SELL"
-                            quantity = delta_q
-                            price_premium = hour_counter * 2 - 2
-
-                        # Place new order
-                        if round(quantity, 1) > 0:
-                            # EPEX requires rounding to to 0.1 MW
-                            new_order.quantity = round(quantity, 1)
-                            # EPEX requires rounding to 0.01 EUR
-                            new_order.price = round(marginal_price + price_premium, 2)
-                            # Remember current values (for eventual next iteration) and save them in the text field of the order.
-                            # The exchange does not disclose this field to any other market participant. Only we can see it.
-                            new_order.txt = json.dumps({"type": "demo", "hour_counter": hour_counter, "marginal_price": marginal_price})
-                            orders_api.add_orders([new_order])
+                    # Prepare a new order.
+                    # Every order needs to be associated with exactly one portfolio.
+                    # The fields that need to be set might change depending on the exchange the algorithm is trading at.
+                    new_order = OrderEntry(prod=contract.product,
+                                           contract_id=contract.contract_id,
+                                           portfolio_id=PORTFOLIO_ID,
+                                           delivery_area=DELIVERY_AREA,
+                                           clearing_acct_type="P",
+                                           ordr_exe_restriction="NON",
+                                           type="O",
+                                           validity_res="GFS",
+                                           state="ACTI",
+                                           quantity=0,
+                                           price=0)
+
+                    # Calculate quantity and price
+                    delta_q = imbalance + net_position
+                    quantity = 0
+                    price_premium = 0
+                    if delta_q < 0:
+                        new_order.side = "BUY"
+                        quantity = abs(delta_q)
+                        price_premium = - (hour_counter * 2 - 2)
+                    elif delta_q > 0:
+                        new_order.side = "SELL"
+                        quantity = delta_q
+                        price_premium = hour_counter * 2 - 2
+
+                    # The planned modifications, most important first: deleting the outdated orders, then placing the new one.
+                    candidates = [(DELETION, to_be_deleted)] if to_be_deleted else []
+                    if round(quantity, 1) > 0:
+                        # EPEX requires rounding to to 0.1 MW
+                        new_order.quantity = round(quantity, 1)
+                        # EPEX requires rounding to 0.01 EUR
+                        new_order.price = round(marginal_price + price_premium, 2)
+                        # Remember current values (for eventual next iteration) and save them in the text field of the order.
+                        # The exchange does not disclose this field to any other market participant. Only we can see it.
+                        new_order.txt = json.dumps({"type": "demo", "hour_counter": hour_counter, "marginal_price": marginal_price})
+                        candidates.append((ENTRY, [new_order]))
+
+                    # The OTR tracker selects the modifications that can be sent without exceeding the OTR limit.
+                    # If the new order does not fit, at least the outdated orders are deleted. A new order is never placed
+                    # while the outdated ones stay on the market.
+                    selected, skipped = otr_tracker.select_within_limit(contract.contract_id, DELIVERY_AREA, otr_limit, candidates,
+                                                                        actions=lambda candidate: len(candidate[1]))
+                    if to_be_deleted and (DELETION, to_be_deleted) in skipped:
+                        selected, skipped = [], candidates
+
+                    for action, orders in selected:
+                        if action == DELETION:
+                            # Delete previously placed orders with our self defined "delete_orders()" method, since we will replace them with new ones.
+                            # If desired, orders can also just be modified instead.
+                            delete_orders(orders_api, orders, contract.contract_id, PORTFOLIO_ID, DELIVERY_AREA)
+                            otr_tracker.record(contract.contract_id, DELIVERY_AREA, DELETION, len(orders))
+                        else:
+                            orders_api.add_orders(orders)
+                            otr_tracker.record_orders(orders)
                             LOGGER.info(f"Created {new_order.side} order for {contract.name} for {new_order.quantity} MW and price { new_order.price}")
-                    else:
-                        LOGGER.info(f"OTR already >60 for {contract.name}. Will not take action.")
+
+                    if skipped:
+                        LOGGER.info(f"OTR would exceed {otr_limit} for {contract.name}. Skipped {len(skipped)} of {len(candidates)} modifications.")
                 else:
                     LOGGER.info(f"Orders are already placed for contract {contract.name}. No changes since last iteration.")
             else:
@@ -188,6 +212,10 @@ if __name__ == '__main__':
     # Define the time interval in which the algorithm is executed regularly (in seconds).
     INTERVAL = 30
 
+    # Order-to-trade ratio used if the risk management settings of the portfolio contain no OTR limit.
+    DEFAULT_OTR_LIMIT = 60
+    otr_tracker = OtrTracker(portfolio_ids=[PORTFOLIO_ID])
+
     # PowerBot api client setup.
     # This utilizes the automatically generated Python library from swagger.
     config = Configuration()
@@ -201,6 +229,11 @@ if __name__ == '__main__':
     orders_api = OrdersApi(client)
     contract_api = ContractApi(client)
     logs_api = LogsApi(client)
+    trades_api = TradesApi(client)
+
+    # The OTR limits are part of the risk management settings of the portfolio.
+    risk_engine = PreTradeRiskEngine([PORTFOLIO_ID])
+    risk_engine.load(PortfoliosApi(client))
     # Normally, the signal logic would be completely separate from the actual trading algorithm.
     # This is only done for simplicity purposes in this example.
     signals_api = SignalsApi(client)
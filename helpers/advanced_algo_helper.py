@@ -1,6 +1,6 @@
 import json, random
-from datetime import datetime, timedelta
 from swagger_client.models import BulkSignal
+from helpers.delivery_period_helper import format_minutes, start_of_day
 
 
 def get_order_info(order, field):
@@ -42,9 +42,12 @@ def get_imbalance(contract):
 def create_signals(position_long, position_short, delivery_areas, portfolio_ids):
     '''
     Helper function to create signals, which later can be sent to PowerBot as input for the algorithm.
+    The random values are seeded with the day, so the signals of a day are always the same and need to be uploaded once.
     '''
-    delivery_start = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
-    delivery_end = delivery_start + timedelta(minutes=15)
+    # Delivery periods in minutes since the epoch, the formatted timestamps are cached.
+    delivery_start = start_of_day()
+    delivery_end = delivery_start + 15
+    rng = random.Random(delivery_start)
 
     quarter_hour = 0
 
@@ -54,8 +57,8 @@ def create_signals(position_long, position_short, delivery_areas, portfolio_ids)
 
         position_signal = BulkSignal(
             source="ETRMSystem",
-            delivery_start=delivery_start.strftime("%Y-%m-%dT%H:%M:%SZ"),
-            delivery_end=delivery_end.strftime("%Y-%m-%dT%H:%M:%SZ"),
+            delivery_start=format_minutes(delivery_start),
+            delivery_end=format_minutes(delivery_end),
             portfolio_ids=portfolio_ids,
             delivery_areas=delivery_areas,
             position_long=position_long,
@@ -64,16 +67,16 @@ def create_signals(position_long, position_short, delivery_areas, portfolio_ids)
 
         fair_value_signal = BulkSignal(
             source="OptSystem",
-            delivery_start=delivery_start.strftime("%Y-%m-%dT%H:%M:%SZ"),
-            delivery_end=delivery_end.strftime("%Y-%m-%dT%H:%M:%SZ"),
+            delivery_start=format_minutes(delivery_start),
+            delivery_end=format_minutes(delivery_end),
             portfolio_ids=portfolio_ids,
             delivery_areas=delivery_areas,
             value={
-                "fair_value": round(random.uniform(30, 60), 2),
-                "margin": round(random.uniform(0, 1), 2),
-                "max_spread": round(random.uniform(20, 30), 2),
-                "max_price": round(random.uniform(100, 150), 2),
-                "min_price": round(random.uniform(0, 10), 2)
+                "fair_value": round(rng.uniform(30, 60), 2),
+                "margin": round(rng.uniform(0, 1), 2),
+                "max_spread": round(rng.uniform(20, 30), 2),
+                "max_price": round(rng.uniform(100, 150), 2),
+                "min_price": round(rng.uniform(0, 10), 2)
             }
         )
 
@@ -83,6 +86,6 @@ def create_signals(position_long, position_short, delivery_areas, portfolio_ids)
         quarter_hour += 1
 
         delivery_start = delivery_end
-        delivery_end = delivery_start + timedelta(minutes=15)
+        delivery_end = delivery_start + 15
 
     return signals
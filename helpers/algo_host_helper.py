@@ -0,0 +1,307 @@
+"""
+Powerbot algorithm host helpers
+(c) 2020 PowerBot GmbH
+
+Runs many (strategy, portfolio, delivery area, products) instances in a single process. All instances share one pooled
+ApiClient, one websocket connection and one order book replica per delivery area and are scheduled fairly on a worker pool.
+"""
+
+import heapq
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue, Empty
+from swagger_client.api import MarketApi, ContractApi, OrdersApi, SignalsApi
+from helpers.client_helper import create_client, get_exchange
+from helpers.event_helper import get_field, parse_message
+from helpers.websocket_helper import PowerBotWebSocket
+
+LOGGER = logging.getLogger("AlgorithmHost")
+
+
+class AlgoInstance:
+    """
+    A single strategy instance trading one portfolio in one delivery area.
+    """
+
+    def __init__(self, name, strategy, portfolio_id, delivery_area, products, interval=30, max_events=1000):
+        """
+        :param name: Unique name of the instance (used for logging).
+        :param strategy: Function strategy(context) holding the trading logic.
+        :param portfolio_id: The portfolio the instance is trading in.
+        :param delivery_area: The delivery area the instance is trading in.
+        :param products: List of products the instance is interested in.
+        :param interval: Time between two runs in seconds.
+        :param max_events: Number of websocket events kept for the instance, older ones are dropped.
+        """
+
+        self.name = name
+        self.strategy = strategy
+        self.portfolio_id = portfolio_id
+        self.delivery_area = delivery_area
+        self.products = list(products)
+        self.interval = interval
+        self.events = deque(maxlen=max_events)
+        self.running = False
+        self.runs = 0
+        self.failures = 0
+
+
+class AlgoContext:
+    """
+    Everything a strategy needs for a single run. The api objects and the order book replica are shared by all instances.
+    """
+
+    def __init__(self, host, instance):
+        self.host = host
+        self.instance = instance
+        self.portfolio_id = instance.portfolio_id
+        self.delivery_area = instance.delivery_area
+        self.market_api = host.market_api
+        self.contract_api = host.contract_api
+        self.orders_api = host.orders_api
+        self.signals_api = host.signals_api
+        self.__own_orders = None
+
+    def contracts(self):
+        """
+        :return: The contracts of the instance's products from the shared order book replica.
+        """
+        return self.host.order_book_replica.contracts(self.delivery_area, self.instance.products)
+
+    def own_orders(self, contract_id=None):
+        """
+        The own orders of the instance's portfolio and delivery area are fetched once per run, not per contract.
+        Maximum limit of orders that can be retrieved with a single request is 500, therefore a loop is used.
+
+        :param contract_id: If set, only the orders of this contract are returned.
+        :return: List of own orders.
+        """
+
+        if self.__own_orders is None:
+            by_contract = {}
+            offset = 0
+            more_orders = True
+            while more_orders:
+                own_orders = self.orders_api.get_own_orders(portfolio_id=[self.portfolio_id], delivery_area=self.delivery_area,
+                                                            offset=offset, limit=500)
+                for own_order in own_orders:
+                    by_contract.setdefault(own_order.contract_id, []).append(own_order)
+                offset += 500
+                more_orders = len(own_orders) == 500
+            self.__own_orders = by_contract
+
+        if contract_id is not None:
+            return list(self.__own_orders.get(contract_id, []))
+        return [own_order for own_orders in self.__own_orders.values() for own_order in own_orders]
+
+    def drain_events(self):
+        """
+        :return: All websocket events received for the instance's portfolio since the last call.
+        """
+
+        events = []
+        while self.instance.events:
+            events.append(self.instance.events.popleft())
+        return events
+
+
+class OrderBookReplica:
+    """
+    One order book per delivery area, containing the union of all products and portfolios of the instances trading in it.
+    The order book is refreshed at most every [max_age] seconds or after a websocket event invalidated it. Concurrent
+    readers of the same delivery area share a single request.
+    """
+
+    def __init__(self, contract_api, max_age=5):
+        self.contract_api = contract_api
+        self.max_age = max_age
+        self.__lock = threading.Lock()
+        # {delivery_area: {"products": set, "portfolio_ids": set, "lock": Lock, "fetched": float, "by_product": dict,
+        #                  "contract_ids": set}}
+        self.__areas = {}
+
+    def register(self, delivery_area, products, portfolio_id):
+        with self.__lock:
+            area = self.__areas.setdefault(delivery_area, {"products": set(), "portfolio_ids": set(), "lock": threading.Lock(),
+                                                           "fetched": 0, "by_product": {}, "contract_ids": set()})
+            area["products"].update(products)
+            area["portfolio_ids"].add(portfolio_id)
+
+    def invalidate(self, delivery_area=None):
+        """
+        Marks the order book of the delivery area (or of all delivery areas) as outdated.
+        """
+
+        for name, area in self.__areas.items():
+            if delivery_area is None or name == delivery_area:
+                area["fetched"] = 0
+
+    def invalidate_events(self, events):
+        """
+        Marks the order books outdated that contain a contract of the order book changed events. Events of other delivery
+        areas or of contracts of other products are ignored.
+        """
+
+        for event in events:
+            area = self.__areas.get(get_field(event, "delivery_area"))
+            if area is None or not area["fetched"]:
+                continue
+            if get_field(event, "contract_id") in area["contract_ids"]:
+                area["fetched"] = 0
+            elif get_field(event, "product") in area["products"] or get_field(event, "product") is None:
+                # A contract that is not in the order book yet, e.g. a newly opened one.
+                area["fetched"] = 0
+
+    def contracts(self, delivery_area, products):
+        area = self.__areas[delivery_area]
+        if time.monotonic() - area["fetched"] > self.max_age:
+            with area["lock"]:
+                # Another instance might have refreshed the order book while we were waiting for the lock.
+                if time.monotonic() - area["fetched"] > self.max_age:
+                    order_book = self.contract_api.get_order_books(product=",".join(sorted(area["products"])),
+                                                                   portfolio_id=sorted(area["portfolio_ids"]),
+                                                                   delivery_area=delivery_area,
+                                                                   with_signals=True)
+                    by_product = {}
+                    for contract in order_book.contracts:
+                        by_product.setdefault(contract.product, []).append(contract)
+                    area["by_product"] = by_product
+                    area["contract_ids"] = {contract.contract_id for contract in order_book.contracts}
+                    area["fetched"] = time.monotonic()
+
+        by_product = area["by_product"]
+        return [contract for product in products for contract in by_product.get(product, [])]
+
+
+class AlgorithmHost:
+    """
+    Schedules the runs of all instances on a worker pool. An instance never runs twice at the same time and due instances
+    are started in the order of their due time, so a slow instance cannot starve the others.
+    """
+
+    def __init__(self, api_key, host_url, workers=8, order_book_max_age=5, exchange=None):
+        """
+        :param exchange: Exchange of the websocket topics (defaults to the exchange in the host URL).
+        """
+
+        self.api_key = api_key
+        self.host_url = host_url
+        self.exchange = exchange or get_exchange(host_url)
+        # Every worker can have one request in flight, so the connection pool does not need to be larger.
+        # The rate limiter of the client is shared by all instances as well.
+        self.client = create_client(api_key, host_url, connection_pool_maxsize=workers)
+        self.market_api = MarketApi(self.client)
+        self.contract_api = ContractApi(self.client)
+        self.orders_api = OrdersApi(self.client)
+        self.signals_api = SignalsApi(self.client)
+        self.order_book_replica = OrderBookReplica(self.contract_api, max_age=order_book_max_age)
+
+        self.__executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="AlgoWorker")
+        self.__instances = []
+        self.__queue = Queue()
+        self.__websocket = None
+        self.__active = False
+
+    @classmethod
+    def from_config(cls, config, strategies, workers=8):
+        """
+        Creates a host with the instances listed under ALGO_INSTANCES in config.yml.
+
+        :param config: The parsed configuration.
+        :param strategies: Dictionary {name: strategy function} used to resolve the STRATEGY of an instance.
+        """
+
+        host = cls(config["CLIENT_DATA"]["API_KEY"], config["CLIENT_DATA"]["HOST"], workers=workers,
+                   exchange=config["CLIENT_DATA"].get("EXCHANGE"))
+        for entry in config["ALGO_INSTANCES"]:
+            host.add_instance(AlgoInstance(name=entry["NAME"],
+                                           strategy=strategies[entry["STRATEGY"]],
+                                           portfolio_id=entry["PORTFOLIO_ID"],
+                                           delivery_area=entry["DELIVERY_AREA"],
+                                           products=entry["PRODUCTS"],
+                                           interval=entry.get("INTERVAL", 30)))
+        return host
+
+    @property
+    def instances(self):
+        return list(self.__instances)
+
+    def add_instance(self, instance):
+        self.__instances.append(instance)
+        self.order_book_replica.register(instance.delivery_area, instance.products, instance.portfolio_id)
+
+    def start_websocket(self):
+        """
+        Opens a single websocket connection with one order book subscription per portfolio and routes the received
+        events to the instances trading in the respective portfolio.
+        """
+
+        portfolio_ids = sorted({instance.portfolio_id for instance in self.__instances})
+        subscriptions = {f"orderbook_event_{portfolio_id}": f"/topic/orderbookchangedevent-{self.exchange}.{portfolio_id}"
+                         for portfolio_id in portfolio_ids}
+        self.__websocket = PowerBotWebSocket(api_key=self.api_key, base_url=self.host_url, subscriptions=subscriptions,
+                                             data_queue=self.__queue)
+        self.__websocket.start()
+        threading.Thread(target=self.__dispatch_events, name="AlgoEventDispatcher", daemon=True).start()
+
+    def __dispatch_events(self):
+        routes = {}
+        for instance in self.__instances:
+            routes.setdefault(f"orderbook_event_{instance.portfolio_id}", []).append(instance)
+
+        while self.__websocket.is_active:
+            try:
+                message = self.__queue.get(timeout=1)
+            except Empty:
+                continue
+            # Only the order books of the delivery areas (and contracts) named in the events are outdated.
+            try:
+                self.order_book_replica.invalidate_events(parse_message(message))
+            except ValueError:
+                self.order_book_replica.invalidate()
+            for instance in routes.get(message["headers"].get("subscription"), []):
+                instance.events.append(message)
+
+    def run_forever(self, tick=0.2):
+        """
+        Runs the scheduling loop until stop() is called.
+        """
+
+        self.__active = True
+        now = time.monotonic()
+        # Heap of (due time, sequence number, instance). The sequence number keeps the order stable for equal due times.
+        due = [(now, index, instance) for index, instance in enumerate(self.__instances)]
+        heapq.heapify(due)
+        sequence = len(due)
+
+        while self.__active:
+            now = time.monotonic()
+            while due and due[0][0] <= now:
+                _, _, instance = heapq.heappop(due)
+                if not instance.running:
+                    instance.running = True
+                    self.__executor.submit(self.__run_instance, instance)
+                else:
+                    LOGGER.warning(f"{instance.name} is still running, skipping this run.")
+                heapq.heappush(due, (now + instance.interval, sequence, instance))
+                sequence += 1
+            time.sleep(tick)
+
+    def stop(self):
+        self.__active = False
+        if self.__websocket:
+            self.__websocket.close()
+        self.__executor.shutdown(wait=True)
+
+    def __run_instance(self, instance):
+        try:
+            instance.strategy(AlgoContext(self, instance))
+            instance.runs += 1
+        except Exception as e:
+            instance.failures += 1
+            LOGGER.exception(f"{instance.name} failed: {e}")
+        finally:
+            instance.running = False
@@ -0,0 +1,256 @@
+"""
+Powerbot asyncio client helpers
+(c) 2020 PowerBot GmbH
+
+asyncio transport for the generated swagger client. The AsyncApiClient can be passed to the generated api classes
+(OrdersApi, ContractApi, SignalsApi, ...) like the ApiClient, their methods keep their signatures but return awaitables,
+which are executed on a shared aiohttp connection pool. A single event loop can run hundreds of concurrent requests
+without any threads, next to the AsyncPowerBotWebSocket:
+
+    async def main():
+        client = AsyncApiClient(configuration)
+        orders_api = OrdersApi(client)
+        own_orders, order_book = await asyncio.gather(
+            orders_api.get_own_orders(portfolio_id=[PORTFOLIO_ID], delivery_area=DELIVERY_AREA),
+            ContractApi(client).get_order_books(delivery_area=DELIVERY_AREA, _request_timeout=2)
+        )
+        await client.close()
+
+The client side rate limiter of the rate_limit_helper is thread based and is not used by the AsyncApiClient.
+"""
+
+import asyncio
+import json
+import logging
+import ssl
+import time
+import uuid
+from urllib.parse import quote
+import aiohttp
+import certifi
+import stomper
+from swagger_client import ApiClient
+from swagger_client.rest import ApiException
+from helpers.instrumentation_helper import METRICS
+
+LOGGER = logging.getLogger("AsyncApiClient")
+
+
+class AsyncResponse:
+    """
+    Response with the interface of the swagger RESTResponse, used for the deserialization and the ApiException.
+    """
+
+    def __init__(self, status, reason, data, headers):
+        self.status = status
+        self.reason = reason
+        self.data = data
+        self.headers = headers
+
+    def getheaders(self):
+        return self.headers
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name, default)
+
+
+class AsyncApiClient(ApiClient):
+    """
+    ApiClient whose call_api returns a coroutine instead of the result. The serialization, the authentication and the
+    deserialization are those of the generated client, only the transport is replaced.
+    """
+
+    def __init__(self, configuration=None, connection_limit=100, timeout=30, metrics=METRICS, **kwargs):
+        """
+        :param connection_limit: Maximum number of open connections of the shared pool.
+        :param timeout: Default timeout per request in seconds, can be overridden per call with _request_timeout
+                        (seconds or a tuple of connect and read timeout).
+        :param metrics: Metrics registry for the request latencies (see instrumentation_helper).
+        """
+
+        super().__init__(configuration, **kwargs)
+        self.connection_limit = connection_limit
+        self.timeout = timeout
+        self.metrics = metrics
+        self.__session = None
+
+    @property
+    def session(self):
+        """
+        The shared aiohttp session, created on first use within the running event loop.
+        """
+
+        if self.__session is None or self.__session.closed:
+            configuration = self.configuration
+            if getattr(configuration, "verify_ssl", True):
+                ssl_context = ssl.create_default_context(cafile=getattr(configuration, "ssl_ca_cert", None) or certifi.where())
+            else:
+                ssl_context = False
+            connector = aiohttp.TCPConnector(limit=self.connection_limit, ssl=ssl_context)
+            self.__session = aiohttp.ClientSession(connector=connector)
+        return self.__session
+
+    async def close(self):
+        if self.__session is not None:
+            await self.__session.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    def call_api(self, resource_path, method, path_params=None, query_params=None, header_params=None, body=None,
+                 post_params=None, files=None, response_type=None, auth_settings=None, async_req=None,
+                 _return_http_data_only=None, collection_formats=None, _preload_content=True, _request_timeout=None):
+        # Every call is asynchronous, async_req is ignored.
+        return self.__call_api(resource_path, method, path_params, query_params, header_params, body, post_params, files,
+                               response_type, auth_settings, _return_http_data_only, collection_formats, _preload_content,
+                               _request_timeout)
+
+    async def __call_api(self, resource_path, method, path_params, query_params, header_params, body, post_params, files,
+                         response_type, auth_settings, _return_http_data_only, collection_formats, _preload_content,
+                         _request_timeout):
+        configuration = self.configuration
+        endpoint = f"{method} {resource_path}"
+
+        # Same preparation of the parameters as the generated ApiClient.__call_api
+        header_params = header_params or {}
+        header_params.update(self.default_headers)
+        if self.cookie:
+            header_params["Cookie"] = self.cookie
+        header_params = dict(self.parameters_to_tuples(self.sanitize_for_serialization(header_params), collection_formats))
+
+        if path_params:
+            path_params = self.parameters_to_tuples(self.sanitize_for_serialization(path_params), collection_formats)
+            for name, value in path_params:
+                resource_path = resource_path.replace(f"{{{name}}}", quote(str(value), safe=getattr(configuration, "safe_chars_for_path_param", "")))
+
+        query_params = self.parameters_to_tuples(self.sanitize_for_serialization(query_params), collection_formats) if query_params else []
+        if post_params or files:
+            post_params = self.prepare_post_parameters(post_params, files)
+            post_params = self.parameters_to_tuples(self.sanitize_for_serialization(post_params), collection_formats)
+
+        self.update_params_for_auth(header_params, query_params, auth_settings)
+        # aiohttp only accepts str, int and float as query values.
+        query_params = [(name, value if isinstance(value, (str, int, float)) and not isinstance(value, bool) else str(value))
+                        for name, value in query_params]
+
+        data = None
+        if body is not None:
+            header_params.setdefault("Content-Type", "application/json")
+            data = json.dumps(self.sanitize_for_serialization(body))
+        elif post_params:
+            data = aiohttp.FormData(post_params)
+            header_params.pop("Content-Type", None)
+
+        start = time.perf_counter()
+        status = "error"
+        try:
+            async with self.session.request(method, configuration.host + resource_path, params=query_params, data=data,
+                                            headers=header_params, timeout=self.__timeout(_request_timeout)) as http_response:
+                response = AsyncResponse(http_response.status, http_response.reason, await http_response.read(),
+                                         dict(http_response.headers))
+            status = str(response.status)
+        finally:
+            self.metrics.histogram("powerbot_api_request_seconds", endpoint=endpoint).record(time.perf_counter() - start)
+            self.metrics.increment("powerbot_api_requests_total", endpoint=endpoint, status=status)
+
+        if not 200 <= response.status <= 299:
+            raise ApiException(http_resp=response)
+
+        if not _preload_content:
+            return_data = response
+        elif response_type:
+            return_data = self.deserialize(response, response_type)
+        else:
+            return_data = None
+
+        if _return_http_data_only:
+            return return_data
+        return return_data, response.status, response.headers
+
+    def __timeout(self, request_timeout):
+        if request_timeout is None:
+            return aiohttp.ClientTimeout(total=self.timeout)
+        if isinstance(request_timeout, (tuple, list)):
+            return aiohttp.ClientTimeout(sock_connect=request_timeout[0], sock_read=request_timeout[1])
+        return aiohttp.ClientTimeout(total=request_timeout)
+
+
+class AsyncPowerBotWebSocket:
+    """
+    STOMP websocket client on the event loop, the asyncio counterpart of the PowerBotWebSocket.
+
+        websocket = AsyncPowerBotWebSocket(api_key, host_url, subscriptions, session=client.session)
+        await websocket.connect()
+        async for message in websocket:
+            events = parse_message(message)
+    """
+
+    def __init__(self, api_key, base_url, subscriptions, session=None, heartbeat=10):
+        """
+        :param subscriptions: Dictionary {subscription id: topic}.
+        :param session: Optional aiohttp session, e.g. the one of the AsyncApiClient.
+        :param heartbeat: Interval of the heartbeats in seconds.
+        """
+
+        self.url = base_url.replace("https", "wss").replace("api", "subscription") + f"?api_key={api_key}"
+        self.subscriptions = subscriptions
+        self.heartbeat = heartbeat
+        self.last_message_time = time.monotonic()
+        self.__session = session
+        self.__own_session = session is None
+        self.__websocket = None
+        self.__heartbeat_task = None
+
+    @property
+    def is_active(self):
+        return self.__websocket is not None and not self.__websocket.closed
+
+    async def connect(self):
+        if self.__session is None:
+            self.__session = aiohttp.ClientSession()
+        self.__websocket = await self.__session.ws_connect(self.url)
+
+        connect = stomper.Frame()
+        connect.setCmd("CONNECT")
+        connect.headers = {"accept-version": "1.1", "heart-beat": f"{self.heartbeat * 1000},{self.heartbeat * 1000}"}
+        await self.__websocket.send_str(connect.pack())
+        self.__heartbeat_task = asyncio.ensure_future(self.__send_heartbeats())
+
+    async def __send_heartbeats(self):
+        while self.is_active:
+            await self.__websocket.send_str("\n")
+            await asyncio.sleep(self.heartbeat)
+
+    def __aiter__(self):
+        return self.messages()
+
+    async def messages(self):
+        """
+        Yields the MESSAGE frames (as unpacked by stomper) until the connection is closed.
+        """
+
+        async for ws_message in self.__websocket:
+            self.last_message_time = time.monotonic()
+            if ws_message.type != aiohttp.WSMsgType.TEXT or ws_message.data == "\n":
+                continue
+            frame = stomper.unpack_frame(ws_message.data)
+            if frame["cmd"] == "CONNECTED":
+                for sub_id, subscription in self.subscriptions.items():
+                    await self.__websocket.send_str(stomper.subscribe(subscription, sub_id))
+            elif frame["cmd"] == "MESSAGE":
+                yield frame
+            elif frame["cmd"] == "ERROR":
+                LOGGER.warning(f"STOMP error: {frame}")
+        LOGGER.info("CONNECTION CLOSED")
+
+    async def close(self):
+        if self.is_active:
+            await self.__websocket.send_str(stomper.disconnect(str(uuid.uuid4())))
+            await self.__websocket.close()
+        if self.__heartbeat_task:
+            self.__heartbeat_task.cancel()
+        if self.__own_session and self.__session is not None:
+            await self.__session.close()
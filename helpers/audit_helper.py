@@ -0,0 +1,199 @@
+"""
+Powerbot audit helpers
+(c) 2020 PowerBot GmbH
+
+Structured decision trail of an algorithm. Every order decision (contract, side, quantity, price, signal inputs and
+reason) is appended to an in-memory buffer without any I/O or locking in the trading loop. A background worker writes
+the entries in batches to a local rotating, gzip compressed file and passes them to optional shippers (functions, e.g.
+forwarding them to a log collector). The entries are not sent to PowerBot. Both priorities share one capacity; if the
+worker cannot keep up, the oldest low priority entries are dropped first and high priority entries only when no low
+priority entry is left. Recording never blocks the strategy.
+"""
+
+import gzip
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from collections import deque
+from logging.handlers import RotatingFileHandler
+from helpers.event_helper import get_field
+
+# Priorities of the audit entries
+HIGH = "HIGH"
+LOW = "LOW"
+
+LOGGER = logging.getLogger("Audit")
+
+
+def _rotate_compressed(source, destination):
+    with open(source, "rb") as file, gzip.open(destination, "wb") as compressed_file:
+        shutil.copyfileobj(file, compressed_file)
+    os.remove(source)
+
+
+def create_audit_file_handler(path, max_bytes=50 * 1024 * 1024, backup_count=10):
+    """
+    Helper function to create a file handler writing one JSON entry per line, which compresses the rotated files
+    (audit.log -> audit.log.1.gz, ...).
+    """
+
+    handler = RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count)
+    handler.namer = lambda name: f"{name}.gz"
+    handler.rotator = _rotate_compressed
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    return handler
+
+
+class AuditTrail:
+    """
+    Buffers of audit entries per priority with a shared capacity and the background worker shipping them.
+    """
+
+    def __init__(self, shippers=(), file_path=None, capacity=100000, batch_size=500, interval=1):
+        """
+        :param shippers: Functions shipper(entries) receiving every batch of entries (dictionaries).
+        :param file_path: Optional path of the local audit file (rotated and compressed).
+        :param capacity: Maximum number of pending entries of both priorities. If the buffers are full, the oldest LOW
+                         entry is dropped; HIGH entries are only dropped if there are no LOW entries left.
+        :param batch_size: Maximum number of entries per batch.
+        :param interval: Time between two batches in seconds.
+        """
+
+        self.shippers = list(shippers)
+        self.capacity = capacity
+        self.batch_size = batch_size
+        self.interval = interval
+        # Appending to and popping from a deque are atomic, so recording does not need a lock.
+        self.__buffers = {HIGH: deque(), LOW: deque()}
+        self.__file_logger = None
+        if file_path:
+            self.__file_logger = logging.getLogger(f"AuditFile.{file_path}")
+            self.__file_logger.propagate = False
+            self.__file_logger.setLevel(logging.INFO)
+            self.__file_logger.addHandler(create_audit_file_handler(file_path))
+
+        self.recorded = 0
+        self.dropped = 0
+        self.shipped = 0
+        self.failed = 0
+        self.__stop = threading.Event()
+        self.__thread = None
+
+    def record(self, event, priority=HIGH, **fields):
+        """
+        Appends an entry to the ring buffer. Never blocks and never does any I/O.
+
+        :param event: Type of the entry, e.g. ORDER_DECISION.
+        :param priority: HIGH or LOW. Under backpressure LOW entries are dropped first.
+        :param fields: JSON serializable fields of the entry.
+        """
+
+        if self.pending >= self.capacity and not self.__evict(priority):
+            # Full of HIGH entries, a LOW entry is not recorded at all.
+            self.dropped += 1
+            return
+        fields["event"] = event
+        fields["timestamp"] = time.time()
+        self.__buffers[priority].append(fields)
+        self.recorded += 1
+
+    def __evict(self, priority):
+        # Drops the oldest entry of the lowest priority, but never a HIGH entry in favour of a LOW one.
+        for candidate in ((LOW, HIGH) if priority == HIGH else (LOW,)):
+            try:
+                self.__buffers[candidate].popleft()
+            except IndexError:
+                # Empty (or emptied by the worker in the meantime).
+                continue
+            self.dropped += 1
+            return True
+        return not self.pending >= self.capacity
+
+    def record_order(self, order, reason, priority=HIGH, **inputs):
+        """
+        Records an order decision.
+
+        :param order: OrderEntry (or order event).
+        :param reason: Why the order has been created, e.g. "aggressor".
+        :param inputs: The signal and market inputs of the decision, e.g. imbalance=..., max_price=...
+        """
+
+        self.record("ORDER_DECISION", priority, contract_id=get_field(order, "contract_id"),
+                    delivery_area=get_field(order, "delivery_area"), portfolio_id=get_field(order, "portfolio_id"),
+                    side=get_field(order, "side"), quantity=get_field(order, "quantity"), price=get_field(order, "price"),
+                    reason=reason, inputs=inputs)
+
+    @property
+    def pending(self):
+        return sum(len(buffer) for buffer in self.__buffers.values())
+
+    def __next_batch(self):
+        batch = []
+        # HIGH entries are shipped first, LOW entries only fill up the batch.
+        for priority in (HIGH, LOW):
+            buffer = self.__buffers[priority]
+            while buffer and len(batch) < self.batch_size:
+                try:
+                    batch.append(buffer.popleft())
+                except IndexError:
+                    break
+        return batch
+
+    def flush(self):
+        """
+        Ships all pending entries.
+
+        :return: Number of shipped entries.
+        """
+
+        shipped = 0
+        batch = self.__next_batch()
+        while batch:
+            self.__ship(batch)
+            shipped += len(batch)
+            batch = self.__next_batch()
+        return shipped
+
+    def __ship(self, batch):
+        if self.__file_logger:
+            for entry in batch:
+                self.__file_logger.info(json.dumps(entry, separators=(",", ":"), default=str))
+        for shipper in self.shippers:
+            try:
+                shipper(batch)
+                self.shipped += len(batch)
+            except Exception as e:
+                # The entries are still in the local file, they are not sent again to avoid a growing backlog.
+                self.failed += len(batch)
+                LOGGER.warning(f"Shipping {len(batch)} audit entries with {shipper} failed: {e}")
+
+    def start(self):
+        """
+        Starts the background worker, which ships a batch every [interval] seconds (or immediately, if there are more
+        pending entries than fit into a batch).
+        """
+
+        def run():
+            while not self.__stop.is_set():
+                batch = self.__next_batch()
+                if batch:
+                    self.__ship(batch)
+                if self.pending < self.batch_size:
+                    self.__stop.wait(self.interval)
+
+        self.__stop.clear()
+        self.__thread = threading.Thread(target=run, name="AuditShipper", daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        """
+        Stops the worker and ships the remaining entries.
+        """
+
+        self.__stop.set()
+        if self.__thread:
+            self.__thread.join()
+        self.flush()
@@ -0,0 +1,248 @@
+"""
+Powerbot checkpoint helpers
+(c) 2020 PowerBot GmbH
+
+Warm restarts of algorithms. The in-memory state of the registered components (e.g. working orders of the order manager,
+positions of the position book, hashes of the last uploaded signals) is written periodically into a compact binary
+checkpoint file. After a restart or a deploy the file is memory-mapped and each component restores its state:
+
+* the position book only loads the trades since the checkpoint (the trades are returned newest first)
+* signals that have already been uploaded are not sent again
+* the working orders are still fetched in full and matched with the restored ones (client ids and states), because
+  get_own_orders cannot be filtered by modification time
+* the order book is not checkpointed, it is requested again with the first run, as it is outdated after any downtime
+
+The checkpoint has to be closed after the sections have been read, an open mapping prevents the next write from replacing
+the file on Windows:
+
+    checkpoint = load_checkpoint("algo.ckpt")
+    if checkpoint:
+        try:
+            order_manager.restore_state(checkpoint.section("orders"))
+        finally:
+            checkpoint.close()
+
+File layout (little endian):
+    header:  magic (4 bytes) | format version (u16) | python version (2 x u8) | created (f64) | number of sections (u32)
+    section: name length (u16) | name | payload length (u32) | crc32 of the payload (u32) | payload
+
+The payloads are encoded with marshal, which only supports built-in types (tuples, lists, dicts, str, numbers, ...), is
+much faster and more compact than JSON and cannot execute code on load. The marshal format depends on the python version,
+so a checkpoint written by another python version is ignored.
+"""
+
+import logging
+import marshal
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+import zlib
+
+MAGIC = b"PBCK"
+VERSION = 1
+
+HEADER = struct.Struct("<4sHBBdI")
+SECTION_NAME = struct.Struct("<H")
+SECTION_PAYLOAD = struct.Struct("<II")
+
+LOGGER = logging.getLogger("Checkpoint")
+
+
+class CheckpointError(Exception):
+    """
+    Raised if a checkpoint file is corrupt or has been written by an incompatible version.
+    """
+
+
+def write_checkpoint(path, sections):
+    """
+    Writes the sections atomically: the file is written to a temporary file, synced to disk and renamed, so a crash
+    during the write never leaves a partial checkpoint behind.
+
+    :param path: Path of the checkpoint file.
+    :param sections: Dictionary {name: state} of marshallable states.
+    :return: Size of the checkpoint in bytes.
+    """
+
+    parts = [HEADER.pack(MAGIC, VERSION, sys.version_info[0], sys.version_info[1], time.time(), len(sections))]
+    for name, state in sections.items():
+        encoded_name = name.encode()
+        payload = marshal.dumps(state)
+        parts.extend((SECTION_NAME.pack(len(encoded_name)), encoded_name,
+                      SECTION_PAYLOAD.pack(len(payload), zlib.crc32(payload)), payload))
+    data = b"".join(parts)
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as file:
+        file.write(data)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, path)
+    return len(data)
+
+
+class Checkpoint:
+    """
+    A memory-mapped checkpoint file. The sections are only decoded when they are requested.
+    """
+
+    def __init__(self, path):
+        """
+        :raises CheckpointError: If the file is corrupt or incompatible.
+        """
+
+        self.path = path
+        with open(path, "rb") as file:
+            self.__map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self.__parse()
+        except Exception:
+            self.__map.close()
+            raise
+
+    def __parse(self):
+        path = self.path
+        try:
+            magic, version, major, minor, self.created, count = HEADER.unpack_from(self.__map, 0)
+        except struct.error:
+            raise CheckpointError(f"{path} is truncated.")
+        if magic != MAGIC or version != VERSION:
+            raise CheckpointError(f"{path} is not a checkpoint of version {VERSION}.")
+        if (major, minor) != sys.version_info[:2]:
+            raise CheckpointError(f"{path} has been written by python {major}.{minor}.")
+
+        # {name: (offset, length, crc)}
+        self.__sections = {}
+        offset = HEADER.size
+        try:
+            for _ in range(count):
+                name_length, = SECTION_NAME.unpack_from(self.__map, offset)
+                offset += SECTION_NAME.size
+                name = self.__map[offset:offset + name_length].decode()
+                offset += name_length
+                length, crc = SECTION_PAYLOAD.unpack_from(self.__map, offset)
+                offset += SECTION_PAYLOAD.size
+                self.__sections[name] = (offset, length, crc)
+                offset += length
+        except struct.error:
+            raise CheckpointError(f"{path} is truncated.")
+        if offset > len(self.__map):
+            raise CheckpointError(f"{path} is truncated.")
+
+    @property
+    def age(self):
+        return time.time() - self.created
+
+    @property
+    def sections(self):
+        return list(self.__sections)
+
+    def section(self, name, default=None):
+        """
+        :return: The decoded state of the section or [default], if the checkpoint does not contain the section.
+        :raises CheckpointError: If the payload of the section is corrupt.
+        """
+
+        if name not in self.__sections:
+            return default
+        offset, length, crc = self.__sections[name]
+        payload = memoryview(self.__map)[offset:offset + length]
+        try:
+            if zlib.crc32(payload) != crc:
+                raise CheckpointError(f"Section {name} of {self.path} is corrupt.")
+            return marshal.loads(payload)
+        finally:
+            payload.release()
+
+    def close(self):
+        self.__map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def load_checkpoint(path, max_age=None):
+    """
+    Helper function to open a checkpoint for a warm restart.
+
+    :param path: Path of the checkpoint file.
+    :param max_age: Checkpoints older than [max_age] seconds are ignored.
+    :return: Checkpoint or None, if there is no usable checkpoint (the algorithm has to start cold).
+    """
+
+    if not os.path.exists(path):
+        return None
+    try:
+        checkpoint = Checkpoint(path)
+    except (CheckpointError, ValueError) as e:
+        # ValueError: an empty file cannot be mapped.
+        LOGGER.warning(f"Ignoring checkpoint: {e}")
+        return None
+    if max_age is not None and checkpoint.age > max_age:
+        LOGGER.info(f"Ignoring checkpoint, it is {checkpoint.age:.0f}s old.")
+        checkpoint.close()
+        return None
+    return checkpoint
+
+
+class CheckpointWriter:
+    """
+    Collects the states of the registered components and writes them into a checkpoint file, on demand or periodically.
+
+        writer = CheckpointWriter("algo.ckpt")
+        writer.register("orders", order_manager.checkpoint_state)
+        writer.register("positions", position_book.checkpoint_state)
+        writer.start(interval=10)
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.__providers = {}
+        self.__lock = threading.Lock()
+        self.__stop = threading.Event()
+        self.__thread = None
+
+    def register(self, name, provider):
+        """
+        :param name: Name of the section.
+        :param provider: Function without arguments returning the marshallable state of the component.
+        """
+        self.__providers[name] = provider
+
+    def write(self):
+        """
+        :return: Size of the written checkpoint in bytes.
+        """
+
+        with self.__lock:
+            sections = {name: provider() for name, provider in self.__providers.items()}
+            return write_checkpoint(self.path, sections)
+
+    def start(self, interval=10):
+        """
+        Writes a checkpoint every [interval] seconds in a daemon thread until stop() is called.
+        """
+
+        def run():
+            while not self.__stop.wait(interval):
+                try:
+                    self.write()
+                except Exception as e:
+                    LOGGER.exception(f"Writing the checkpoint failed: {e}")
+
+        self.__stop.clear()
+        self.__thread = threading.Thread(target=run, name="CheckpointWriter", daemon=True)
+        self.__thread.start()
+
+    def stop(self, final_write=True):
+        self.__stop.set()
+        if self.__thread:
+            self.__thread.join()
+        if final_write:
+            self.write()
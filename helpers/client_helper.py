@@ -0,0 +1,58 @@
+"""
+Powerbot client helpers
+(c) 2020 PowerBot GmbH
+
+The ApiClient shared by the algorithms, which combines the client side features of the other helpers.
+"""
+
+from swagger_client import Configuration
+from helpers.coalescing_helper import CoalescingApiClient
+from helpers.delivery_period_helper import DeliveryPeriodApiClient
+from helpers.instrumentation_helper import InstrumentedApiClient
+from helpers.metadata_cache_helper import ObservableApiClient
+from helpers.rate_limit_helper import RateLimitedApiClient
+
+
+class PowerBotApiClient(CoalescingApiClient, RateLimitedApiClient, InstrumentedApiClient, DeliveryPeriodApiClient,
+                       ObservableApiClient):
+    """
+    ApiClient with coalescing of identical read requests, client side rate limiting, latency metrics, cached parsing
+    of the delivery timestamps and notifications about changes (see metadata_cache_helper).
+    The metrics are recorded per attempt, i.e. a request which was throttled and retried shows up twice, while requests
+    that were served by a coalesced call do not show up at all.
+    """
+
+
+def create_client(api_key, host, connection_pool_maxsize=None, **kwargs):
+    """
+    Helper function to create the shared PowerBotApiClient.
+
+    :param api_key: API Key for PowerBot
+    :param host: Host URL for PowerBot
+    :param connection_pool_maxsize: Number of connections kept open per host (defaults to the swagger default).
+    :param kwargs: Further arguments of the client, e.g. cache_ttl, limiter or metrics.
+    :return: PowerBotApiClient
+    """
+
+    config = Configuration()
+    config.api_key["api_key"] = api_key
+    config.host = host
+    if connection_pool_maxsize:
+        config.connection_pool_maxsize = connection_pool_maxsize
+    return PowerBotApiClient(config, **kwargs)
+
+
+def get_exchange(host, default="epex"):
+    """
+    Helper function to determine the exchange from the PowerBot host URL, e.g. "epex" for
+    https://staging.powerbot-trading.com/company_name/epex/v2/api. The exchange is part of the websocket topics.
+
+    :param host: Host URL for PowerBot
+    :param default: Exchange returned if the URL does not have the expected format.
+    :return: The exchange in lower case.
+    """
+
+    parts = host.rstrip("/").split("/")
+    if len(parts) >= 6 and parts[-1] == "api" and parts[-2].startswith("v"):
+        return parts[-3].lower()
+    return default
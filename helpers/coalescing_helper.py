@@ -0,0 +1,131 @@
+"""
+Powerbot request coalescing helpers
+(c) 2020 PowerBot GmbH
+
+Single-flight layer for read requests: identical requests which are in flight at the same time (e.g. several strategies
+fetching the same order book on the quarter hour) share one HTTP call and one deserialized result. Optionally, results
+are cached for a very short time.
+
+The shared result objects are returned to every caller, they must be treated as read-only.
+"""
+
+import threading
+import time
+from swagger_client import ApiClient
+
+
+class _Call:
+    __slots__ = ("event", "result", "exception")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.exception = None
+
+
+class SingleFlight:
+    """
+    Executes a function at most once per key at the same time, concurrent callers with the same key wait for the result.
+    """
+
+    # Expired cache entries are removed as soon as the cache reaches this size.
+    MAX_CACHE_SIZE = 1024
+
+    def __init__(self, ttl=0):
+        """
+        :param ttl: Time in seconds the result of a call is reused for subsequent calls with the same key (0 disables the cache).
+        """
+
+        self.ttl = ttl
+        self.__lock = threading.Lock()
+        self.__in_flight = {}
+        self.__cache = {}
+        self.calls = 0
+        self.shared = 0
+        self.cached = 0
+
+    def do(self, key, function):
+        """
+        :param key: Hashable key identifying identical calls.
+        :param function: Function without arguments, which is executed if there is no call in flight for the key.
+        :return: The result of the function (shared by all callers with the same key).
+        """
+
+        with self.__lock:
+            if self.ttl:
+                entry = self.__cache.get(key)
+                if entry and entry[0] > time.monotonic():
+                    self.cached += 1
+                    return entry[1]
+
+            call = self.__in_flight.get(key)
+            leader = call is None
+            if leader:
+                call = self.__in_flight[key] = _Call()
+                self.calls += 1
+            else:
+                self.shared += 1
+
+        if not leader:
+            call.event.wait()
+            if call.exception is not None:
+                raise call.exception
+            return call.result
+
+        try:
+            call.result = function()
+            if self.ttl:
+                with self.__lock:
+                    now = time.monotonic()
+                    if len(self.__cache) >= self.MAX_CACHE_SIZE:
+                        self.__cache = {k: entry for k, entry in self.__cache.items() if entry[0] > now}
+                    self.__cache[key] = (now + self.ttl, call.result)
+            return call.result
+        except BaseException as exception:
+            call.exception = exception
+            raise
+        finally:
+            with self.__lock:
+                del self.__in_flight[key]
+            call.event.set()
+
+    def clear(self):
+        with self.__lock:
+            self.__cache.clear()
+
+
+def _freeze(value):
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+class CoalescingApiClient(ApiClient):
+    """
+    ApiClient which coalesces identical GET requests (same resource path, parameters and response type).
+    It should be the outermost client class, so coalesced calls neither consume rate limiter tokens nor show up as requests
+    in the metrics.
+    """
+
+    def __init__(self, configuration=None, cache_ttl=0, coalesced_paths=None, **kwargs):
+        """
+        :param cache_ttl: Time in seconds results are reused after the request has finished (0 only shares in-flight requests).
+        :param coalesced_paths: Optional list of resource path prefixes; if set only GET requests to these paths are coalesced.
+        """
+
+        super().__init__(configuration, **kwargs)
+        self.coalesced_paths = tuple(coalesced_paths) if coalesced_paths else None
+        self.single_flight = SingleFlight(ttl=cache_ttl)
+
+    def _ApiClient__call_api(self, resource_path, method, path_params=None, query_params=None, header_params=None, body=None, *args, **kwargs):
+        call = super()._ApiClient__call_api
+        # Raw responses (_preload_content=False) can only be read once and are never shared.
+        preload_content = args[6] if len(args) > 6 else kwargs.get("_preload_content", True)
+        if method != "GET" or preload_content is False or (self.coalesced_paths and not resource_path.startswith(self.coalesced_paths)):
+            return call(resource_path, method, path_params, query_params, header_params, body, *args, **kwargs)
+
+        # The positional arguments hold the response type and the flags that define the shape of the result.
+        key = (resource_path, _freeze(path_params), _freeze(query_params), _freeze(args), _freeze(kwargs))
+        return self.single_flight.do(key, lambda: call(resource_path, method, path_params, query_params, header_params, body, *args, **kwargs))
@@ -0,0 +1,199 @@
+"""
+Powerbot conflating queue helpers
+(c) 2020 PowerBot GmbH
+
+Drop-in replacement for the queue.Queue passed as data_queue to the PowerBotWebSocket. Pending messages are kept per key
+(by default contract and delivery area) and a newer message replaces (or is merged into) the pending message of the same
+key, so a slow consumer always works on the freshest order book state instead of all intermediate states. Keys are
+served first in, first out, and the number of pending items is bounded. If the queue is full, the oldest pending order
+book state is dropped and its key is recorded, so the consumer can request the order book of these contracts again:
+
+    for destination, contract_id, delivery_area in queue.take_dropped_keys():
+        ...
+
+Items that can never be conflated (e.g. own order and trade events) are never dropped. If the queue is full and contains
+only such items, put blocks (or raises queue.Full) like queue.Queue.
+
+    queue = ConflatingQueue(maxsize=10000)
+    websocket = PowerBotWebSocket(api_key=api_key, base_url=host_url, subscriptions=subscriptions, data_queue=queue)
+"""
+
+import heapq
+import threading
+import time
+from collections import OrderedDict, deque
+from itertools import count
+from queue import Empty, Full
+from helpers.event_helper import get_field, parse_message
+
+
+# Only order book states can be conflated, own order and trade events must all be processed.
+CONFLATED_TOPICS = ("orderbookchangedevent",)
+
+
+def contract_key(message):
+    """
+    Default key function: the destination, contract and delivery area of the event(s) in an order book changed frame.
+
+    :return: The key or None, if the frame is no order book event or contains events of several contracts (such frames
+             are never conflated).
+    """
+
+    headers = message.get("headers", {}) if isinstance(message, dict) else {}
+    destination = headers.get("destination") or headers.get("subscription") or ""
+    if not any(topic in destination for topic in CONFLATED_TOPICS):
+        return None
+    try:
+        events = parse_message(message)
+    except ValueError:
+        return None
+    keys = {(get_field(event, "contract_id"), get_field(event, "delivery_area")) for event in events}
+    if len(keys) != 1 or None in next(iter(keys)):
+        return None
+    return (destination,) + keys.pop()
+
+
+class ConflatingQueue:
+    """
+    Thread-safe queue with the interface of queue.Queue (put, get, qsize, empty and their _nowait variants).
+    """
+
+    def __init__(self, maxsize=0, key_func=contract_key, merge=None, drop_oldest=True):
+        """
+        :param maxsize: Maximum number of pending items (0 means unbounded).
+        :param key_func: Function key_func(item) returning the conflation key of an item; items with the key None are
+                         never conflated.
+        :param merge: Optional function merge(pending, new) returning the item that replaces the pending item of the same
+                      key, e.g. to merge order book deltas. By default the new item simply replaces the pending one.
+        :param drop_oldest: If the queue is full, drop the oldest pending item that could have been conflated instead of
+                            blocking the producer (the websocket thread should not block). Its key is recorded, see
+                            take_dropped_keys. Without such an item, put blocks or raises Full.
+        """
+
+        self.maxsize = maxsize
+        self.key_func = key_func
+        self.merge = merge
+        self.drop_oldest = drop_oldest
+        self.__lock = threading.Lock()
+        self.__not_empty = threading.Condition(self.__lock)
+        self.__not_full = threading.Condition(self.__lock)
+        # Items that can be conflated {key: (sequence number, item)} and items that are never conflated
+        # deque((sequence number, item)), both ordered by the arrival of their first pending item. The sequence numbers
+        # restore the overall arrival order, and the oldest conflatable item can be dropped without a scan.
+        self.__conflatable = OrderedDict()
+        self.__unique = deque()
+        self.__sequence = count()
+        # Keys whose pending item has been dropped since the last take_dropped_keys.
+        self.__dropped_keys = set()
+
+        self.puts = 0
+        self.gets = 0
+        self.conflated = 0
+        self.merged = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self.__conflatable) + len(self.__unique)
+
+    def put(self, item, block=True, timeout=None):
+        key = self.key_func(item)
+
+        with self.__not_full:
+            self.puts += 1
+            if key is not None:
+                pending = self.__conflatable.get(key)
+                if pending is not None:
+                    # The key keeps its place in the queue, only the item is replaced.
+                    if self.merge:
+                        self.__conflatable[key] = (pending[0], self.merge(pending[1], item))
+                        self.merged += 1
+                    else:
+                        self.__conflatable[key] = (pending[0], item)
+                        self.conflated += 1
+                    return
+
+            if self.maxsize > 0 and len(self) >= self.maxsize:
+                if self.drop_oldest and self.__conflatable:
+                    # Only items that can be conflated are dropped, a newer state of their key can be requested again.
+                    dropped_key, _ = self.__conflatable.popitem(last=False)
+                    self.__dropped_keys.add(dropped_key)
+                    self.dropped += 1
+                elif not block:
+                    raise Full
+                else:
+                    deadline = None if timeout is None else time.monotonic() + timeout
+                    while len(self) >= self.maxsize:
+                        remaining = None if deadline is None else deadline - time.monotonic()
+                        if remaining is not None and remaining <= 0:
+                            raise Full
+                        self.__not_full.wait(remaining)
+
+            if key is None:
+                self.__unique.append((next(self.__sequence), item))
+            else:
+                self.__conflatable[key] = (next(self.__sequence), item)
+            self.__not_empty.notify()
+
+    def put_nowait(self, item):
+        return self.put(item, block=False)
+
+    def get(self, block=True, timeout=None):
+        with self.__not_empty:
+            if not block:
+                if not len(self):
+                    raise Empty
+            else:
+                deadline = None if timeout is None else time.monotonic() + timeout
+                while not len(self):
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        raise Empty
+                    self.__not_empty.wait(remaining)
+
+            # The older of both heads.
+            if self.__unique and (not self.__conflatable or self.__unique[0][0] < next(iter(self.__conflatable.values()))[0]):
+                _, item = self.__unique.popleft()
+            else:
+                _, (_, item) = self.__conflatable.popitem(last=False)
+            self.gets += 1
+            self.__not_full.notify()
+            return item
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def drain(self):
+        """
+        :return: All pending items (oldest first), without waiting.
+        """
+
+        with self.__lock:
+            items = [item for _, item in heapq.merge(self.__unique, self.__conflatable.values(), key=lambda entry: entry[0])]
+            self.__unique.clear()
+            self.__conflatable.clear()
+            self.gets += len(items)
+            self.__not_full.notify_all()
+            return items
+
+    def take_dropped_keys(self):
+        """
+        :return: Set of the keys whose pending item has been dropped since the previous call.
+        """
+
+        with self.__lock:
+            dropped_keys, self.__dropped_keys = self.__dropped_keys, set()
+            return dropped_keys
+
+    def qsize(self):
+        return len(self)
+
+    def empty(self):
+        return not len(self)
+
+    def full(self):
+        return 0 < self.maxsize <= len(self)
+
+    @property
+    def stats(self):
+        return {"puts": self.puts, "gets": self.gets, "conflated": self.conflated, "merged": self.merged,
+                "dropped": self.dropped, "dropped_keys": len(self.__dropped_keys), "pending": len(self)}
@@ -0,0 +1,181 @@
+"""
+Powerbot contract catalogue helpers
+(c) 2020 PowerBot GmbH
+
+In-memory catalogue of the contracts, loaded once with find_contracts (or from an order book) and kept current from
+contract events. Contracts can be looked up by contract id, by (delivery area, product, delivery start) and by delivery
+interval, e.g. to map a signal to its contract or an hour to its quarter hours without scanning order_book.contracts.
+"""
+
+import threading
+from bisect import bisect_left, bisect_right, insort
+from helpers.event_helper import get_field, get_timestamp
+
+
+def get_delivery_areas(contract):
+    """
+    Helper function to retrieve the delivery areas of a contract (a list in the contract models, a single area in events).
+    """
+
+    delivery_areas = get_field(contract, "delivery_areas")
+    if delivery_areas:
+        return list(delivery_areas)
+    delivery_area = get_field(contract, "delivery_area")
+    return [delivery_area] if delivery_area else []
+
+
+class ContractCatalogue:
+    """
+    Contracts indexed by contract id, by (delivery area, product, delivery start) and by delivery interval.
+    Delivery times can be passed as datetime, ISO 8601 string or seconds since the epoch.
+    """
+
+    def __init__(self):
+        self.__lock = threading.RLock()
+        # {contract_id: contract}
+        self.__contracts = {}
+        # {(delivery_area, product, delivery_start): contract_id}
+        self.__by_period = {}
+        # Sorted list of (delivery_start, delivery_end, contract_id)
+        self.__intervals = []
+        # {contract_id: delivery areas the contract is indexed for}
+        self.__areas = {}
+        # Longest delivery period in the catalogue, limits the range of the interval search.
+        self.__max_duration = 0.0
+
+    def __len__(self):
+        return len(self.__contracts)
+
+    def load(self, contract_api, delivery_start, delivery_end):
+        """
+        Adds all contracts delivered within the given period with a single find_contracts request.
+
+        :return: Number of contracts added or updated.
+        """
+
+        contracts = contract_api.find_contracts(delivery_start=delivery_start, delivery_end=delivery_end)
+        for contract in contracts:
+            self.on_contract(contract)
+        return len(contracts)
+
+    def add_order_book(self, order_book, delivery_area=None):
+        """
+        Adds the contracts of an order book (get_order_books).
+
+        :param delivery_area: The delivery area of the order book, if the contracts do not list their delivery areas.
+        """
+
+        for contract in order_book.contracts:
+            self.on_contract(contract, delivery_area)
+
+    def on_contract(self, contract, delivery_area=None):
+        """
+        Adds or updates a contract (REST model or websocket contract event).
+        """
+
+        contract_id = get_field(contract, "contract_id")
+        start = get_timestamp(get_field(contract, "delivery_start"))
+        end = get_timestamp(get_field(contract, "delivery_end"))
+        delivery_areas = get_delivery_areas(contract)
+        if delivery_area and delivery_area not in delivery_areas:
+            delivery_areas.append(delivery_area)
+
+        with self.__lock:
+            previous = self.__contracts.get(contract_id)
+            if previous is not None:
+                # Contract events might not list all areas the contract has been loaded for.
+                delivery_areas = list(dict.fromkeys(self.__areas.get(contract_id, []) + delivery_areas))
+                self.__remove(contract_id, previous)
+
+            self.__contracts[contract_id] = contract
+            for area in delivery_areas:
+                self.__by_period[(area, get_field(contract, "product"), start)] = contract_id
+            insort(self.__intervals, (start, end, contract_id))
+            self.__max_duration = max(self.__max_duration, end - start)
+            self.__areas[contract_id] = delivery_areas
+
+    def __remove(self, contract_id, contract):
+        start = get_timestamp(get_field(contract, "delivery_start"))
+        end = get_timestamp(get_field(contract, "delivery_end"))
+        for area in self.__areas.get(contract_id, []):
+            key = (area, get_field(contract, "product"), start)
+            if self.__by_period.get(key) == contract_id:
+                del self.__by_period[key]
+        position = bisect_left(self.__intervals, (start, end, contract_id))
+        if position < len(self.__intervals) and self.__intervals[position] == (start, end, contract_id):
+            del self.__intervals[position]
+
+    def remove(self, contract_id):
+        """
+        Removes a contract, e.g. after its delivery.
+        """
+
+        with self.__lock:
+            contract = self.__contracts.pop(contract_id, None)
+            if contract is not None:
+                self.__remove(contract_id, contract)
+                del self.__areas[contract_id]
+
+    def remove_delivered(self, now):
+        """
+        Removes all contracts whose delivery has ended before [now].
+
+        :return: Number of removed contracts.
+        """
+
+        now = get_timestamp(now)
+        with self.__lock:
+            delivered = [contract_id for _, end, contract_id in self.__intervals if end <= now]
+            for contract_id in delivered:
+                self.remove(contract_id)
+        return len(delivered)
+
+    def get(self, contract_id):
+        return self.__contracts.get(contract_id)
+
+    def find(self, delivery_area, product, delivery_start):
+        """
+        :return: The contract of the product with the given delivery start in the delivery area or None.
+        """
+
+        contract_id = self.__by_period.get((delivery_area, product, get_timestamp(delivery_start)))
+        return self.__contracts.get(contract_id) if contract_id is not None else None
+
+    def overlapping(self, delivery_start, delivery_end, delivery_area=None, product=None):
+        """
+        :return: List of contracts whose delivery period overlaps the given period, sorted by delivery start.
+        """
+
+        start = get_timestamp(delivery_start)
+        end = get_timestamp(delivery_end)
+        with self.__lock:
+            # Only contracts starting after [start - longest delivery period] can still be delivered at [start].
+            first = bisect_right(self.__intervals, (start - self.__max_duration,))
+            last = bisect_left(self.__intervals, (end,))
+            contract_ids = [contract_id for _, contract_end, contract_id in self.__intervals[first:last] if contract_end > start]
+            return [self.__contracts[contract_id] for contract_id in contract_ids
+                    if (delivery_area is None or delivery_area in self.__areas[contract_id])
+                    and (product is None or get_field(self.__contracts[contract_id], "product") == product)]
+
+    def within(self, delivery_start, delivery_end, delivery_area=None, product=None):
+        """
+        :return: List of contracts delivered completely within the given period, e.g. the quarter hours of an hour.
+        """
+
+        start = get_timestamp(delivery_start)
+        end = get_timestamp(delivery_end)
+        return [contract for contract in self.overlapping(start, end, delivery_area, product)
+                if get_timestamp(get_field(contract, "delivery_start")) >= start
+                and get_timestamp(get_field(contract, "delivery_end")) <= end]
+
+    def for_signal(self, signal, delivery_area, product=None):
+        """
+        :param signal: BulkSignal or contract signal with delivery_start and delivery_end.
+        :return: List of contracts in the delivery area with exactly the delivery period of the signal.
+        """
+
+        start = get_timestamp(get_field(signal, "delivery_start"))
+        end = get_timestamp(get_field(signal, "delivery_end"))
+        return [contract for contract in self.overlapping(start, end, delivery_area, product)
+                if get_timestamp(get_field(contract, "delivery_start")) == start
+                and get_timestamp(get_field(contract, "delivery_end")) == end]
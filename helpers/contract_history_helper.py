@@ -0,0 +1,330 @@
+"""
+Powerbot contract history helpers
+(c) 2020 PowerBot GmbH
+
+Local, memory-mapped store of the revision history of contracts. get_contract_history always returns the full history of
+a contract (it cannot be filtered by revision or time), the store reads the raw response without deserializing it into
+swagger models, only appends the revisions newer than the last stored one and keeps a checkpoint of the full book state
+every [checkpoint_interval] revisions. The book state at any point in time is rebuilt from the closest checkpoint plus the
+following deltas, without any request to the server.
+
+The layout of a revision is taken as returned by the api (serialized to JSON). By default a revision is treated as a
+delta of the order book: the orders listed under "bids" and "asks" replace the orders with the same order_id and orders
+with a quantity of 0 are removed. A different interpretation can be passed as [apply] function.
+"""
+
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+from bisect import bisect_left, bisect_right
+from helpers.event_helper import get_timestamp
+
+# Index record per revision: revision number, timestamp (seconds since the epoch), offset of the revision and offset of
+# the checkpoint after this revision (-1 if there is none) in the data file.
+INDEX_RECORD = struct.Struct("<qdqq")
+# Every entry of the data file is prefixed with its length.
+LENGTH_PREFIX = struct.Struct("<I")
+
+BOOK_SIDES = ("bids", "asks")
+
+LOGGER = logging.getLogger("ContractHistory")
+
+
+def apply_revision(state, revision):
+    """
+    Default delta function: updates the book state {side: {order_id: order}} with the orders of a revision.
+
+    :param state: Book state, modified in place.
+    :param revision: The revision as dictionary.
+    :return: The updated state.
+    """
+
+    for side in BOOK_SIDES:
+        orders = state.setdefault(side, {})
+        for order in revision.get(side) or []:
+            order_id = str(order.get("order_id"))
+            if order.get("quantity"):
+                orders[order_id] = order
+            else:
+                orders.pop(order_id, None)
+    state["revision_no"] = revision.get("revision_no")
+    return state
+
+
+class _TimestampColumn:
+    """
+    Read-only sequence view of the timestamps in the index, used for the binary search.
+    """
+
+    def __init__(self, index, length):
+        self.index = index
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, position):
+        return INDEX_RECORD.unpack_from(self.index, position * INDEX_RECORD.size)[1]
+
+
+class ContractHistoryStore:
+    """
+    Revision history of a single contract in a delivery area, stored in [directory] as <area>_<contract_id>.dat (revisions
+    and checkpoints) and <area>_<contract_id>.idx (fixed size index records).
+    """
+
+    def __init__(self, directory, contract_id, delivery_area, checkpoint_interval=100, timestamp_field="timestamp",
+                 apply=apply_revision):
+        """
+        :param directory: Directory of the history files.
+        :param contract_id: ID of the contract.
+        :param delivery_area: EIC of the delivery area.
+        :param checkpoint_interval: Number of revisions between two checkpoints.
+        :param timestamp_field: Field of a revision holding its timestamp.
+        :param apply: Function apply(state, revision) returning the state after the revision.
+        """
+
+        self.contract_id = contract_id
+        self.delivery_area = delivery_area
+        self.checkpoint_interval = checkpoint_interval
+        self.timestamp_field = timestamp_field
+        self.apply = apply
+
+        os.makedirs(directory, exist_ok=True)
+        base = os.path.join(directory, f"{delivery_area}_{contract_id}")
+        self.__data_path = f"{base}.dat"
+        self.__index_path = f"{base}.idx"
+        self.__lock = threading.RLock()
+        self.__data_map = None
+        self.__index_map = None
+        # The book state after the last revision, required to write the next checkpoint.
+        self.__state = None
+
+        self.__repair()
+        self.__data_file = open(self.__data_path, "ab")
+        self.__index_file = open(self.__index_path, "ab")
+        self.__remap()
+
+    def __repair(self):
+        # A crash between writing the data and the index leaves trailing bytes without index record, they are dropped.
+        # Index records referring to data that has not been written completely are dropped as well.
+        open(self.__data_path, "ab").close()
+        open(self.__index_path, "ab").close()
+        index_size = os.path.getsize(self.__index_path)
+        data_size = os.path.getsize(self.__data_path)
+        records = index_size // INDEX_RECORD.size
+        data_end = 0
+        with open(self.__index_path, "rb") as index_file, open(self.__data_path, "rb") as data_file:
+            while records:
+                index_file.seek((records - 1) * INDEX_RECORD.size)
+                _, _, offset, checkpoint_offset = INDEX_RECORD.unpack(index_file.read(INDEX_RECORD.size))
+                last = max(offset, checkpoint_offset)
+                if last + LENGTH_PREFIX.size <= data_size:
+                    data_file.seek(last)
+                    length, = LENGTH_PREFIX.unpack(data_file.read(LENGTH_PREFIX.size))
+                    if last + LENGTH_PREFIX.size + length <= data_size:
+                        data_end = last + LENGTH_PREFIX.size + length
+                        break
+                records -= 1
+        valid_size = records * INDEX_RECORD.size
+        if valid_size != index_size:
+            if index_size - valid_size >= INDEX_RECORD.size:
+                LOGGER.warning(f"Dropping {(index_size - valid_size) // INDEX_RECORD.size} index records of "
+                               f"{self.delivery_area}_{self.contract_id} without complete data.")
+            os.truncate(self.__index_path, valid_size)
+        if data_size != data_end:
+            LOGGER.warning(f"Dropping incomplete revisions of {self.delivery_area}_{self.contract_id}.")
+            os.truncate(self.__data_path, data_end)
+
+    def __remap(self):
+        for memory_map in (self.__data_map, self.__index_map):
+            if memory_map is not None:
+                memory_map.close()
+        # Empty files cannot be mapped.
+        self.__data_map = self.__map(self.__data_path)
+        self.__index_map = self.__map(self.__index_path)
+
+    @staticmethod
+    def __map(path):
+        if not os.path.getsize(path):
+            return None
+        with open(path, "rb") as file:
+            return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return len(self.__index_map) // INDEX_RECORD.size if self.__index_map is not None else 0
+
+    def __record(self, position):
+        return INDEX_RECORD.unpack_from(self.__index_map, position * INDEX_RECORD.size)
+
+    def __read(self, offset):
+        length, = LENGTH_PREFIX.unpack_from(self.__data_map, offset)
+        start = offset + LENGTH_PREFIX.size
+        return json.loads(self.__data_map[start:start + length])
+
+    def __write(self, value):
+        payload = json.dumps(value, separators=(",", ":")).encode()
+        offset = self.__data_file.tell()
+        self.__data_file.write(LENGTH_PREFIX.pack(len(payload)))
+        self.__data_file.write(payload)
+        return offset
+
+    @property
+    def last_revision_no(self):
+        """
+        :return: Revision number of the newest stored revision or None, if the store is empty.
+        """
+        return self.__record(len(self) - 1)[0] if len(self) else None
+
+    def update(self, contract_api):
+        """
+        Fetches the history with get_contract_history and appends the new revisions. The api always returns the full
+        history, so the raw response is parsed as JSON instead of being deserialized into swagger models, which would be
+        thrown away for all revisions that are already stored.
+
+        :param contract_api: ContractApi object.
+        :return: Number of appended revisions.
+        """
+
+        response = contract_api.get_contract_history(contract_id=self.contract_id, delivery_area=self.delivery_area,
+                                                     _preload_content=False)
+        return self.append(json.loads(response.data) or [])
+
+    def append(self, revisions):
+        """
+        Appends the revisions newer than the last stored revision.
+
+        :param revisions: Revisions as dictionaries (in any order).
+        :return: Number of appended revisions.
+        """
+
+        with self.__lock:
+            last_revision_no = self.last_revision_no
+            new_revisions = sorted((r for r in revisions if last_revision_no is None or r["revision_no"] > last_revision_no),
+                                   key=lambda r: r["revision_no"])
+            if not new_revisions:
+                return 0
+
+            position = len(self)
+            state = self.__state
+            if state is None:
+                state = self.__rebuild(position - 1) if position else {}
+
+            for revision in new_revisions:
+                state = self.apply(state, revision)
+                offset = self.__write(revision)
+                checkpoint_offset = -1
+                if (position + 1) % self.checkpoint_interval == 0:
+                    checkpoint_offset = self.__write(state)
+                self.__index_file.write(INDEX_RECORD.pack(revision["revision_no"],
+                                                          get_timestamp(revision.get(self.timestamp_field)),
+                                                          offset, checkpoint_offset))
+                position += 1
+
+            # The data has to be on disk before the index refers to it.
+            self.__data_file.flush()
+            os.fsync(self.__data_file.fileno())
+            self.__index_file.flush()
+            self.__state = state
+            self.__remap()
+            return len(new_revisions)
+
+    def position_at(self, timestamp):
+        """
+        :param timestamp: datetime, ISO 8601 string or seconds since the epoch.
+        :return: Position of the last revision at or before the timestamp, -1 if there is none.
+        """
+
+        with self.__lock:
+            return bisect_right(_TimestampColumn(self.__index_map, len(self)), get_timestamp(timestamp)) - 1
+
+    def revision_at(self, timestamp):
+        """
+        :return: The last revision at or before the timestamp or None.
+        """
+
+        with self.__lock:
+            position = self.position_at(timestamp)
+            return self.__read(self.__record(position)[2]) if position >= 0 else None
+
+    def book_at(self, timestamp):
+        """
+        Rebuilds the book state at a point in time from the closest checkpoint and the following revisions.
+
+        :param timestamp: datetime, ISO 8601 string or seconds since the epoch.
+        :return: The book state or None, if the contract had no revision at that time.
+        """
+
+        with self.__lock:
+            position = self.position_at(timestamp)
+            return self.__rebuild(position) if position >= 0 else None
+
+    def __rebuild(self, position):
+        start = position
+        while start >= 0 and self.__record(start)[3] < 0:
+            start -= 1
+        state = self.__read(self.__record(start)[3]) if start >= 0 else {}
+        for current in range(start + 1, position + 1):
+            state = self.apply(state, self.__read(self.__record(current)[2]))
+        return state
+
+    def revisions(self, start=None, end=None):
+        """
+        :param start: Optional timestamp of the first revision.
+        :param end: Optional timestamp of the last revision.
+        :return: List of the stored revisions within the time range.
+        """
+
+        with self.__lock:
+            first = bisect_left(_TimestampColumn(self.__index_map, len(self)), get_timestamp(start)) if start is not None else 0
+            last = self.position_at(end) if end is not None else len(self) - 1
+            return [self.__read(self.__record(position)[2]) for position in range(first, last + 1)]
+
+    def close(self):
+        with self.__lock:
+            self.__data_file.close()
+            self.__index_file.close()
+            for memory_map in (self.__data_map, self.__index_map):
+                if memory_map is not None:
+                    memory_map.close()
+            self.__data_map = self.__index_map = None
+
+
+class ContractHistoryCache:
+    """
+    ContractHistoryStore objects per (contract_id, delivery_area) in a common directory.
+    """
+
+    def __init__(self, directory, **kwargs):
+        """
+        :param directory: Directory of the history files.
+        :param kwargs: Arguments passed to every ContractHistoryStore.
+        """
+
+        self.directory = directory
+        self.kwargs = kwargs
+        self.__lock = threading.Lock()
+        self.__stores = {}
+
+    def store(self, contract_id, delivery_area):
+        with self.__lock:
+            store = self.__stores.get((contract_id, delivery_area))
+            if store is None:
+                store = self.__stores[(contract_id, delivery_area)] = ContractHistoryStore(self.directory, contract_id,
+                                                                                           delivery_area, **self.kwargs)
+            return store
+
+    def update(self, contract_api, contract_id, delivery_area):
+        return self.store(contract_id, delivery_area).update(contract_api)
+
+    def book_at(self, contract_id, delivery_area, timestamp):
+        return self.store(contract_id, delivery_area).book_at(timestamp)
+
+    def close(self):
+        with self.__lock:
+            for store in self.__stores.values():
+                store.close()
+            self.__stores.clear()
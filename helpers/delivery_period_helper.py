@@ -0,0 +1,153 @@
+"""
+Powerbot delivery period helpers
+(c) 2020 PowerBot GmbH
+
+Parsing and formatting of delivery timestamps. A trading day only knows a few hundred distinct delivery starts and ends
+(quarter hours, half hours and hours of today and tomorrow), so they are parsed and formatted once and then served from a
+cache. Strategies can compare delivery periods and do their arithmetic on integer minutes since the epoch:
+
+    minutes_to_delivery_start = to_minutes(contract.delivery_start) - time.time() / 60
+
+current_minute() is the current time with the seconds cut off, so it must not be used for the time remaining until a
+delivery start (it would be up to a minute too long).
+
+The DeliveryPeriodApiClient deserializes the datetime fields of the swagger models with the same cache.
+"""
+
+import re
+import time
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from dateutil import parser
+from swagger_client import ApiClient
+from swagger_client.rest import ApiException
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+MINUTE = timedelta(minutes=1)
+MINUTES_PER_DAY = 1440
+
+# Format of the delivery timestamps sent to PowerBot, e.g. in the signals.
+TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+# Only timestamps on a full minute (delivery periods) are cached, the millisecond timestamps of orders and trades are
+# unique and would just evict them.
+_ON_THE_MINUTE = re.compile(r"^\d{4}-\d\d-\d\d[T ]\d\d:\d\d(:00(\.0+)?)?(Z|[+-]00:?00)?$")
+
+CACHE_SIZE = 4096
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _parse_cached(value):
+    return _parse(value)
+
+
+def _parse(value):
+    try:
+        return parser.isoparse(value)
+    except ValueError:
+        return parser.parse(value)
+
+
+def parse_datetime(value):
+    """
+    Helper function to parse an ISO 8601 timestamp. Timestamps on a full minute are cached, i.e. the same string always
+    returns the same datetime object (datetime objects are immutable, they can be shared).
+
+    :param value: ISO 8601 string.
+    :return: datetime
+    :raises ValueError: If the string is no valid timestamp.
+    """
+
+    if _ON_THE_MINUTE.match(value):
+        return _parse_cached(value)
+    return _parse(value)
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _string_to_minutes(value):
+    return to_minutes(_parse(value))
+
+
+def to_minutes(value):
+    """
+    Helper function to convert a delivery timestamp to minutes since the epoch.
+
+    :param value: datetime (naive datetimes are UTC), ISO 8601 string or number of seconds since the epoch.
+    :return: Minutes since the epoch as int (seconds are cut off).
+    """
+
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        return (value - EPOCH) // MINUTE
+    if isinstance(value, str):
+        return _string_to_minutes(value)
+    return int(value // 60)
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def from_minutes(minutes):
+    """
+    :param minutes: Minutes since the epoch.
+    :return: UTC datetime (cached).
+    """
+
+    return EPOCH + timedelta(minutes=minutes)
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def format_minutes(minutes):
+    """
+    :param minutes: Minutes since the epoch.
+    :return: The timestamp as string in the TIMESTAMP_FORMAT (cached).
+    """
+
+    return from_minutes(minutes).strftime(TIMESTAMP_FORMAT)
+
+
+def format_timestamp(value):
+    """
+    Helper function to format a delivery timestamp in the TIMESTAMP_FORMAT.
+
+    :param value: Minutes since the epoch (int), datetime or ISO 8601 string.
+    :return: The timestamp as string.
+    """
+
+    return format_minutes(value if isinstance(value, int) else to_minutes(value))
+
+
+def current_minute():
+    """
+    :return: The current time in minutes since the epoch.
+    """
+
+    return int(time.time() // 60)
+
+
+def start_of_day(minutes=None):
+    """
+    :param minutes: Minutes since the epoch (defaults to the current minute).
+    :return: Minutes since the epoch of the UTC midnight before [minutes].
+    """
+
+    minutes = current_minute() if minutes is None else minutes
+    return minutes - minutes % MINUTES_PER_DAY
+
+
+class DeliveryPeriodApiClient(ApiClient):
+    """
+    ApiClient which deserializes the datetime and date fields of the swagger models with the cached parser instead of
+    parsing every delivery_start and delivery_end of an order book again.
+    """
+
+    def _ApiClient__deserialize_datatime(self, string):
+        try:
+            return parse_datetime(string)
+        except (ValueError, OverflowError):
+            raise ApiException(status=0, reason=f"Failed to parse `{string}` as datetime object")
+
+    def _ApiClient__deserialize_date(self, string):
+        try:
+            return parse_datetime(string).date()
+        except (ValueError, OverflowError):
+            raise ApiException(status=0, reason=f"Failed to parse `{string}` as date object")
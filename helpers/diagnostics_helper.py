@@ -0,0 +1,366 @@
+"""
+Powerbot diagnostics helpers
+(c) 2020 PowerBot GmbH
+
+Diagnostics of a running algorithm, switched on and off at runtime without a restart:
+
+* a sampling profiler, which records the stacks of the running threads (algorithm cycle, websocket, workers) at a fixed
+  interval and writes them in the folded format of flamegraph.pl and speedscope
+* an allocation tracker, which takes a tracemalloc snapshot after every algorithm cycle and logs the code locations
+  whose memory grew since the previous cycle (e.g. growing queues or caches)
+
+    diagnostics = Diagnostics(output_dir="diagnostics")
+    diagnostics.install_signal_handler()        # kill -USR2 <pid> toggles the diagnostics
+    diagnostics.start_http_server(port=9101)    # curl -X POST "http://127.0.0.1:9101/diagnostics/start?duration=60"
+
+    with diagnostics.cycle():
+        algorithm()
+
+Both tools only cost anything while they are enabled. tracemalloc slows down every allocation noticeably, so the
+diagnostics should be switched off again once enough cycles have been recorded.
+"""
+
+import json
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import urlparse, parse_qs
+
+LOGGER = logging.getLogger("Diagnostics")
+
+
+class SamplingProfiler:
+    """
+    Wall clock sampling profiler over all threads of the process (or the threads with the given names).
+    """
+
+    def __init__(self, interval=0.01, threads=None):
+        """
+        :param interval: Time between two samples in seconds.
+        :param threads: Optional names of the threads to sample. Threads that have not been started with the threading
+                        module (e.g. the websocket thread) are called "thread-<ident>".
+        """
+
+        self.interval = interval
+        self.threads = set(threads) if threads else None
+        self.samples = 0
+        self.__stacks = Counter()
+        # {code object: frame label}, the labels are only formatted once per function.
+        self.__labels = {}
+        self.__lock = threading.Lock()
+        self.__stop = threading.Event()
+        self.__thread = None
+
+    @property
+    def running(self):
+        return self.__thread is not None and self.__thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+        self.__stop.clear()
+        self.__thread = threading.Thread(target=self.__run, name="SamplingProfiler", daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        self.__stop.set()
+        if self.__thread:
+            self.__thread.join()
+            self.__thread = None
+
+    def reset(self):
+        with self.__lock:
+            self.__stacks.clear()
+            self.samples = 0
+
+    def __label(self, code):
+        label = self.__labels.get(code)
+        if label is None:
+            label = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+            self.__labels[code] = label
+        return label
+
+    def __run(self):
+        own_ident = threading.get_ident()
+        while not self.__stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            stacks = []
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+                name = names.get(ident, f"thread-{ident}")
+                if self.threads is not None and name not in self.threads:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(self.__label(frame.f_code))
+                    frame = frame.f_back
+                stack.append(name)
+                stacks.append(";".join(reversed(stack)))
+            with self.__lock:
+                self.__stacks.update(stacks)
+                self.samples += 1
+
+    def folded(self):
+        """
+        :return: The recorded stacks in the folded format ("thread;outer function;...;inner function count"), the input
+                 of flamegraph.pl.
+        """
+
+        with self.__lock:
+            return [f"{stack} {count}" for stack, count in sorted(self.__stacks.items())]
+
+    def write_folded(self, path):
+        with open(path, "w") as file:
+            for line in self.folded():
+                file.write(line + "\n")
+
+
+class AllocationTracker:
+    """
+    Compares tracemalloc snapshots of consecutive cycles.
+    """
+
+    def __init__(self, frames=10, key_type="lineno", limit=20):
+        """
+        :param frames: Number of frames stored per allocation.
+        :param key_type: Grouping of the allocations, "lineno", "filename" or "traceback".
+        :param limit: Number of code locations in a report.
+        """
+
+        self.frames = frames
+        self.key_type = key_type
+        self.limit = limit
+        self.__previous = None
+        self.__started = False
+
+    @property
+    def tracing(self):
+        return tracemalloc.is_tracing()
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+            self.__started = True
+        self.__previous = None
+
+    def stop(self):
+        # tracemalloc is only stopped if it has been started by the tracker.
+        if self.__started:
+            tracemalloc.stop()
+            self.__started = False
+        self.__previous = None
+
+    def snapshot(self):
+        """
+        Takes a snapshot and compares it with the previous one.
+
+        :return: List of tracemalloc.StatisticDiff with the largest growth first (empty for the first snapshot).
+        """
+
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap*>"),
+            tracemalloc.Filter(False, "<unknown>")
+        ))
+        previous, self.__previous = self.__previous, snapshot
+        if previous is None:
+            return []
+        diffs = snapshot.compare_to(previous, self.key_type)
+        return [diff for diff in diffs if diff.size_diff > 0][:self.limit]
+
+    def report(self, diffs):
+        """
+        :return: The diffs as text, one code location per line.
+        """
+
+        current, peak = tracemalloc.get_traced_memory()
+        lines = [f"traced: {current / 1024:.1f} KiB, peak: {peak / 1024:.1f} KiB"]
+        for diff in diffs:
+            # Innermost frame first, the traceback is ordered from the oldest frame to the most recent one.
+            location = " <- ".join(f"{frame.filename}:{frame.lineno}" for frame in reversed(diff.traceback))
+            lines.append(f"{diff.size_diff / 1024:+.1f} KiB ({diff.count_diff:+d} blocks), total {diff.size / 1024:.1f} KiB: "
+                         f"{location}")
+        return "\n".join(lines)
+
+
+class Diagnostics:
+    """
+    Switches the profiler and the allocation tracker on and off and writes their results to the output directory.
+    """
+
+    def __init__(self, output_dir="diagnostics", interval=0.01, threads=None, frames=10, limit=20):
+        """
+        :param output_dir: Directory of the written profiles (<time>.folded) and allocation reports (<time>.allocations).
+        :param interval: See SamplingProfiler.
+        :param threads: See SamplingProfiler.
+        :param frames: See AllocationTracker.
+        :param limit: See AllocationTracker.
+        """
+
+        self.output_dir = str(output_dir)
+        self.profiler = SamplingProfiler(interval, threads)
+        self.allocations = AllocationTracker(frames, limit=limit)
+        self.last_report = ""
+        self.__lock = threading.Lock()
+        self.__name = None
+        self.__timer = None
+
+    @property
+    def enabled(self):
+        return self.__name is not None
+
+    def enable(self, duration=None):
+        """
+        :param duration: Optional number of seconds after which the diagnostics are disabled again.
+        """
+
+        with self.__lock:
+            if self.__name is not None:
+                return
+            self.__name = time.strftime("%Y%m%dT%H%M%S")
+            self.profiler.reset()
+            self.profiler.start()
+            self.allocations.start()
+            if duration:
+                self.__timer = threading.Timer(duration, self.disable)
+                self.__timer.daemon = True
+                self.__timer.start()
+        LOGGER.info(f"Diagnostics enabled{f' for {duration}s' if duration else ''}.")
+
+    def disable(self):
+        """
+        Stops the diagnostics and writes the profile.
+
+        :return: Path of the written profile (None, if the diagnostics were not enabled).
+        """
+
+        with self.__lock:
+            if self.__name is None:
+                return None
+            if self.__timer:
+                self.__timer.cancel()
+                self.__timer = None
+            self.profiler.stop()
+            self.allocations.stop()
+            os.makedirs(self.output_dir, exist_ok=True)
+            path = os.path.join(self.output_dir, f"{self.__name}.folded")
+            self.profiler.write_folded(path)
+            self.__name = None
+        LOGGER.info(f"Diagnostics disabled, {self.profiler.samples} samples written to {path}.")
+        return path
+
+    def toggle(self):
+        if self.enabled:
+            self.disable()
+        else:
+            self.enable()
+
+    def on_cycle(self):
+        """
+        Compares the allocations with those after the previous cycle and appends the growth to the allocation report.
+        Does nothing while the diagnostics are disabled.
+        """
+
+        with self.__lock:
+            if self.__name is None:
+                return
+            diffs = self.allocations.snapshot()
+            if not diffs:
+                return
+            self.last_report = self.allocations.report(diffs)
+            os.makedirs(self.output_dir, exist_ok=True)
+            with open(os.path.join(self.output_dir, f"{self.__name}.allocations"), "a") as file:
+                file.write(f"--- {time.strftime('%Y-%m-%dT%H:%M:%S')}\n{self.last_report}\n")
+        LOGGER.info(f"Memory growth since the previous cycle:\n{self.last_report}")
+
+    @contextmanager
+    def cycle(self):
+        """
+        Context manager around an algorithm cycle, which calls on_cycle afterwards.
+        """
+
+        try:
+            yield
+        finally:
+            self.on_cycle()
+
+    def install_signal_handler(self, signum=getattr(signal, "SIGUSR2", None)):
+        """
+        Toggles the diagnostics whenever the process receives the signal (SIGUSR2 by default, not available on Windows).
+        Must be called from the main thread.
+        """
+
+        if signum is None:
+            raise ValueError("Signal handlers are not supported on this platform, use the http endpoint instead.")
+        # The handler interrupts the main thread, which might hold the lock in on_cycle right now.
+        signal.signal(signum, lambda *args: threading.Thread(target=self.toggle, name="DiagnosticsToggle").start())
+
+    def status(self):
+        return {"enabled": self.enabled, "samples": self.profiler.samples, "tracing": self.allocations.tracing,
+                "output_dir": self.output_dir}
+
+    def start_http_server(self, port=9101, host="127.0.0.1"):
+        """
+        Starts a daemon thread serving the diagnostics under http://[host]:[port]/diagnostics:
+
+        * GET /diagnostics: Status as JSON
+        * POST /diagnostics/start?duration=<seconds>: Enables the diagnostics (optionally for a limited time)
+        * POST /diagnostics/stop: Disables the diagnostics and writes the profile
+        * GET /diagnostics/profile: The stacks recorded so far in the folded format
+        * GET /diagnostics/allocations: The latest allocation report
+        """
+
+        diagnostics = self
+
+        class DiagnosticsHandler(BaseHTTPRequestHandler):
+
+            def __respond(self, body, content_type="application/json"):
+                body = body.encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                path = urlparse(self.path).path
+                if path == "/diagnostics":
+                    self.__respond(json.dumps(diagnostics.status()))
+                elif path == "/diagnostics/profile":
+                    self.__respond("\n".join(diagnostics.profiler.folded()) + "\n", "text/plain")
+                elif path == "/diagnostics/allocations":
+                    self.__respond(diagnostics.last_report + "\n", "text/plain")
+                else:
+                    self.send_error(404)
+
+            def do_POST(self):
+                url = urlparse(self.path)
+                if url.path == "/diagnostics/start":
+                    duration = parse_qs(url.query).get("duration")
+                    try:
+                        diagnostics.enable(float(duration[0]) if duration else None)
+                    except ValueError:
+                        self.send_error(400, "Invalid duration")
+                        return
+                    self.__respond(json.dumps(diagnostics.status()))
+                elif url.path == "/diagnostics/stop":
+                    self.__respond(json.dumps(dict(diagnostics.status(), profile=diagnostics.disable())))
+                else:
+                    self.send_error(404)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = HTTPServer((host, port), DiagnosticsHandler)
+        thread = threading.Thread(target=server.serve_forever, name="DiagnosticsHttpServer", daemon=True)
+        thread.start()
+        return server
@@ -0,0 +1,99 @@
+"""
+Powerbot helper functions
+(c) 2020 PowerBot GmbH
+
+Helpers to process objects that either come from the REST api (swagger models) or from websocket events (dictionaries).
+"""
+
+import json
+from datetime import datetime
+from helpers.delivery_period_helper import parse_datetime
+
+
+def get_field(obj, field, default=None):
+    """
+    Helper function to read a field from a swagger model as well as from a decoded websocket event.
+
+    :param obj: Swagger model or dictionary.
+    :param field: The name of the field (the REST api and the websocket events use the same snake case names).
+    :param default: Value returned if the field does not exist or is None.
+    :return: The value of the field.
+    """
+
+    if isinstance(obj, dict):
+        value = obj.get(field)
+    else:
+        value = getattr(obj, field, None)
+    return default if value is None else value
+
+
+def parse_message(message):
+    """
+    Helper function to decode the body of a MESSAGE frame put into the queue by the PowerBotWebSocket.
+
+    :param message: The frame as unpacked by stomper.
+    :return: List of event dictionaries (a single event is wrapped in a list).
+    """
+
+    body = message["body"] if isinstance(message, dict) else message
+    if not body:
+        return []
+    data = json.loads(body)
+    return data if isinstance(data, list) else [data]
+
+
+def get_trade_legs(trade):
+    """
+    Helper function to split a trade into the legs of our own portfolios.
+    Own trades contain the portfolio and delivery area of both sides, which might both be ours (e.g. internal trades).
+
+    :param trade: Trade model or trade event.
+    :return: List of tuples (portfolio_id, delivery_area, side), where side is "BUY" or "SELL".
+    """
+
+    legs = []
+    buy_portfolio_id = get_field(trade, "buy_portfolio_id")
+    sell_portfolio_id = get_field(trade, "sell_portfolio_id")
+
+    if buy_portfolio_id or sell_portfolio_id:
+        if buy_portfolio_id:
+            legs.append((buy_portfolio_id, get_field(trade, "buy_delivery_area", get_field(trade, "delivery_area")), "BUY"))
+        if sell_portfolio_id:
+            legs.append((sell_portfolio_id, get_field(trade, "sell_delivery_area", get_field(trade, "delivery_area")), "SELL"))
+    elif get_field(trade, "portfolio_id"):
+        side = "BUY" if get_field(trade, "buy", False) else "SELL"
+        legs.append((get_field(trade, "portfolio_id"), get_field(trade, "delivery_area"), side))
+
+    return legs
+
+
+def get_order_side(order):
+    """
+    Helper function to retrieve the side of an order entry (side field) or own order (buy flag).
+
+    :param order: OrderEntry, OwnOrder or order event.
+    :return: "BUY" or "SELL"
+    """
+
+    side = get_field(order, "side")
+    if side:
+        return side
+    return "BUY" if get_field(order, "buy", False) else "SELL"
+
+
+def get_timestamp(value):
+    """
+    Helper function to convert a timestamp of a swagger model (datetime) or websocket event (ISO 8601 string) to seconds
+    since the epoch.
+
+    :param value: datetime, ISO 8601 string or number of seconds.
+    :return: Seconds since the epoch as float (0.0 for None).
+    """
+
+    if value is None:
+        return 0.0
+    if isinstance(value, datetime):
+        return value.timestamp()
+    if isinstance(value, (int, float)):
+        return float(value)
+    return parse_datetime(value).timestamp()
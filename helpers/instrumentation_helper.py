@@ -0,0 +1,306 @@
+"""
+Powerbot instrumentation helpers
+(c) 2020 PowerBot GmbH
+
+Low-overhead latency histograms and counters for the REST calls and the phases of an algorithm cycle.
+The collected metrics can be exposed as a Prometheus text endpoint or written to a snapshot file periodically.
+"""
+
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from swagger_client import ApiClient
+from swagger_client.rest import ApiException
+
+
+class LatencyHistogram:
+    """
+    HDR-style histogram with log-linear buckets. Values are recorded in microseconds, each power of two is split into
+    SUB_BUCKETS / 2 linear buckets, which keeps the relative error of every percentile below 100 / SUB_BUCKETS percent.
+    """
+
+    SUB_BUCKET_BITS = 6
+    SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+    # 2^36 microseconds are roughly 19 hours, anything above is clamped into the last bucket.
+    MAX_EXPONENT = 36 - SUB_BUCKET_BITS + 1
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__counts = [0] * (self.SUB_BUCKETS + self.MAX_EXPONENT * (self.SUB_BUCKETS >> 1))
+        self.__count = 0
+        self.__sum = 0
+        self.__max = 0
+
+    @classmethod
+    def _bucket_index(cls, value):
+        if value < cls.SUB_BUCKETS:
+            return value
+        exponent = min(value.bit_length() - cls.SUB_BUCKET_BITS, cls.MAX_EXPONENT)
+        mantissa = min(value >> exponent, cls.SUB_BUCKETS - 1)
+        return cls.SUB_BUCKETS + (exponent - 1) * (cls.SUB_BUCKETS >> 1) + mantissa - (cls.SUB_BUCKETS >> 1)
+
+    @classmethod
+    def _bucket_value(cls, index):
+        if index < cls.SUB_BUCKETS:
+            return index
+        exponent, mantissa = divmod(index - cls.SUB_BUCKETS, cls.SUB_BUCKETS >> 1)
+        return (mantissa + (cls.SUB_BUCKETS >> 1)) << (exponent + 1)
+
+    def record(self, seconds):
+        """
+        Records a single duration.
+
+        :param seconds: The duration in seconds (as returned by the difference of two time.perf_counter() calls).
+        """
+
+        value = max(int(seconds * 1e6), 0)
+        index = self._bucket_index(value)
+        with self.__lock:
+            self.__counts[index] += 1
+            self.__count += 1
+            self.__sum += value
+            if value > self.__max:
+                self.__max = value
+
+    @property
+    def count(self):
+        return self.__count
+
+    @property
+    def sum(self):
+        """
+        Sum of all recorded durations in seconds.
+        """
+        return self.__sum / 1e6
+
+    @property
+    def max(self):
+        """
+        Largest recorded duration in seconds.
+        """
+        return self.__max / 1e6
+
+    def percentiles(self, quantiles):
+        """
+        Calculates multiple percentiles with a single pass over the buckets.
+
+        :param quantiles: Ascending list of quantiles between 0 and 1.
+        :return: Dictionary {quantile: duration in seconds}
+        """
+
+        with self.__lock:
+            counts = list(self.__counts)
+            total = self.__count
+            maximum = self.__max
+
+        result = {}
+        if total == 0:
+            return {q: 0.0 for q in quantiles}
+
+        remaining = list(quantiles)
+        seen = 0
+        for index, bucket_count in enumerate(counts):
+            if not bucket_count:
+                continue
+            seen += bucket_count
+            while remaining and seen >= remaining[0] * total:
+                result[remaining.pop(0)] = min(self._bucket_value(index), maximum) / 1e6
+            if not remaining:
+                break
+        for q in remaining:
+            result[q] = maximum / 1e6
+        return result
+
+
+class Metrics:
+    """
+    Registry for latency histograms and counters. Every metric is identified by its name and a tuple of label pairs.
+    """
+
+    QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__histograms = {}
+        self.__counters = {}
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def histogram(self, name, **labels):
+        key = self._key(name, labels)
+        histogram = self.__histograms.get(key)
+        if histogram is None:
+            with self.__lock:
+                histogram = self.__histograms.setdefault(key, LatencyHistogram())
+        return histogram
+
+    def increment(self, name, amount=1, **labels):
+        key = self._key(name, labels)
+        with self.__lock:
+            self.__counters[key] = self.__counters.get(key, 0) + amount
+
+    def counter(self, name, **labels):
+        return self.__counters.get(self._key(name, labels), 0)
+
+    @contextmanager
+    def time(self, name, **labels):
+        """
+        Context manager which records the duration of its body in the histogram [name].
+        """
+
+        histogram = self.histogram(name, **labels)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            histogram.record(time.perf_counter() - start)
+
+    def phase(self, phase):
+        """
+        Shortcut to time a phase of the algorithm cycle, e.g. "fetch", "strategy" or "submit".
+        """
+        return self.time("powerbot_algo_phase_seconds", phase=phase)
+
+    def snapshot(self):
+        """
+        :return: A JSON serializable dictionary holding the current state of all metrics.
+        """
+
+        with self.__lock:
+            histograms = list(self.__histograms.items())
+            counters = list(self.__counters.items())
+
+        return {
+            "timestamp": time.time(),
+            "histograms": [{"name": name,
+                            "labels": dict(labels),
+                            "count": histogram.count,
+                            "sum": histogram.sum,
+                            "max": histogram.max,
+                            "percentiles": {str(q): v for q, v in histogram.percentiles(self.QUANTILES).items()}}
+                           for (name, labels), histogram in histograms],
+            "counters": [{"name": name, "labels": dict(labels), "value": value} for (name, labels), value in counters]
+        }
+
+    def to_prometheus(self):
+        """
+        :return: All metrics in the Prometheus text exposition format. Histograms are exported as summaries.
+        """
+
+        def format_labels(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ""
+            return "{" + ",".join('{}="{}"'.format(k, str(v).replace('"', '\\"')) for k, v in pairs) + "}"
+
+        with self.__lock:
+            histograms = sorted(self.__histograms.items())
+            counters = sorted(self.__counters.items())
+
+        lines = []
+        declared = set()
+        for (name, labels), histogram in histograms:
+            if name not in declared:
+                lines.append(f"# TYPE {name} summary")
+                declared.add(name)
+            for q, value in histogram.percentiles(self.QUANTILES).items():
+                lines.append(f"{name}{format_labels(labels, [('quantile', q)])} {value}")
+            lines.append(f"{name}_sum{format_labels(labels)} {histogram.sum}")
+            lines.append(f"{name}_count{format_labels(labels)} {histogram.count}")
+        for (name, labels), value in counters:
+            if name not in declared:
+                lines.append(f"# TYPE {name} counter")
+                declared.add(name)
+            lines.append(f"{name}{format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def write_snapshot(self, path):
+        """
+        Writes the current snapshot as JSON. The file is replaced atomically, so readers never see a partial file.
+        """
+
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as snapshot_file:
+            json.dump(self.snapshot(), snapshot_file)
+        os.replace(tmp_path, path)
+
+    def start_snapshot_writer(self, path, interval=60):
+        """
+        Starts a daemon thread, which writes a snapshot to [path] every [interval] seconds.
+        """
+
+        def run():
+            while True:
+                time.sleep(interval)
+                self.write_snapshot(path)
+
+        thread = threading.Thread(target=run, name="MetricsSnapshotWriter", daemon=True)
+        thread.start()
+        return thread
+
+    def start_http_server(self, port=9100, host="127.0.0.1"):
+        """
+        Starts a daemon thread serving the metrics in the Prometheus text format under http://[host]:[port]/metrics.
+        """
+
+        metrics = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.to_prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = HTTPServer((host, port), MetricsHandler)
+        thread = threading.Thread(target=server.serve_forever, name="MetricsHttpServer", daemon=True)
+        thread.start()
+        return server
+
+
+# Default registry shared by the helpers and examples of this project.
+METRICS = Metrics()
+
+
+class InstrumentedApiClient(ApiClient):
+    """
+    ApiClient which records the latency and the outcome of every REST call.
+    Calls made with async_req=True are measured in the worker thread, i.e. from sending the request until the
+    response is deserialized.
+    """
+
+    def __init__(self, configuration=None, metrics=METRICS, **kwargs):
+        super().__init__(configuration, **kwargs)
+        self.metrics = metrics
+
+    def _ApiClient__call_api(self, resource_path, method, *args, **kwargs):
+        # The generated client dispatches every (sync and async) call to the name mangled __call_api method.
+        # The resource path is still the template (e.g. /orders/{orderId}), which keeps the label cardinality low.
+        endpoint = f"{method} {resource_path}"
+        start = time.perf_counter()
+        status = "200"
+        try:
+            return super()._ApiClient__call_api(resource_path, method, *args, **kwargs)
+        except ApiException as exception:
+            status = str(exception.status)
+            raise
+        except Exception:
+            status = "error"
+            raise
+        finally:
+            self.metrics.histogram("powerbot_api_request_seconds", endpoint=endpoint).record(time.perf_counter() - start)
+            self.metrics.increment("powerbot_api_requests_total", endpoint=endpoint, status=status)
@@ -0,0 +1,246 @@
+"""
+Powerbot kill switch helpers
+(c) 2020 PowerBot GmbH
+
+Cancel-on-disconnect and kill switch. An index of all active own orders (order id and revision number) is kept current
+from order events. When the kill switch is triggered (UNIX signal, lost websocket heartbeat or a risk breach), all
+orders are deleted in parallel bulk requests and the deletion is confirmed by fetching the own orders again.
+"""
+
+import logging
+import signal
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from swagger_client.models import OrderModify, OrderModifyItem
+from swagger_client.rest import ApiException
+from helpers.event_helper import get_field
+from helpers.instrumentation_helper import METRICS
+
+# Order states of orders which are still on the order book and have to be deleted.
+ACTIVE_STATES = ("ACTI", "IACT", "HIBE")
+
+LOGGER = logging.getLogger("KillSwitch")
+
+
+class KillSwitch:
+    """
+    Keeps the index of active orders and deletes all of them on trigger. Once triggered, the kill switch stays triggered
+    (check [triggered] before placing new orders) until reset() is called.
+    """
+
+    def __init__(self, orders_api, portfolio_ids, delivery_areas, chunk_size=100, workers=8, max_rounds=3):
+        """
+        :param orders_api: OrdersApi object, ideally of a client with CRITICAL priority for deletions.
+        :param portfolio_ids: Portfolios whose orders are deleted.
+        :param delivery_areas: Delivery areas whose orders are deleted.
+        :param chunk_size: Number of orders deleted with a single modify_orders request.
+        :param workers: Number of modify_orders requests sent in parallel.
+        :param max_rounds: Number of delete/confirm rounds before giving up.
+        """
+
+        self.orders_api = orders_api
+        self.portfolio_ids = list(portfolio_ids)
+        self.delivery_areas = list(delivery_areas)
+        self.chunk_size = chunk_size
+        self.max_rounds = max_rounds
+        self.triggered = threading.Event()
+        self.callbacks = []
+
+        self.__executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="KillSwitch")
+        self.__lock = threading.Lock()
+        self.__trigger_lock = threading.Lock()
+        # {order_id: (revision_no, contract_id, delivery_area)}
+        self.__orders = {}
+
+    @property
+    def active_orders(self):
+        return len(self.__orders)
+
+    def on_order(self, order):
+        """
+        Updates the index from an own order (REST model, add_orders response or websocket event).
+        """
+
+        if get_field(order, "portfolio_id") not in self.portfolio_ids:
+            return
+        order_id = get_field(order, "order_id")
+        with self.__lock:
+            if get_field(order, "state") in ACTIVE_STATES and get_field(order, "quantity", 0) > 0:
+                self.__orders[order_id] = (get_field(order, "revision_no"), get_field(order, "contract_id"), get_field(order, "delivery_area"))
+            else:
+                self.__orders.pop(order_id, None)
+
+    def bootstrap(self):
+        """
+        Fills the index with all own orders of the portfolios and delivery areas.
+
+        :return: Number of active orders.
+        """
+
+        orders = self.__fetch_own_orders()
+        with self.__lock:
+            self.__orders.clear()
+        for order in orders:
+            self.on_order(order)
+        return self.active_orders
+
+    def arm_signals(self, signals=(signal.SIGTERM, signal.SIGUSR1)):
+        """
+        Triggers the kill switch on the given UNIX signals. Must be called from the main thread.
+        """
+
+        def handler(signum, frame):
+            # Signal handlers should return quickly, the deletion runs in its own thread.
+            threading.Thread(target=self.trigger, args=(f"signal {signum}",), name="KillSwitchTrigger").start()
+
+        for signum in signals:
+            signal.signal(signum, handler)
+
+    def on_disconnect(self):
+        """
+        Triggers the kill switch when the websocket connection is lost, pass it as on_disconnect to the PowerBotWebSocket.
+        """
+
+        # The websocket thread must not wait for the deletion.
+        threading.Thread(target=self.trigger, args=("websocket disconnected",), name="KillSwitchTrigger").start()
+
+    def watch_heartbeat(self, websocket, timeout=30, interval=1):
+        """
+        Starts a daemon thread which triggers the kill switch if the websocket is closed or did not receive any frame
+        (including heartbeats) within [timeout] seconds.
+
+        :param websocket: PowerBotWebSocket object.
+        """
+
+        def run():
+            while not self.triggered.is_set():
+                silence = time.monotonic() - websocket.last_message_time
+                if not websocket.is_active or silence > timeout:
+                    self.trigger(f"websocket heartbeat lost ({silence:.1f}s)")
+                    return
+                time.sleep(interval)
+
+        thread = threading.Thread(target=run, name="KillSwitchHeartbeat", daemon=True)
+        thread.start()
+        return thread
+
+    def trigger(self, reason):
+        """
+        Deletes all orders. Concurrent triggers wait for the running deletion instead of starting another one.
+
+        :param reason: Reason for the log output (e.g. "risk breach").
+        :return: Number of orders that could not be deleted.
+        """
+
+        with self.__trigger_lock:
+            already_triggered = self.triggered.is_set()
+            self.triggered.set()
+            if already_triggered and not self.__orders:
+                return 0
+
+            LOGGER.warning(f"KILL SWITCH TRIGGERED: {reason}. Deleting {self.active_orders} orders.")
+            # The orders are deleted first, a failing or slow callback must never delay or prevent the deletion.
+            remaining = None
+            try:
+                with METRICS.time("powerbot_mass_cancel_seconds"):
+                    remaining = self.mass_cancel()
+                if remaining:
+                    LOGGER.error(f"KILL SWITCH: {remaining} orders are still active after {self.max_rounds} rounds.")
+                else:
+                    LOGGER.warning("KILL SWITCH: all orders deleted.")
+            finally:
+                for callback in self.callbacks:
+                    try:
+                        callback(reason)
+                    except Exception as e:
+                        LOGGER.exception(f"KILL SWITCH: callback {callback} failed: {e}")
+            return remaining
+
+    def reset(self):
+        self.triggered.clear()
+
+    def mass_cancel(self):
+        """
+        Deletes all indexed orders in parallel chunks and confirms the deletion with get_own_orders. Orders that are still
+        active after a round (e.g. unknown to the index) are deleted in the next round.
+
+        :return: Number of orders that are still active.
+        """
+
+        with self.__lock:
+            orders = dict(self.__orders)
+
+        for _ in range(self.max_rounds):
+            if orders:
+                items = list(orders.items())
+                chunks = [items[i:i + self.chunk_size] for i in range(0, len(items), self.chunk_size)]
+                list(self.__executor.map(self.__delete_chunk, chunks))
+
+            try:
+                remaining = self.__fetch_own_orders()
+            except Exception as e:
+                # E.g. the connection is lost, the orders of this round are deleted again in the next round.
+                LOGGER.exception(f"KILL SWITCH: confirming the deletion failed: {e}")
+                continue
+            orders = {o.order_id: (o.revision_no, o.contract_id, o.delivery_area) for o in remaining
+                      if o.state in ACTIVE_STATES}
+            with self.__lock:
+                self.__orders = dict(orders)
+            if not orders:
+                return 0
+        return len(orders)
+
+    def __delete_chunk(self, chunk):
+        modify_items = [OrderModifyItem(order_id=order_id, revision_no=revision_no, changes=OrderModify(action="DELE"))
+                        for order_id, (revision_no, _, _) in chunk]
+        try:
+            self.orders_api.modify_orders(modifications=modify_items)
+        except ApiException as exception:
+            # 400: an order of the chunk no longer exists, 409: an order has another revision number (partial execution).
+            # The confirmation round fetches the current revisions and deletes the remaining orders.
+            if exception.status not in (400, 409):
+                LOGGER.exception(exception)
+            else:
+                self.__delete_refreshed(chunk)
+        except Exception as e:
+            # E.g. a timeout, the other chunks are deleted anyway and the confirmation round retries this one.
+            LOGGER.exception(f"KILL SWITCH: deleting {len(chunk)} orders failed: {e}")
+
+    def __delete_refreshed(self, chunk):
+        contract_ids = sorted({contract_id for _, (_, contract_id, _) in chunk})
+        order_ids = {order_id for order_id, _ in chunk}
+        for delivery_area in sorted({area for _, (_, _, area) in chunk}):
+            try:
+                self.__delete_current(contract_ids, order_ids, delivery_area)
+            except Exception as e:
+                # Still outdated or not reachable, the orders are deleted in the next round after the confirmation.
+                LOGGER.exception(f"KILL SWITCH: deleting the refreshed orders of {delivery_area} failed: {e}")
+
+    def __delete_current(self, contract_ids, order_ids, delivery_area):
+        current = self.orders_api.get_own_orders(contract_id=contract_ids, portfolio_id=self.portfolio_ids,
+                                                 delivery_area=delivery_area, offset=0, limit=500)
+        modify_items = [OrderModifyItem(order_id=o.order_id, revision_no=o.revision_no, changes=OrderModify(action="DELE"))
+                        for o in current if o.order_id in order_ids and o.state in ACTIVE_STATES]
+        if not modify_items:
+            return
+        try:
+            self.orders_api.modify_orders(modifications=modify_items)
+        except ApiException as exception:
+            # Still outdated, the orders are deleted in the next round after the confirmation.
+            if exception.status not in (400, 409):
+                raise
+
+    def __fetch_own_orders(self):
+        # Maximum limit of orders that can be retrieved with a single request is 500.
+        all_own_orders = []
+        for delivery_area in self.delivery_areas:
+            offset = 0
+            more_orders = True
+            while more_orders:
+                own_orders = self.orders_api.get_own_orders(portfolio_id=self.portfolio_ids, delivery_area=delivery_area,
+                                                            offset=offset, limit=500)
+                all_own_orders.extend(own_orders)
+                offset += 500
+                more_orders = len(own_orders) == 500
+        return all_own_orders
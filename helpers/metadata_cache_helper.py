@@ -0,0 +1,229 @@
+"""
+Powerbot metadata cache helpers
+(c) 2020 PowerBot GmbH
+
+In-memory cache of the tenants, the portfolios, the portfolios of the current API key and the risk management settings
+of the traded portfolios (and their tenant). Everything is loaded at once with concurrent requests and served from memory
+afterwards, e.g. to validate the portfolio ids of an order batch without any round trip. The cache is reloaded after its
+TTL or after the tenants, portfolios, API keys or risk settings have been changed through the same client:
+
+    client = create_client(API_KEY, URL)
+    metadata = MetadataCache(client, ttl=3600, portfolio_ids=[PORTFOLIO_ID])
+    metadata.validate_portfolios([PORTFOLIO_ID])
+    PortfoliosApi(client).update_portfolio_risk_management_settings(id=PORTFOLIO_ID, value=settings)
+    metadata.risk_settings(PORTFOLIO_ID)    # reloaded
+"""
+
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from swagger_client import ApiClient
+from swagger_client.api import AuthenticationApi, PortfoliosApi, TenantsApi
+from swagger_client.rest import ApiException
+from helpers.event_helper import get_field
+
+LOGGER = logging.getLogger("MetadataCache")
+
+# Changes (non GET requests) to resource paths containing one of these parts invalidate the cache.
+INVALIDATING_PATHS = ("tenant", "portfolio", "apikey", "api_key", "risk")
+
+
+class ObservableApiClient(ApiClient):
+    """
+    ApiClient which notifies its mutation listeners after every request that is not a GET request.
+    """
+
+    def __init__(self, configuration=None, **kwargs):
+        super().__init__(configuration, **kwargs)
+        # Functions listener(method, resource_path)
+        self.mutation_listeners = []
+
+    def _ApiClient__call_api(self, resource_path, method, *args, **kwargs):
+        try:
+            return super()._ApiClient__call_api(resource_path, method, *args, **kwargs)
+        finally:
+            # Failed requests (e.g. timeouts) might have changed something on the server as well.
+            if method != "GET":
+                for listener in self.mutation_listeners:
+                    listener(method, resource_path)
+
+
+def _id_of(item):
+    return item if isinstance(item, str) else get_field(item, "id")
+
+
+def _result(future, name, denied, default=None):
+    # Depending on its permissions, an API key cannot read all metadata (e.g. the tenants). Denied requests are recorded
+    # in [denied] {name: ApiException}, so the lookups can tell them apart from missing metadata.
+    try:
+        return future.result()
+    except ApiException as exception:
+        if exception.status in (401, 403):
+            LOGGER.warning(f"The API key is not allowed to read the {name} ({exception.status} {exception.reason}).")
+            denied[name] = exception
+            return default
+        raise
+
+
+class MetadataCache:
+    """
+    Tenants, portfolios, API key permissions and risk management settings, loaded at once and served from memory.
+    """
+
+    def __init__(self, client, ttl=3600, workers=8, portfolio_ids=(), tenant_ids=(), invalidating_paths=INVALIDATING_PATHS):
+        """
+        :param client: ApiClient; an ObservableApiClient (like the PowerBotApiClient) invalidates the cache after changes.
+        :param ttl: Time in seconds after which the metadata is reloaded.
+        :param workers: Number of concurrent requests while loading.
+        :param portfolio_ids: Portfolios whose risk management settings are loaded.
+        :param tenant_ids: Tenants whose risk management settings are loaded.
+        :param invalidating_paths: Parts of the resource paths whose changes invalidate the cache.
+        """
+
+        self.tenants_api = TenantsApi(client)
+        self.portfolios_api = PortfoliosApi(client)
+        self.authentication_api = AuthenticationApi(client)
+        self.ttl = ttl
+        self.workers = workers
+        self.portfolio_ids = [portfolio_id for portfolio_id in portfolio_ids if portfolio_id]
+        self.tenant_ids = [tenant_id for tenant_id in tenant_ids if tenant_id]
+        self.invalidating_paths = tuple(invalidating_paths)
+        self.loads = 0
+        self.__lock = threading.Lock()
+        # The loaded metadata is replaced as a whole, readers never see a partially loaded state.
+        self.__data = None
+        self.__expires = 0
+        # Incremented by every invalidation, so an invalidation during a load is not lost.
+        self.__generation = 0
+
+        if hasattr(client, "mutation_listeners"):
+            client.mutation_listeners.append(self.__on_mutation)
+
+    def __on_mutation(self, method, resource_path):
+        path = resource_path.lower()
+        if any(part in path for part in self.invalidating_paths):
+            LOGGER.info(f"{method} {resource_path} invalidated the metadata cache.")
+            self.invalidate()
+
+    def invalidate(self):
+        """
+        Marks the metadata as outdated, it is reloaded with the next lookup.
+        """
+
+        self.__generation += 1
+        self.__expires = 0
+
+    def load(self):
+        """
+        Loads all metadata and the risk settings of the configured tenants and portfolios in parallel.
+        """
+
+        generation = self.__generation
+        denied = {}
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="MetadataCache") as executor:
+            tenants = executor.submit(self.tenants_api.get_tenants)
+            portfolios = executor.submit(self.portfolios_api.get_portfolios)
+            api_key_portfolios = executor.submit(self.authentication_api.get_current_api_key_portfolios)
+            futures = {tenant_id: executor.submit(self.tenants_api.get_tenant_risk_management, id=tenant_id)
+                       for tenant_id in self.tenant_ids}
+            futures.update({portfolio_id: executor.submit(self.portfolios_api.get_portfolio_risk_management_settings, id=portfolio_id)
+                            for portfolio_id in self.portfolio_ids})
+
+            data = {"tenants": {_id_of(tenant): tenant for tenant in _result(tenants, "tenants", denied) or []},
+                    "portfolios": {_id_of(portfolio): portfolio for portfolio in _result(portfolios, "portfolios", denied) or []},
+                    "api_key_portfolio_ids": {_id_of(portfolio) for portfolio in
+                                              _result(api_key_portfolios, "api_key_portfolios", denied) or []},
+                    "risk_settings": {owner_id: _result(future, f"risk settings of {owner_id}", denied)
+                                      for owner_id, future in futures.items()},
+                    "denied": denied}
+
+        self.__data = data
+        self.__expires = time.monotonic() + self.ttl if generation == self.__generation else 0
+        self.loads += 1
+        return data
+
+    def __current(self):
+        if time.monotonic() < self.__expires:
+            return self.__data
+
+        # Only one thread reloads, the others keep using the outdated metadata in the meantime (if there is any).
+        if not self.__lock.acquire(blocking=self.__data is None):
+            return self.__data
+        try:
+            if time.monotonic() < self.__expires:
+                return self.__data
+            try:
+                return self.load()
+            except Exception as e:
+                if self.__data is None:
+                    raise
+                # Keep the outdated metadata and try again in a minute.
+                LOGGER.warning(f"Reloading the metadata failed, using the cached metadata: {e}")
+                self.__expires = time.monotonic() + min(self.ttl, 60)
+                return self.__data
+        finally:
+            self.__lock.release()
+
+    def tenants(self):
+        """
+        :return: Dictionary {tenant_id: Tenant}
+        """
+
+        return self.__current()["tenants"]
+
+    def tenant(self, tenant_id):
+        return self.__current()["tenants"].get(tenant_id)
+
+    def portfolios(self):
+        """
+        :return: Dictionary {portfolio_id: Portfolio}
+        """
+
+        return self.__current()["portfolios"]
+
+    def portfolio(self, portfolio_id):
+        return self.__current()["portfolios"].get(portfolio_id)
+
+    def api_key_portfolio_ids(self):
+        """
+        :return: Set of the ids of the portfolios the current API key has access to.
+        """
+
+        return self.__current()["api_key_portfolio_ids"]
+
+    def risk_settings(self, owner_id):
+        """
+        :param owner_id: Id of one of the configured portfolios or tenants.
+        :return: RiskManagementSettings or None, if the owner has no settings.
+        :raises ApiException: If the API key is not allowed to read the settings. The risk checks must not run without them.
+        :raises KeyError: If the owner is not one of the configured portfolios or tenants.
+        """
+
+        data = self.__current()
+        exception = data["denied"].get(f"risk settings of {owner_id}")
+        if exception is not None:
+            raise exception
+        return data["risk_settings"][owner_id]
+
+    def validate_portfolios(self, portfolio_ids):
+        """
+        Checks that the portfolios exist and that the current API key has access to them. Checks that the API key is not
+        allowed to run (e.g. a STANDARD key cannot read all portfolios) are skipped with a warning.
+
+        :raises ValueError: If one of the portfolios is unknown or not accessible.
+        """
+
+        data = self.__current()
+        if "portfolios" in data["denied"]:
+            LOGGER.warning("Skipping the check for unknown portfolios, the API key is not allowed to read the portfolios.")
+        else:
+            unknown = [portfolio_id for portfolio_id in portfolio_ids if portfolio_id not in data["portfolios"]]
+            if unknown:
+                raise ValueError(f"Unknown portfolios: {unknown}")
+        if "api_key_portfolios" in data["denied"]:
+            LOGGER.warning("Skipping the check for accessible portfolios, the API key is not allowed to read its portfolios.")
+        else:
+            forbidden = [portfolio_id for portfolio_id in portfolio_ids if portfolio_id not in data["api_key_portfolio_ids"]]
+            if forbidden:
+                raise ValueError(f"The API key has no access to the portfolios: {forbidden}")
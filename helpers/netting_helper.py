@@ -0,0 +1,299 @@
+"""
+Powerbot netting helpers
+(c) 2020 PowerBot GmbH
+
+Internal netting of opposing positions between portfolios. The positions per portfolio and contract are matched into
+internal transfers (exact matches first, then greedily largest long against largest short, which needs at most
+longs + shorts - 1 transfers, but not necessarily the fewest possible), which are submitted concurrently with
+add_internal_trade. Every transfer carries an idempotency key in its buy_txt/sell_txt, so a retried or repeated netting
+round never books a transfer twice. The keys are derived from the round id given by the caller, which must stay the same
+across the retries of a round:
+
+    engine = NettingEngine(trades_api)
+    positions, prices = engine.positions_from_order_book(order_book, DELIVERY_AREA, portfolio_ids)
+    transfers, failed = engine.net(positions, prices, round_id=scheduled_start)
+"""
+
+import hashlib
+import heapq
+import json
+import logging
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from swagger_client.models import NewInternalTrade
+from swagger_client.rest import ApiException
+from helpers.event_helper import get_field
+
+LOGGER = logging.getLogger("Netting")
+
+NettingPosition = namedtuple("NettingPosition", ["portfolio_id", "delivery_area", "contract_id", "delivery_start",
+                                                 "delivery_end", "net_pos"])
+
+
+class InternalTransfer:
+    """
+    A planned internal trade: [sell_portfolio_id] sells [quantity] to [buy_portfolio_id].
+    """
+
+    __slots__ = ("contract_id", "delivery_start", "delivery_end", "buy_portfolio_id", "buy_delivery_area", "sell_portfolio_id",
+                 "sell_delivery_area", "quantity", "price", "key", "trade", "error")
+
+    def __init__(self, contract_id, delivery_start, delivery_end, buy, sell, quantity, price, round_id):
+        self.contract_id = contract_id
+        self.delivery_start = delivery_start
+        self.delivery_end = delivery_end
+        self.buy_portfolio_id, self.buy_delivery_area = buy
+        self.sell_portfolio_id, self.sell_delivery_area = sell
+        self.quantity = quantity
+        self.price = price
+        # Deterministic, so the same netting round produces the same keys when it is repeated.
+        self.key = hashlib.sha1(f"{round_id}|{contract_id}|{buy}|{sell}|{quantity}".encode()).hexdigest()[:16]
+        self.trade = None
+        self.error = None
+
+    def __repr__(self):
+        return (f"InternalTransfer({self.sell_portfolio_id} -> {self.buy_portfolio_id}, {self.quantity} MW @ {self.price}, "
+                f"contract={self.contract_id}, key={self.key})")
+
+
+def match_positions(positions, quantity_step=0.1):
+    """
+    Matches long and short positions of a single contract.
+    Positions with exactly opposing quantities are paired first, the remaining positions are matched greedily largest
+    long against largest short, which needs at most (longs + shorts - 1) transfers.
+
+    :param positions: List of ((portfolio_id, delivery_area), net_pos).
+    :param quantity_step: Quantities are rounded down to multiples of the step.
+    :return: List of (buy (portfolio_id, delivery_area), sell (portfolio_id, delivery_area), quantity). The long
+             portfolio sells, the short portfolio buys.
+    """
+
+    def steps(quantity):
+        # Integer steps avoid floating point residues.
+        return int(abs(quantity) / quantity_step + 1e-9)
+
+    longs = {}
+    shorts = {}
+    for owner, net_pos in positions:
+        if steps(net_pos) > 0:
+            (longs if net_pos > 0 else shorts)[owner] = steps(net_pos)
+
+    matches = []
+    # Exact matches: {steps: [short owners]}
+    shorts_by_size = {}
+    for owner, size in shorts.items():
+        shorts_by_size.setdefault(size, []).append(owner)
+    for owner, size in list(longs.items()):
+        candidates = shorts_by_size.get(size)
+        if candidates:
+            short_owner = candidates.pop()
+            matches.append((short_owner, owner, size))
+            del longs[owner]
+            del shorts[short_owner]
+
+    # Greedy matching of the remaining positions with two max heaps.
+    long_heap = [(-size, owner) for owner, size in longs.items()]
+    short_heap = [(-size, owner) for owner, size in shorts.items()]
+    heapq.heapify(long_heap)
+    heapq.heapify(short_heap)
+    while long_heap and short_heap:
+        long_size, long_owner = heapq.heappop(long_heap)
+        short_size, short_owner = heapq.heappop(short_heap)
+        size = min(-long_size, -short_size)
+        matches.append((short_owner, long_owner, size))
+        if -long_size > size:
+            heapq.heappush(long_heap, (long_size + size, long_owner))
+        if -short_size > size:
+            heapq.heappush(short_heap, (short_size + size, short_owner))
+
+    return [(buy, sell, round(size * quantity_step, 6)) for buy, sell, size in matches]
+
+
+class NettingEngine:
+    """
+    Plans and submits the internal transfers of a netting round.
+    """
+
+    def __init__(self, trades_api, exchange="epex", quantity_step=0.1, workers=8, max_retries=3, across_areas=False):
+        """
+        :param trades_api: TradesApi object.
+        :param exchange: Exchange of the internal trades.
+        :param quantity_step: Minimum quantity step of the internal trades.
+        :param workers: Number of internal trades submitted in parallel.
+        :param max_retries: Number of retries per internal trade.
+        :param across_areas: Whether positions of different delivery areas may be netted against each other.
+        """
+
+        self.trades_api = trades_api
+        self.exchange = exchange
+        self.quantity_step = quantity_step
+        self.max_retries = max_retries
+        self.across_areas = across_areas
+        # Idempotency keys of the transfers booked by this engine, they are not requested again.
+        self.__booked = set()
+        self.__executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="Netting")
+
+    @staticmethod
+    def positions_from_order_book(order_book, delivery_area, portfolio_ids=None):
+        """
+        Helper function to read the net positions per portfolio from an order book requested for several portfolios
+        (get_order_books(portfolio_id=[...])).
+
+        :return: Tuple (list of NettingPosition, {contract_id: mid price or None})
+        """
+
+        positions = []
+        prices = {}
+        for contract in order_book.contracts:
+            for info in contract.portfolio_information or []:
+                if portfolio_ids is None or info.portfolio_id in portfolio_ids:
+                    positions.append(NettingPosition(info.portfolio_id, delivery_area, contract.contract_id, contract.delivery_start,
+                                                     contract.delivery_end, info.net_pos or 0))
+            if contract.best_bid_price is not None and contract.best_ask_price is not None:
+                # Prices are limited to two decimals.
+                prices[contract.contract_id] = round((contract.best_bid_price + contract.best_ask_price) / 2, 2)
+            else:
+                prices.setdefault(contract.contract_id, None)
+        return positions, prices
+
+    def plan(self, positions, prices, round_id):
+        """
+        :param positions: List of NettingPosition.
+        :param prices: Dictionary {contract_id: price of the internal trades}. Contracts without price are not netted.
+        :param round_id: ID of the netting round, part of the idempotency keys. It has to be the same for every retry of a
+                         round (e.g. the scheduled start of the round), not the time of the attempt.
+        :return: List of InternalTransfer.
+        """
+
+        groups = {}
+        for position in positions:
+            key = (position.contract_id,) if self.across_areas else (position.contract_id, position.delivery_area)
+            groups.setdefault(key, []).append(position)
+
+        transfers = []
+        for key, group in groups.items():
+            contract_id = key[0]
+            price = prices.get(contract_id)
+            if price is None:
+                LOGGER.warning(f"No price for contract {contract_id}, its positions are not netted.")
+                continue
+            matches = match_positions([((p.portfolio_id, p.delivery_area), p.net_pos) for p in group], self.quantity_step)
+            for buy, sell, quantity in matches:
+                transfers.append(InternalTransfer(contract_id, group[0].delivery_start, group[0].delivery_end, buy, sell, quantity,
+                                                  price, round_id))
+        return transfers
+
+    def submit(self, transfers):
+        """
+        Submits the transfers concurrently. Transfers whose idempotency key already exists are skipped.
+
+        :return: List of the transfers that failed (with their error).
+        """
+
+        pending = [t for t in transfers if t.key not in self.__booked]
+        if pending:
+            # Only the internal trades of the netted delivery periods can carry the keys of these transfers.
+            existing = self.existing_keys({t.buy_portfolio_id for t in pending} | {t.sell_portfolio_id for t in pending},
+                                          min(t.delivery_start for t in pending), max(t.delivery_end for t in pending))
+            self.__booked.update(existing)
+            pending = [t for t in pending if t.key not in existing]
+        if len(pending) < len(transfers):
+            LOGGER.info(f"{len(transfers) - len(pending)} transfers have already been booked.")
+        results = list(self.__executor.map(self.__submit, pending))
+        return [transfer for transfer, success in zip(pending, results) if not success]
+
+    def net(self, positions, prices, round_id):
+        """
+        Plans and submits a netting round.
+
+        :param round_id: See plan.
+
+        :return: Tuple (list of all planned transfers, list of failed transfers)
+        """
+
+        transfers = self.plan(positions, prices, round_id)
+        return transfers, self.submit(transfers)
+
+    def existing_keys(self, portfolio_ids, delivery_start=None, delivery_end=None):
+        """
+        Collects the idempotency keys of the internal trades of the portfolios.
+        Maximum limit of trades that can be retrieved with a single request is 500, therefore a loop is used.
+
+        :param delivery_start: Optional start of the requested delivery periods, should always be set to not page through
+                               the whole trade history.
+        :param delivery_end: Optional end of the requested delivery periods.
+        :return: Set of idempotency keys.
+        """
+
+        keys = set()
+        if not portfolio_ids:
+            return keys
+        filters = {}
+        if delivery_start is not None:
+            filters["delivery_within_start"] = delivery_start
+        if delivery_end is not None:
+            filters["delivery_within_end"] = delivery_end
+        offset = 0
+        more_trades = True
+        while more_trades:
+            trades = self.trades_api.get_internal_trades(portfolio_id=sorted(portfolio_ids), offset=offset, limit=500, **filters)
+            for trade in trades:
+                key = self.__key_of(get_field(trade, "buy_txt")) or self.__key_of(get_field(trade, "sell_txt"))
+                if key:
+                    keys.add(key)
+            offset += 500
+            more_trades = len(trades) == 500
+        return keys
+
+    @staticmethod
+    def __key_of(txt):
+        try:
+            data = json.loads(txt) if txt else None
+        except ValueError:
+            return None
+        return data.get("netting") if isinstance(data, dict) else None
+
+    def __submit(self, transfer):
+        txt = json.dumps({"netting": transfer.key}, separators=(",", ":"))
+        internal_trade = NewInternalTrade(exchange=self.exchange,
+                                          delivery_start=transfer.delivery_start,
+                                          delivery_end=transfer.delivery_end,
+                                          exec_time=datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z",
+                                          buy_delivery_area=transfer.buy_delivery_area,
+                                          buy_txt=txt,
+                                          buy_portfolio_id=transfer.buy_portfolio_id,
+                                          buy_aggressor_indicator="N",
+                                          sell_delivery_area=transfer.sell_delivery_area,
+                                          sell_txt=txt,
+                                          sell_portfolio_id=transfer.sell_portfolio_id,
+                                          sell_aggressor_indicator="Y",
+                                          contract_id=transfer.contract_id,
+                                          price=transfer.price,
+                                          quantity=transfer.quantity)
+
+        for attempt in range(self.max_retries + 1):
+            try:
+                transfer.trade = self.trades_api.add_internal_trade(internal_trade)
+                transfer.error = None
+                self.__booked.add(transfer.key)
+                return True
+            except ApiException as exception:
+                transfer.error = exception
+                if exception.status is not None and 400 <= exception.status < 500 and exception.status not in (408, 429):
+                    # The request is invalid, a retry would not change the result.
+                    LOGGER.error(f"{transfer} has been rejected: {exception.status} {exception.reason}")
+                    return False
+            except Exception as e:
+                transfer.error = e
+
+            if attempt < self.max_retries:
+                time.sleep(min(2 ** attempt, 10))
+                # The failed request might have been booked nevertheless (e.g. a timeout after the server processed it).
+                if transfer.key in self.existing_keys({transfer.buy_portfolio_id}, transfer.delivery_start, transfer.delivery_end):
+                    self.__booked.add(transfer.key)
+                    return True
+
+        LOGGER.error(f"{transfer} failed after {self.max_retries + 1} attempts: {transfer.error}")
+        return False
@@ -0,0 +1,372 @@
+"""
+Powerbot order manager helpers
+(c) 2020 PowerBot GmbH
+
+Order lifecycle tracking with client order ids. Every order entry is tagged with a client id in the JSON of its txt field
+and tracked through PENDING -> ACTIVE -> PARTIAL -> FILLED/DELETED/REJECTED from the api responses and order events.
+This answers "what do I have working on contract X" from memory instead of fetching the own orders every cycle.
+"""
+
+import json
+import logging
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from swagger_client.models import OrderModify
+from swagger_client.rest import ApiException
+from helpers.event_helper import get_field, get_order_side
+
+PENDING = "PENDING"
+ACTIVE = "ACTIVE"
+PARTIAL = "PARTIAL"
+FILLED = "FILLED"
+DELETED = "DELETED"
+REJECTED = "REJECTED"
+
+WORKING = (PENDING, ACTIVE, PARTIAL)
+
+# Exchange order states in which an order can still be executed.
+EXCHANGE_WORKING_STATES = ("ACTI", "IACT", "HIBE")
+
+LOGGER = logging.getLogger("OrderManager")
+
+
+class ManagedOrder:
+    """
+    An order sent by the order manager.
+    """
+
+    __slots__ = ("client_id", "order_id", "revision_no", "state", "contract_id", "delivery_area", "portfolio_id", "side",
+                 "price", "initial_quantity", "remaining_quantity", "updated")
+
+    def __init__(self, client_id, contract_id, delivery_area, portfolio_id, side, price, quantity):
+        self.client_id = client_id
+        self.order_id = None
+        self.revision_no = None
+        self.state = PENDING
+        self.contract_id = contract_id
+        self.delivery_area = delivery_area
+        self.portfolio_id = portfolio_id
+        self.side = side
+        self.price = price
+        self.initial_quantity = quantity
+        self.remaining_quantity = quantity
+        self.updated = time.time()
+
+    @property
+    def executed_quantity(self):
+        return self.initial_quantity - self.remaining_quantity
+
+    def to_tuple(self):
+        return tuple(getattr(self, slot) for slot in self.__slots__)
+
+    @classmethod
+    def from_tuple(cls, values):
+        managed_order = cls.__new__(cls)
+        for slot, value in zip(cls.__slots__, values):
+            setattr(managed_order, slot, value)
+        return managed_order
+
+    def __repr__(self):
+        return (f"ManagedOrder({self.client_id}, {self.state}, {self.side} {self.remaining_quantity}/{self.initial_quantity} "
+                f"@ {self.price}, contract={self.contract_id}, order_id={self.order_id})")
+
+
+def get_client_id(order):
+    """
+    Helper function to retrieve the client id from the JSON stored in an order's txt field.
+    """
+
+    txt = get_field(order, "txt")
+    if txt:
+        try:
+            return json.loads(txt).get("cid")
+        except (ValueError, AttributeError):
+            pass
+    return None
+
+
+class OrderManager:
+    """
+    Tracks all orders of an algorithm by their client id. Other components (e.g. the risk engine or the kill switch)
+    can register in [listeners] to receive every order update processed by the manager.
+    """
+
+    def __init__(self, orders_api, algo_id, history_size=1000):
+        """
+        :param orders_api: OrdersApi object.
+        :param algo_id: ID of the algorithm, stored in the txt field of every order.
+        :param history_size: Number of finished orders that are kept for inspection.
+        """
+
+        self.orders_api = orders_api
+        self.algo_id = algo_id
+        self.listeners = []
+
+        self.__lock = threading.RLock()
+        # {client_id: ManagedOrder} of all working orders
+        self.__orders = {}
+        # {order_id: client_id}
+        self.__order_ids = {}
+        # {(contract_id, delivery_area): set(client_id)}
+        self.__by_contract = {}
+        self.__history = deque(maxlen=history_size)
+        self.__executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="OrderManager")
+
+    def tag(self, order):
+        """
+        Stores a new client id (and the algo id) in the JSON of the order's txt field, keeping the existing values.
+        Orders that have already been tagged by this manager (e.g. before the risk checks) keep their client id.
+
+        :return: The client id.
+        """
+
+        data = {}
+        if order.txt:
+            try:
+                data = json.loads(order.txt)
+            except ValueError:
+                data = {"txt": order.txt}
+            if not isinstance(data, dict):
+                data = {"txt": order.txt}
+            elif data.get("algo_id") == self.algo_id and data.get("cid"):
+                return data["cid"]
+        # Short ids, the txt field of the exchanges is limited in length.
+        client_id = uuid.uuid4().hex[:12]
+        data.update({"cid": client_id, "algo_id": self.algo_id})
+        order.txt = json.dumps(data, separators=(",", ":"))
+        return client_id
+
+    def submit(self, orders, async_req=False):
+        """
+        Tags and sends a batch of new orders (OrderEntry objects) and processes the response.
+
+        :param async_req: Do not wait for the response (add_orders(async_req=True)), it is processed in a background
+                          thread. Until then, the orders are PENDING.
+        :return: List of ManagedOrder objects in the order of the given orders (with async_req, a Future of this list).
+        """
+
+        managed = []
+        with self.__lock:
+            for order in orders:
+                client_id = self.tag(order)
+                managed_order = ManagedOrder(client_id, order.contract_id, order.delivery_area, order.portfolio_id,
+                                             order.side, order.price, order.quantity)
+                self.__orders[client_id] = managed_order
+                self.__by_contract.setdefault((order.contract_id, order.delivery_area), set()).add(client_id)
+                managed.append(managed_order)
+
+        if async_req:
+            # The request is started by the calling thread, so it keeps the caller's priority (see rate_limit_helper), only
+            # its response is awaited and processed in the background.
+            request = self.orders_api.add_orders(orders, async_req=True)
+            future = self.__executor.submit(self.__process, managed, request.get)
+            future.add_done_callback(self.__log_failure)
+            return future
+        return self.__process(managed, lambda: self.orders_api.add_orders(orders))
+
+    @staticmethod
+    def __log_failure(future):
+        if future.exception() is not None:
+            LOGGER.error(f"Sending orders failed: {future.exception()}")
+
+    def __process(self, managed, request):
+        try:
+            response = request()
+        except ApiException:
+            # The whole batch has been rejected by the server.
+            LOGGER.warning(f"Batch of {len(managed)} orders has been rejected.")
+            with self.__lock:
+                for managed_order in managed:
+                    self.__finish(managed_order, REJECTED)
+            raise
+
+        response = response or []
+        for managed_order, own_order in zip(managed, response):
+            if len(response) == len(managed) and get_client_id(own_order) is None:
+                # The response is in the order of the request, in case the txt field is not returned.
+                with self.__lock:
+                    self.__order_ids[get_field(own_order, "order_id")] = managed_order.client_id
+        for own_order in response:
+            self.on_order(own_order)
+        return managed
+
+    def delete(self, managed_order):
+        """
+        Deletes a working order with its current revision number and processes the response.
+        """
+
+        own_order = self.orders_api.modify_order(order_id=managed_order.order_id, revision_no=managed_order.revision_no,
+                                                 modifications=OrderModify(action="DELE"))
+        self.on_order(own_order)
+
+    def on_order(self, order):
+        """
+        Updates the state of a managed order from an own order (REST model, api response or websocket event).
+        Orders that have not been sent by this manager are only passed on to the listeners.
+        """
+
+        with self.__lock:
+            self.__apply(order)
+
+        for listener in self.listeners:
+            listener(order)
+
+    def __apply(self, order):
+        order_id = get_field(order, "order_id")
+        client_id = self.__order_ids.get(order_id) or get_client_id(order)
+        managed_order = self.__orders.get(client_id)
+        if managed_order is None:
+            return
+
+        revision_no = get_field(order, "revision_no")
+        if managed_order.revision_no is not None and revision_no is not None and revision_no < managed_order.revision_no:
+            # Outdated event, e.g. a websocket event that arrived after the api response.
+            return
+
+        managed_order.order_id = order_id
+        managed_order.revision_no = revision_no
+        managed_order.remaining_quantity = get_field(order, "quantity", managed_order.remaining_quantity)
+        managed_order.updated = time.time()
+        self.__order_ids[order_id] = client_id
+
+        state = get_field(order, "state")
+        action = get_field(order, "action", "")
+        if state in EXCHANGE_WORKING_STATES and managed_order.remaining_quantity > 0:
+            managed_order.state = PARTIAL if managed_order.executed_quantity > 0 else ACTIVE
+        elif "REJ" in action or state == "REJE":
+            self.__finish(managed_order, REJECTED)
+        elif "DEL" in action:
+            # Deletions by us (DELE) or by the exchange (e.g. at gate closure).
+            self.__finish(managed_order, DELETED)
+        elif action == "FEXE" or managed_order.remaining_quantity == 0:
+            self.__finish(managed_order, FILLED)
+        else:
+            self.__finish(managed_order, DELETED)
+
+    def adopt(self, own_orders):
+        """
+        Takes over the working orders of this algorithm (identified by the algo id in the txt field), e.g. after a restart.
+        Managed orders which are no longer in the list are considered finished.
+
+        :param own_orders: All own orders, as retrieved with get_own_orders.
+        """
+
+        seen = set()
+        with self.__lock:
+            for order in own_orders:
+                txt = get_field(order, "txt")
+                try:
+                    data = json.loads(txt) if txt else {}
+                except ValueError:
+                    continue
+                if not isinstance(data, dict) or data.get("algo_id") != self.algo_id or "cid" not in data:
+                    continue
+
+                client_id = data["cid"]
+                seen.add(client_id)
+                if client_id not in self.__orders:
+                    quantity = get_field(order, "quantity", 0)
+                    managed_order = ManagedOrder(client_id, get_field(order, "contract_id"), get_field(order, "delivery_area"),
+                                                 get_field(order, "portfolio_id"), get_order_side(order), get_field(order, "price"),
+                                                 get_field(order, "initial_quantity", quantity))
+                    self.__orders[client_id] = managed_order
+                    self.__by_contract.setdefault((managed_order.contract_id, managed_order.delivery_area), set()).add(client_id)
+                self.on_order(order)
+
+            for client_id, managed_order in list(self.__orders.items()):
+                if client_id not in seen and managed_order.state != PENDING:
+                    # Executed or deleted while we were not listening, the own orders do not tell us which of both.
+                    self.__finish(managed_order, FILLED if managed_order.remaining_quantity == 0 else DELETED)
+
+    def checkpoint_state(self):
+        """
+        :return: The working orders as marshallable state for a checkpoint (see checkpoint_helper).
+        """
+
+        with self.__lock:
+            return {"algo_id": self.algo_id, "orders": [o.to_tuple() for o in self.__orders.values()]}
+
+    def restore_state(self, state):
+        """
+        Restores the working orders of a checkpoint. Afterwards, resync() has to be called to fetch the working orders
+        again, which finishes the restored orders that have been executed or deleted since the checkpoint.
+
+        :return: Number of restored orders.
+        """
+
+        if not state or state.get("algo_id") != self.algo_id:
+            return 0
+        restored = 0
+        with self.__lock:
+            for values in state["orders"]:
+                managed_order = ManagedOrder.from_tuple(values)
+                if managed_order.state == PENDING:
+                    # The response to the submission has not been processed, resync() adopts the order if it exists.
+                    continue
+                restored += 1
+                self.__orders[managed_order.client_id] = managed_order
+                if managed_order.order_id is not None:
+                    self.__order_ids[managed_order.order_id] = managed_order.client_id
+                self.__by_contract.setdefault((managed_order.contract_id, managed_order.delivery_area), set()).add(managed_order.client_id)
+        return restored
+
+    def resync(self, portfolio_ids, delivery_area):
+        """
+        Fetches all own orders once (e.g. after a 409 response or a warm restart) and adopts them. This is always a full
+        refetch of the working orders, a restored checkpoint only keeps the client ids and states of the orders that are
+        still working.
+        Maximum limit of orders that can be retrieved with a single request is 500, therefore a loop is used.
+        """
+
+        all_own_orders = []
+        offset = 0
+        more_orders = True
+        while more_orders:
+            own_orders = self.orders_api.get_own_orders(portfolio_id=portfolio_ids, delivery_area=delivery_area, offset=offset, limit=500)
+            all_own_orders.extend(own_orders)
+            offset += 500
+            more_orders = len(own_orders) == 500
+        self.adopt(all_own_orders)
+
+    def get(self, client_id):
+        return self.__orders.get(client_id)
+
+    def working(self, contract_id=None, delivery_area=None):
+        """
+        :return: List of working (pending, active or partially executed) orders, optionally for a single contract.
+        """
+
+        with self.__lock:
+            if contract_id is None:
+                return [o for o in self.__orders.values() if delivery_area is None or o.delivery_area == delivery_area]
+            keys = [(contract_id, delivery_area)] if delivery_area else [key for key in self.__by_contract if key[0] == contract_id]
+            return [self.__orders[client_id] for key in keys for client_id in self.__by_contract.get(key, ())]
+
+    def working_quantity(self, contract_id, delivery_area):
+        """
+        :return: Signed remaining quantity of all working orders for the contract (BUY positive, SELL negative).
+        """
+
+        return sum(o.remaining_quantity if o.side == "BUY" else -o.remaining_quantity for o in self.working(contract_id, delivery_area))
+
+    @property
+    def history(self):
+        """
+        The most recently finished orders.
+        """
+        return list(self.__history)
+
+    def __finish(self, managed_order, state):
+        managed_order.state = state
+        self.__orders.pop(managed_order.client_id, None)
+        if managed_order.order_id is not None:
+            self.__order_ids.pop(managed_order.order_id, None)
+        client_ids = self.__by_contract.get((managed_order.contract_id, managed_order.delivery_area))
+        if client_ids:
+            client_ids.discard(managed_order.client_id)
+            if not client_ids:
+                del self.__by_contract[(managed_order.contract_id, managed_order.delivery_area)]
+        self.__history.append(managed_order)
@@ -0,0 +1,248 @@
+"""
+Powerbot OTR helpers
+(c) 2020 PowerBot GmbH
+
+Local order-to-trade ratio (OTR) tracking. The exchange_otr of a contract is only as fresh as the last order book request,
+therefore our own order entries, modifications and deletions as well as our trades are counted the moment they happen.
+The counters are re-based on the exchange_otr with every order book, the local counts only cover the actions since then.
+This allows to project the OTR impact of a planned batch before sending it and to select the modifications that fit.
+
+Only exchange trades count towards the OTR of the exchange, internal trades between portfolios are ignored. The counters
+of contracts whose delivery has ended are removed automatically.
+"""
+
+import threading
+import time
+from helpers.event_helper import get_field, get_timestamp, get_trade_legs
+
+ENTRY = "entries"
+MODIFICATION = "modifications"
+DELETION = "deletions"
+
+
+class OtrCounter:
+    """
+    Order actions and trades of a single contract in a single delivery area.
+    """
+
+    __slots__ = ("entries", "modifications", "deletions", "trade_ids", "delivery_end", "updated")
+
+    def __init__(self):
+        self.entries = 0
+        self.modifications = 0
+        self.deletions = 0
+        # Ids of the own trades, trades might be received via REST and websocket.
+        self.trade_ids = set()
+        # Seconds since the epoch (0.0 while unknown) and time of the last update, used for the expiry.
+        self.delivery_end = 0.0
+        self.updated = time.time()
+
+    @property
+    def trades(self):
+        return len(self.trade_ids)
+
+    @property
+    def actions(self):
+        return self.entries + self.modifications + self.deletions
+
+    @property
+    def otr(self):
+        # Without any trade, every order action counts fully (same as the exchange does).
+        return self.actions / max(self.trades, 1)
+
+
+class OtrTracker:
+    """
+    Counts order actions and trades per (contract_id, delivery_area).
+    """
+
+    def __init__(self, portfolio_ids=None, retention=3600, idle_retention=86400):
+        """
+        :param portfolio_ids: If set, only trades of these portfolios are counted.
+        :param retention: Seconds after the delivery end of a contract after which its counter is removed.
+        :param idle_retention: Seconds after which counters of contracts with unknown delivery end are removed, if they
+                               have not been updated in the meantime.
+        """
+
+        self.portfolio_ids = set(portfolio_ids) if portfolio_ids else None
+        self.retention = retention
+        self.idle_retention = idle_retention
+        self.__lock = threading.Lock()
+        self.__counters = {}
+        # Trades of contracts whose delivery ended at or before this time (seconds since the epoch) have been removed
+        # and are not counted again, e.g. by update_trades.
+        self.__expired_until = 0.0
+        # The expired counters are removed by sync and on_trade once a minute.
+        self.__next_expiry = 0.0
+
+    def __counter(self, contract_id, delivery_area, delivery_end=0.0):
+        key = (contract_id, delivery_area)
+        counter = self.__counters.get(key)
+        if counter is None:
+            counter = self.__counters.setdefault(key, OtrCounter())
+        if delivery_end:
+            counter.delivery_end = delivery_end
+        counter.updated = time.time()
+        return counter
+
+    def __expire_periodically(self):
+        now = time.time()
+        if now >= self.__next_expiry:
+            self.__next_expiry = now + 60
+            self.expire(now)
+
+    def expire(self, now=None):
+        """
+        Removes the counters of contracts whose delivery ended more than [retention] seconds ago and of contracts with
+        unknown delivery end that have not been updated for [idle_retention] seconds. Called automatically once a minute.
+
+        :param now: Seconds since the epoch (defaults to the current time).
+        :return: Number of removed counters.
+        """
+
+        now = time.time() if now is None else now
+        horizon = now - self.retention
+        with self.__lock:
+            expired = [key for key, counter in self.__counters.items()
+                       if (counter.delivery_end and counter.delivery_end < horizon)
+                       or (not counter.delivery_end and counter.updated < now - self.idle_retention)]
+            for key in expired:
+                counter = self.__counters.pop(key)
+                self.__expired_until = max(self.__expired_until, counter.delivery_end)
+        return len(expired)
+
+    def sync(self, contract_id, delivery_area, exchange_otr, delivery_end=None):
+        """
+        Re-bases the local counter on the OTR reported by the exchange (e.g. contract.exchange_otr of the order book), which
+        should be called right after the order book has been requested. Afterwards, the counter contains the actions
+        implied by the exchange_otr and the own trades, and the actions recorded from now on.
+
+        :param delivery_end: Delivery end of the contract (datetime or ISO 8601 string), used for the expiry of the counter.
+        :return: The OTR after the synchronisation.
+        """
+
+        self.__expire_periodically()
+        with self.__lock:
+            counter = self.__counter(contract_id, delivery_area, get_timestamp(delivery_end))
+            if exchange_otr is not None:
+                # Attribute all actions to entries, which is all that matters for the ratio.
+                counter.entries = exchange_otr * max(counter.trades, 1)
+                counter.modifications = 0
+                counter.deletions = 0
+            return counter.otr
+
+    def record(self, contract_id, delivery_area, action, count=1):
+        """
+        Records order actions that have been sent to the exchange.
+
+        :param action: One of ENTRY, MODIFICATION or DELETION.
+        :param count: Number of actions.
+        """
+
+        with self.__lock:
+            counter = self.__counter(contract_id, delivery_area)
+            setattr(counter, action, getattr(counter, action) + count)
+
+    def record_orders(self, orders):
+        """
+        Records a batch of new orders (OrderEntry objects) that has been sent with add_orders.
+        """
+
+        with self.__lock:
+            for order in orders:
+                self.__counter(order.contract_id, order.delivery_area).entries += 1
+
+    def on_trade(self, trade):
+        """
+        Counts an own exchange trade (REST model or websocket event) once per leg. Internal trades between portfolios do
+        not count towards the OTR of the exchange and trades that have already been counted are ignored.
+
+        :return: True if the trade has been counted.
+        """
+
+        trade_id = get_field(trade, "trade_id")
+        if trade_id is None or get_field(trade, "internal_trade_id") is not None:
+            return False
+        delivery_end = get_timestamp(get_field(trade, "delivery_end"))
+        self.__expire_periodically()
+
+        contract_id = get_field(trade, "contract_id")
+        counted = False
+        with self.__lock:
+            if delivery_end and delivery_end <= self.__expired_until:
+                # The counter of the contract has already been removed.
+                return False
+            for portfolio_id, delivery_area, side in get_trade_legs(trade):
+                if self.portfolio_ids is None or portfolio_id in self.portfolio_ids:
+                    trade_ids = self.__counter(contract_id, delivery_area, delivery_end).trade_ids
+                    # Both legs of a trade between two own portfolios are counted.
+                    leg = (trade_id, portfolio_id, side)
+                    if leg not in trade_ids:
+                        trade_ids.add(leg)
+                        counted = True
+        return counted
+
+    def update_trades(self, trades_api, page_size=500, **filters):
+        """
+        Counts the own trades that have not been counted yet. Paging stops at the first page without new trades, which
+        relies on the trades being returned newest first.
+        Maximum limit of trades that can be retrieved with a single request is 500, therefore a loop is used.
+
+        :param trades_api: TradesApi object.
+        :param filters: Further filters passed to get_trades (e.g. portfolio_id).
+        :return: Number of newly counted trades.
+        """
+
+        if self.portfolio_ids:
+            filters.setdefault("portfolio_id", list(self.portfolio_ids))
+        counted = 0
+        offset = 0
+        more_trades = True
+        while more_trades:
+            trades = trades_api.get_trades(offset=offset, limit=page_size, **filters)
+            new_trades = sum(self.on_trade(trade) for trade in trades)
+            counted += new_trades
+            offset += page_size
+            more_trades = len(trades) == page_size and new_trades > 0
+        return counted
+
+    def otr(self, contract_id, delivery_area):
+        counter = self.__counters.get((contract_id, delivery_area))
+        return counter.otr if counter else 0
+
+    def projected_otr(self, contract_id, delivery_area, entries=0, modifications=0, deletions=0):
+        """
+        :return: The OTR after the given number of order actions would have been sent.
+        """
+
+        counter = self.__counters.get((contract_id, delivery_area)) or OtrCounter()
+        return (counter.actions + entries + modifications + deletions) / max(counter.trades, 1)
+
+    def headroom(self, contract_id, delivery_area, otr_limit):
+        """
+        :return: Number of order actions that can still be sent without exceeding the OTR limit.
+        """
+
+        counter = self.__counters.get((contract_id, delivery_area)) or OtrCounter()
+        return max(int(otr_limit * max(counter.trades, 1) - counter.actions), 0)
+
+    def select_within_limit(self, contract_id, delivery_area, otr_limit, candidates, actions=lambda candidate: 1):
+        """
+        Selects the candidates (ordered by priority) that can be sent without exceeding the OTR limit.
+
+        :param candidates: List of planned modifications, most important first.
+        :param actions: Function returning the number of order actions a candidate causes (e.g. 2 for delete + new entry).
+        :return: Tuple(selected, skipped)
+        """
+
+        remaining = self.headroom(contract_id, delivery_area, otr_limit)
+        selected = []
+        skipped = []
+        for candidate in candidates:
+            cost = actions(candidate)
+            if cost <= remaining:
+                selected.append(candidate)
+                remaining -= cost
+            else:
+                skipped.append(candidate)
+        return selected, skipped
@@ -0,0 +1,266 @@
+"""
+Powerbot position helpers
+(c) 2020 PowerBot GmbH
+
+In-memory position and PnL book per (portfolio_id, contract_id, delivery_area). The book is bootstrapped once from the
+(paginated) trade history and afterwards updated incrementally from own trade events, so strategies can size their
+orders off the current position without downloading the order book or the trade history again.
+"""
+
+import threading
+import time
+from helpers.event_helper import get_field, get_timestamp, get_trade_legs
+
+
+class Position:
+    """
+    Position of a portfolio in a single contract and delivery area. The realized PnL is calculated with the average cost method.
+    """
+
+    __slots__ = ("net_pos", "abs_pos", "buy_quantity", "sell_quantity", "buy_value", "sell_value", "avg_price", "realized_pnl")
+
+    def __init__(self, net_pos=0, abs_pos=0):
+        self.net_pos = net_pos
+        self.abs_pos = abs_pos
+        self.buy_quantity = 0
+        self.sell_quantity = 0
+        self.buy_value = 0
+        self.sell_value = 0
+        self.avg_price = 0
+        self.realized_pnl = 0
+
+    def apply(self, side, quantity, price):
+        signed_quantity = quantity if side == "BUY" else -quantity
+
+        if side == "BUY":
+            self.buy_quantity += quantity
+            self.buy_value += quantity * price
+        else:
+            self.sell_quantity += quantity
+            self.sell_value += quantity * price
+
+        if self.net_pos == 0 or (self.net_pos > 0) == (signed_quantity > 0):
+            # Opening or increasing the position -> update the average price.
+            self.avg_price = (self.avg_price * abs(self.net_pos) + price * quantity) / (abs(self.net_pos) + quantity)
+        else:
+            # Reducing the position -> realize the PnL of the closed quantity.
+            closed = min(quantity, abs(self.net_pos))
+            self.realized_pnl += closed * (price - self.avg_price) * (1 if self.net_pos > 0 else -1)
+            if quantity > closed:
+                # The position flipped its direction, the remaining quantity was opened at the trade price.
+                self.avg_price = price
+
+        self.net_pos += signed_quantity
+        self.abs_pos += quantity
+        if self.net_pos == 0:
+            self.avg_price = 0
+
+    @property
+    def cash(self):
+        """
+        Cash balance of all trades (sell proceeds - buy costs).
+        """
+        return self.sell_value - self.buy_value
+
+    def unrealized_pnl(self, mark_price):
+        """
+        :param mark_price: Current price of the contract, e.g. the last price or the mid price of the order book.
+        """
+        return (mark_price - self.avg_price) * self.net_pos
+
+    def to_tuple(self):
+        return tuple(getattr(self, slot) for slot in self.__slots__)
+
+    @classmethod
+    def from_tuple(cls, values):
+        position = cls()
+        for slot, value in zip(cls.__slots__, values):
+            setattr(position, slot, value)
+        return position
+
+
+class PositionBook:
+    """
+    Positions of all portfolios, contracts and delivery areas. Lookups are plain dictionary accesses.
+    """
+
+    def __init__(self, portfolio_ids=None, retention=3600):
+        """
+        :param portfolio_ids: If set, only legs of these portfolios are booked.
+        :param retention: Seconds after the delivery end of a contract after which the ids of its trades are forgotten.
+                          Afterwards, trades of contracts up to the latest forgotten delivery end (e.g. from a repeated
+                          bootstrap) are considered already booked.
+        """
+
+        self.portfolio_ids = set(portfolio_ids) if portfolio_ids else None
+        self.retention = retention
+        self.__lock = threading.Lock()
+        # {(portfolio_id, contract_id, delivery_area): Position}
+        self.__positions = {}
+        # {portfolio_id: cash balance}
+        self.__cash = {}
+        # Trade ids that have already been booked per delivery end, trades might be received via REST and websocket.
+        # {delivery_end (seconds since the epoch): set((internal, trade_id))}
+        self.__trade_ids = {}
+        # Trades up to this delivery end have all been booked (their ids have been forgotten).
+        self.__expired_until = 0.0
+        # The expired trade ids are removed by on_trade once a minute.
+        self.__next_expiry = 0.0
+
+    def bootstrap(self, trades_api, page_size=500, delta=False, **filters):
+        """
+        Books the full trade history (exchange and internal trades) of the portfolios once.
+        Maximum limit of trades that can be retrieved with a single request is 500, therefore a loop is used.
+
+        :param trades_api: TradesApi object.
+        :param page_size: Number of trades per request.
+        :param delta: Stop paging as soon as a page contains only trades that have already been booked, e.g. after
+                      restoring a checkpoint. This relies on the trades being returned newest first.
+        :param filters: Further filters passed to get_trades/get_internal_trades (e.g. delivery_within_start).
+        :return: Number of booked trades.
+        """
+
+        if self.portfolio_ids:
+            filters.setdefault("portfolio_id", list(self.portfolio_ids))
+
+        booked = 0
+        for fetch in (trades_api.get_trades, trades_api.get_internal_trades):
+            offset = 0
+            more_trades = True
+            while more_trades:
+                trades = fetch(offset=offset, limit=page_size, **filters)
+                new_trades = sum(self.on_trade(trade) for trade in trades)
+                booked += new_trades
+                offset += page_size
+                more_trades = len(trades) == page_size and (new_trades > 0 or not delta)
+        return booked
+
+    def on_trade(self, trade):
+        """
+        Books an own trade (REST model or websocket event). Trades that have already been booked are ignored.
+
+        :param trade: Trade or InternalTrade. The ids of internal trades (internal_trade_id) are independent of the
+                      exchange trade ids (trade_id), REST models and websocket events of the same trade have the same key.
+        :return: True if the trade has been booked.
+        """
+
+        internal_trade_id = get_field(trade, "internal_trade_id")
+        trade_key = (True, internal_trade_id) if internal_trade_id is not None else (False, get_field(trade, "trade_id"))
+        delivery_end = get_timestamp(get_field(trade, "delivery_end"))
+        contract_id = get_field(trade, "contract_id")
+        quantity = get_field(trade, "quantity", 0)
+        price = get_field(trade, "price", 0)
+
+        now = time.time()
+        if now >= self.__next_expiry:
+            self.__next_expiry = now + 60
+            self.expire(now)
+
+        with self.__lock:
+            if trade_key[1] is not None:
+                if delivery_end and delivery_end <= self.__expired_until:
+                    return False
+                trade_ids = self.__trade_ids.setdefault(delivery_end, set())
+                if trade_key in trade_ids:
+                    return False
+                trade_ids.add(trade_key)
+
+            for portfolio_id, delivery_area, side in get_trade_legs(trade):
+                if self.portfolio_ids is not None and portfolio_id not in self.portfolio_ids:
+                    continue
+                key = (portfolio_id, contract_id, delivery_area)
+                position = self.__positions.get(key)
+                if position is None:
+                    position = self.__positions[key] = Position()
+                position.apply(side, quantity, price)
+                self.__cash[portfolio_id] = self.__cash.get(portfolio_id, 0) + (quantity * price if side == "SELL" else -quantity * price)
+        return True
+
+    def set_position(self, portfolio_id, contract_id, delivery_area, net_pos, abs_pos, avg_price=None):
+        """
+        Overrides net and absolute position, e.g. with the portfolio information of an order book.
+
+        :param avg_price: Average price of the new position. If it is not given and the net position changed, the average
+                          price of the booked trades no longer applies: it is reset to 0 (unknown) and the unrealized PnL
+                          is only meaningful again after the position has been closed or set with its average price.
+        """
+
+        with self.__lock:
+            position = self.__positions.get((portfolio_id, contract_id, delivery_area))
+            if position is None:
+                position = self.__positions[(portfolio_id, contract_id, delivery_area)] = Position()
+            if avg_price is not None:
+                position.avg_price = avg_price if net_pos else 0
+            elif net_pos != position.net_pos:
+                position.avg_price = 0
+            position.net_pos = net_pos
+            position.abs_pos = abs_pos
+
+    def expire(self, now=None):
+        """
+        Forgets the ids of the trades of contracts whose delivery ended more than [retention] seconds ago, so the set of
+        booked trade ids does not grow with every delivery period. The positions are kept.
+
+        :param now: Seconds since the epoch (defaults to the current time).
+        :return: Number of forgotten trade ids.
+        """
+
+        horizon = (time.time() if now is None else now) - self.retention
+        with self.__lock:
+            expired = [delivery_end for delivery_end in self.__trade_ids if delivery_end and delivery_end < horizon]
+            forgotten = sum(len(self.__trade_ids.pop(delivery_end)) for delivery_end in expired)
+            self.__expired_until = max([self.__expired_until] + expired)
+        return forgotten
+
+    def get(self, portfolio_id, contract_id, delivery_area):
+        """
+        :return: The Position object or None, if there are no trades yet.
+        """
+        return self.__positions.get((portfolio_id, contract_id, delivery_area))
+
+    def net_pos(self, portfolio_id, contract_id, delivery_area):
+        position = self.__positions.get((portfolio_id, contract_id, delivery_area))
+        return position.net_pos if position else 0
+
+    def abs_pos(self, portfolio_id, contract_id, delivery_area):
+        position = self.__positions.get((portfolio_id, contract_id, delivery_area))
+        return position.abs_pos if position else 0
+
+    def cash(self, portfolio_id):
+        return self.__cash.get(portfolio_id, 0)
+
+    def checkpoint_state(self):
+        """
+        :return: Positions, cash balances and booked trade ids as marshallable state for a checkpoint (see checkpoint_helper).
+        """
+
+        with self.__lock:
+            return {"positions": [key + position.to_tuple() for key, position in self.__positions.items()],
+                    "cash": dict(self.__cash),
+                    "trade_ids": [(delivery_end,) + trade_key for delivery_end, trade_ids in self.__trade_ids.items()
+                                  for trade_key in trade_ids],
+                    "expired_until": self.__expired_until}
+
+    def restore_state(self, state):
+        """
+        Restores the book from a checkpoint. Afterwards, bootstrap(trades_api, delta=True) books the trades since then.
+        """
+
+        if not state:
+            return
+        with self.__lock:
+            self.__positions = {tuple(values[:3]): Position.from_tuple(values[3:]) for values in state["positions"]}
+            self.__cash = dict(state["cash"])
+            self.__trade_ids = {}
+            for delivery_end, internal, trade_id in state["trade_ids"]:
+                self.__trade_ids.setdefault(delivery_end, set()).add((internal, trade_id))
+            self.__expired_until = state.get("expired_until", 0.0)
+
+    def snapshot(self):
+        """
+        :return: Dictionary {(portfolio_id, contract_id, delivery_area): tuple of the Position slots}. The tuples are
+                 immutable copies, i.e. the snapshot is not affected by later trades.
+        """
+
+        with self.__lock:
+            return {key: position.to_tuple() for key, position in self.__positions.items()}
@@ -0,0 +1,216 @@
+"""
+Powerbot rate limit helpers
+(c) 2020 PowerBot GmbH
+
+Client side token bucket rate limiter with priority classes. Cancellations and aggressor orders are served before order
+entries, reads and bulk requests (signal uploads, history downloads), and the rate adapts automatically to 429/503 responses.
+"""
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from swagger_client import ApiClient
+from swagger_client.rest import ApiException
+
+# Priority classes, lower values are served first.
+CRITICAL = 0
+HIGH = 1
+NORMAL = 2
+BULK = 3
+
+LOGGER = logging.getLogger("RateLimiter")
+
+# Requests that can be sent again without side effects, if the server was unavailable (503).
+IDEMPOTENT_METHODS = ("GET", "HEAD", "OPTIONS", "PUT", "DELETE")
+
+
+class PriorityRateLimiter:
+    """
+    Token bucket shared by all priority classes. Waiting requests are served strictly by priority (FIFO within a class)
+    and a reserve of tokens can only be used by CRITICAL requests, so bulk traffic can never exhaust the whole bucket.
+
+    The rate is adapted with additive increase / multiplicative decrease: every throttled response (429/503) reduces it,
+    every successful request slowly increases it again up to max_rate.
+    """
+
+    def __init__(self, rate=20.0, burst=20, critical_reserve=5, min_rate=1.0, max_rate=None, decrease_factor=0.5, increase_step=0.1):
+        """
+        :param rate: Initial number of requests per second.
+        :param burst: Maximum number of tokens in the bucket.
+        :param critical_reserve: Number of tokens that only CRITICAL requests can use.
+        :param min_rate: The rate is never decreased below this value.
+        :param max_rate: The rate is never increased above this value (defaults to the initial rate).
+        :param decrease_factor: Factor applied to the rate after a throttled response.
+        :param increase_step: Requests per second added to the rate after each successful request.
+        """
+
+        self.rate = rate
+        self.burst = burst
+        self.critical_reserve = min(critical_reserve, burst - 1)
+        self.min_rate = min_rate
+        self.max_rate = max_rate or rate
+        self.decrease_factor = decrease_factor
+        self.increase_step = increase_step
+
+        self.__condition = threading.Condition()
+        self.__tokens = float(burst)
+        self.__updated = time.monotonic()
+        self.__blocked_until = 0
+        self.__waiters = []
+        self.__sequence = itertools.count()
+
+    def __refill(self, now):
+        self.__tokens = min(self.burst, self.__tokens + (now - self.__updated) * self.rate)
+        self.__updated = now
+
+    def acquire(self, priority=NORMAL, timeout=None):
+        """
+        Blocks until a token is available for the given priority.
+
+        :param priority: CRITICAL, HIGH, NORMAL or BULK
+        :param timeout: Maximum time to wait in seconds (None waits forever).
+        :return: True if a token was acquired, False on timeout.
+        """
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        waiter = (priority, next(self.__sequence))
+
+        with self.__condition:
+            heapq.heappush(self.__waiters, waiter)
+            try:
+                while True:
+                    now = time.monotonic()
+                    self.__refill(now)
+                    required = 1 if priority == CRITICAL else 1 + self.critical_reserve
+
+                    if self.__waiters[0] == waiter and now >= self.__blocked_until and self.__tokens >= required:
+                        self.__tokens -= 1
+                        return True
+
+                    if deadline is not None and now >= deadline:
+                        return False
+
+                    # Wait until enough tokens have been refilled (or the throttling period has passed).
+                    wait = max((required - self.__tokens) / self.rate, self.__blocked_until - now, 0.001)
+                    if deadline is not None:
+                        wait = min(wait, deadline - now)
+                    self.__condition.wait(wait)
+            finally:
+                self.__waiters.remove(waiter)
+                heapq.heapify(self.__waiters)
+                self.__condition.notify_all()
+
+    def on_success(self):
+        with self.__condition:
+            self.rate = min(self.max_rate, self.rate + self.increase_step)
+
+    def on_throttled(self, retry_after=None):
+        """
+        Reduces the rate after a 429/503 response and pauses all requests for [retry_after] seconds.
+        """
+
+        with self.__condition:
+            self.rate = max(self.min_rate, self.rate * self.decrease_factor)
+            if retry_after:
+                self.__blocked_until = max(self.__blocked_until, time.monotonic() + retry_after)
+            self.__condition.notify_all()
+        LOGGER.warning(f"Request throttled by the server, reduced rate to {self.rate:.1f}/s (retry after: {retry_after}).")
+
+
+def classify_request(resource_path, method, body):
+    """
+    Default classification of a REST call into a priority class.
+
+    :return: CRITICAL for deletions, HIGH for other order actions, BULK for signals, trades and history downloads and
+             NORMAL for all other requests.
+    """
+
+    if method == "DELETE":
+        return CRITICAL
+    if resource_path.startswith("/orders") and method != "GET":
+        # OrderModify (modify_order) or a list of OrderModifyItem (modify_orders).
+        items = body if isinstance(body, list) else [body]
+        actions = [getattr(getattr(item, "changes", item), "action", None) for item in items]
+        if actions and all(action == "DELE" for action in actions):
+            return CRITICAL
+        return HIGH
+    if resource_path.startswith("/signals") or resource_path.startswith("/trades") or "history" in resource_path:
+        return BULK
+    return NORMAL
+
+
+class RateLimitedApiClient(ApiClient):
+    """
+    ApiClient which passes every REST call through a PriorityRateLimiter. Throttled calls (429) are retried after the
+    Retry-After period. A 503 response reduces the rate as well, but only idempotent calls are retried: a POST or PATCH
+    (e.g. an order entry) might have been processed nonetheless, so the exception is raised and the caller has to resync
+    its orders before acting again.
+
+    The priority of a call is determined by classify_request or can be set explicitly for the current thread:
+
+        with client.priority(CRITICAL):
+            orders_api.add_orders(aggressor_orders)
+    """
+
+    def __init__(self, configuration=None, limiter=None, max_retries=3, **kwargs):
+        super().__init__(configuration, **kwargs)
+        self.limiter = limiter or PriorityRateLimiter()
+        self.max_retries = max_retries
+        self.__local = threading.local()
+
+    @contextmanager
+    def priority(self, priority):
+        """
+        Overrides the priority of all calls (also async_req=True calls) made by the current thread within the context.
+        """
+
+        previous = getattr(self.__local, "priority", None)
+        self.__local.priority = priority
+        try:
+            yield
+        finally:
+            self.__local.priority = previous
+
+    def call_api(self, *args, **kwargs):
+        priority = getattr(self.__local, "priority", None)
+        if priority is None or not kwargs.get("async_req"):
+            return super().call_api(*args, **kwargs)
+        # The thread pool of async requests does not see the priority of the calling thread, so it is passed along.
+        kwargs["async_req"] = False
+        return self.pool.apply_async(self.__call_with_priority, (priority, args, kwargs))
+
+    def __call_with_priority(self, priority, args, kwargs):
+        with self.priority(priority):
+            return super().call_api(*args, **kwargs)
+
+    def _ApiClient__call_api(self, resource_path, method, path_params=None, query_params=None, header_params=None, body=None, *args, **kwargs):
+        priority = getattr(self.__local, "priority", None)
+        if priority is None:
+            priority = classify_request(resource_path, method, body)
+
+        retries = 0
+        while True:
+            self.limiter.acquire(priority)
+            try:
+                result = super()._ApiClient__call_api(resource_path, method, path_params, query_params, header_params, body, *args, **kwargs)
+                self.limiter.on_success()
+                return result
+            except ApiException as exception:
+                if exception.status not in (429, 503):
+                    raise
+                self.limiter.on_throttled(self.__retry_after(exception))
+                if retries >= self.max_retries or (exception.status == 503 and method not in IDEMPOTENT_METHODS):
+                    raise
+                retries += 1
+
+    @staticmethod
+    def __retry_after(exception):
+        headers = exception.headers or {}
+        try:
+            return float(headers.get("Retry-After"))
+        except (TypeError, ValueError):
+            # Retry-After might also be a http date, in this case we only rely on the reduced rate.
+            return 1.0
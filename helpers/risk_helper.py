@@ -0,0 +1,297 @@
+"""
+Powerbot risk management helpers
+(c) 2020 PowerBot GmbH
+
+Local pre-trade risk checks. The risk management settings of the portfolios (and optionally of the tenant) are loaded once,
+positions and working orders are updated incrementally from trades and order events. Every outgoing batch of orders is
+checked against the position and cash limits before it is sent, so violating orders are trimmed or rejected locally
+instead of costing a full round trip to the server.
+"""
+
+import logging
+import math
+import threading
+from helpers.event_helper import get_field, get_order_side
+from helpers.order_manager_helper import get_client_id
+from helpers.position_helper import PositionBook
+
+# Order states in which an order still can be executed and therefore counts towards the worst case position.
+WORKING_STATES = ("ACTI", "IACT", "HIBE")
+
+LOGGER = logging.getLogger("PreTradeRiskEngine")
+
+
+class PreTradeRiskEngine:
+    """
+    Keeps the net/absolute position, cash balance and working orders per (portfolio_id, contract_id, delivery_area) and
+    checks new orders against the worst case position, i.e. assuming that all working orders are executed.
+    """
+
+    def __init__(self, portfolio_ids, tenant_id=None, quantity_step=0.1, position_book=None):
+        """
+        :param portfolio_ids: List of portfolios whose orders are checked.
+        :param tenant_id: If set, the risk limits of the tenant are checked against the sum of all portfolios.
+        :param quantity_step: Orders are trimmed to multiples of this quantity (EPEX requires 0.1 MW).
+        :param position_book: PositionBook shared with the strategy. Trades are only booked once, even if both feed it.
+        """
+
+        self.portfolio_ids = set(portfolio_ids)
+        self.tenant_id = tenant_id
+        self.quantity_step = quantity_step
+
+        self.__lock = threading.RLock()
+        # {portfolio_id or tenant_id: RiskManagementSettings}
+        self.__settings = {}
+        self.position_book = position_book or PositionBook(portfolio_ids)
+        # {order_id or ("client", client id): (key, side, quantity, price)}
+        self.__orders = {}
+        # {key: [working buy quantity, working sell quantity, number of working orders]}
+        self.__working = {}
+        # {portfolio_id: value of all working buy orders}
+        self.__working_buy_value = {}
+
+    def load(self, portfolios_api, tenants_api=None):
+        """
+        Loads the risk management settings of all portfolios (and the tenant) once.
+
+        :param portfolios_api: PortfoliosApi object.
+        :param tenants_api: TenantsApi object, only required if a tenant_id was specified.
+        """
+
+        settings = {portfolio_id: portfolios_api.get_portfolio_risk_management_settings(id=portfolio_id) for portfolio_id in self.portfolio_ids}
+        if self.tenant_id and tenants_api:
+            settings[self.tenant_id] = tenants_api.get_tenant_risk_management(id=self.tenant_id)
+        self.set_settings(settings)
+
+    def set_settings(self, settings):
+        """
+        :param settings: Dictionary {portfolio_id or tenant_id: RiskManagementSettings}
+        """
+
+        with self.__lock:
+            self.__settings = dict(settings)
+
+    def otr_limit(self, delivery_area, portfolio_id=None):
+        """
+        :return: The strictest OTR limit for the delivery area of the given portfolio (and the tenant) or None if there is no limit.
+        """
+
+        limits = [otr.otr_limit for owner in self.__owners(portfolio_id) for otr in (get_field(self.__settings.get(owner), "otr_limits", []))
+                  if otr.delivery_area == delivery_area]
+        return min(limits) if limits else None
+
+    def seed_from_order_book(self, order_book, delivery_area):
+        """
+        Sets the positions of all contracts in the order book from their portfolio information.
+
+        :param order_book: OrderBook object retrieved with get_order_books(portfolio_id=[...]).
+        :param delivery_area: The delivery area of the order book.
+        """
+
+        for contract in order_book.contracts:
+            for info in contract.portfolio_information or []:
+                if info.portfolio_id in self.portfolio_ids:
+                    self.position_book.set_position(info.portfolio_id, contract.contract_id, delivery_area, info.net_pos or 0, info.abs_pos or 0)
+
+    def seed_orders(self, own_orders):
+        """
+        Replaces all working orders, e.g. with the orders retrieved via get_own_orders.
+        """
+
+        with self.__lock:
+            self.__orders.clear()
+            self.__working.clear()
+            self.__working_buy_value.clear()
+            for order in own_orders:
+                self.on_order(order)
+
+    def on_trade(self, trade):
+        """
+        Updates positions and cash balance from an own trade (REST model or websocket event).
+        """
+
+        self.position_book.on_trade(trade)
+
+    def update_trades(self, trades_api, delta=True, **filters):
+        """
+        Books the own trades (exchange and internal trades) that have not been booked yet, see PositionBook.bootstrap.
+
+        :param delta: Stop paging at the first page without new trades. The first call should load the whole period
+                      relevant for the cash limits instead (delta=False with e.g. delivery_within_start).
+        :return: Number of booked trades.
+        """
+
+        return self.position_book.bootstrap(trades_api, delta=delta, **filters)
+
+    def on_order(self, order):
+        """
+        Updates the working orders from an own order (REST model, add_orders response or websocket event).
+        """
+
+        portfolio_id = get_field(order, "portfolio_id")
+        if portfolio_id not in self.portfolio_ids:
+            return
+
+        order_id = get_field(order, "order_id")
+        key = (portfolio_id, get_field(order, "contract_id"), get_field(order, "delivery_area"))
+        quantity = get_field(order, "quantity", 0)
+        working = get_field(order, "state") in WORKING_STATES and quantity > 0
+
+        with self.__lock:
+            previous = self.__orders.pop(order_id, None)
+            if previous:
+                self.__book(*previous, direction=-1)
+            # The first event of a new order replaces the quantity booked by check() under its client id.
+            client_id = get_client_id(order)
+            pending = self.__orders.pop(("client", client_id), None) if client_id else None
+            if pending:
+                self.__book(*pending, direction=-1)
+            if working:
+                entry = (key, get_order_side(order), quantity, get_field(order, "price", 0))
+                self.__orders[order_id] = entry
+                self.__book(*entry)
+
+    def position(self, portfolio_id, contract_id, delivery_area):
+        """
+        :return: Tuple (net_pos, abs_pos)
+        """
+
+        return self.position_book.net_pos(portfolio_id, contract_id, delivery_area), self.position_book.abs_pos(portfolio_id, contract_id, delivery_area)
+
+    def order_count(self, portfolio_id, contract_id, delivery_area):
+        """
+        :return: Number of working orders.
+        """
+
+        working = self.__working.get((portfolio_id, contract_id, delivery_area))
+        return working[2] if working else 0
+
+    def check(self, orders):
+        """
+        Checks a batch of new orders against the position and cash limits of their portfolio (and the tenant).
+        Orders exceeding a limit are trimmed to the remaining headroom, orders without headroom are rejected.
+        Accepted orders are counted as working orders, so subsequent checks (also within the same batch) consider them.
+
+        :param orders: List of OrderEntry objects.
+        :return: Tuple(accepted, rejected), where rejected is a list of tuples (order, reason).
+        """
+
+        accepted = []
+        rejected = []
+
+        with self.__lock:
+            for order in orders:
+                allowed, reason = self.__allowed_quantity(order)
+                allowed = math.floor(round(allowed / self.quantity_step, 6)) * self.quantity_step
+
+                if allowed < self.quantity_step:
+                    # Without a binding limit, the order itself is smaller than the minimum quantity step.
+                    rejected.append((order, reason or f"quantity {order.quantity} below the minimum step {self.quantity_step}"))
+                    continue
+                if allowed < order.quantity:
+                    LOGGER.info(f"Trimmed {order.side} order for {order.contract_id} from {order.quantity} to {round(allowed, 6)} ({reason}).")
+                    order.quantity = round(allowed, 6)
+
+                key = (order.portfolio_id, order.contract_id, order.delivery_area)
+                pending_key = self.__pending_key(order)
+                previous = self.__orders.pop(pending_key, None)
+                if previous:
+                    # The same order has been checked before.
+                    self.__book(*previous, direction=-1)
+                self.__book(key, order.side, order.quantity, order.price or 0)
+                # New orders are tracked with their client id (see order_manager_helper) until the first order event with
+                # the exchange order id arrives.
+                self.__orders[pending_key] = (key, order.side, order.quantity, order.price or 0)
+                accepted.append(order)
+
+        return accepted, rejected
+
+    def release(self, orders):
+        """
+        Releases the working quantities booked by check() for orders, which were not sent or for which the order events
+        (with the exchange order ids) have been processed.
+        """
+
+        with self.__lock:
+            for order in orders:
+                previous = self.__orders.pop(self.__pending_key(order), None)
+                if previous:
+                    self.__book(*previous, direction=-1)
+
+    @staticmethod
+    def __pending_key(order):
+        client_id = get_client_id(order)
+        if client_id is None:
+            # Untagged orders can only be released with the same object.
+            return "object", id(order)
+        return "client", client_id
+
+    def __owners(self, portfolio_id):
+        owners = [portfolio_id] if portfolio_id else list(self.portfolio_ids)
+        if self.tenant_id:
+            owners.append(self.tenant_id)
+        return owners
+
+    def __book(self, key, side, quantity, price, direction=1):
+        working = self.__working.setdefault(key, [0, 0, 0])
+        if side == "BUY":
+            working[0] += direction * quantity
+            self.__working_buy_value[key[0]] = self.__working_buy_value.get(key[0], 0) + direction * quantity * price
+        else:
+            working[1] += direction * quantity
+        working[2] += direction
+
+    def __allowed_quantity(self, order):
+        """
+        :return: Tuple(maximum quantity allowed by all limits, reason of the most restrictive limit)
+        """
+
+        allowed = order.quantity
+        reason = None
+
+        for owner in self.__owners(order.portfolio_id):
+            settings = self.__settings.get(owner)
+            if not settings:
+                continue
+
+            if owner == self.tenant_id:
+                keys = [(portfolio_id, order.contract_id, order.delivery_area) for portfolio_id in self.portfolio_ids]
+                portfolios = list(self.portfolio_ids)
+            else:
+                keys = [(order.portfolio_id, order.contract_id, order.delivery_area)]
+                portfolios = [order.portfolio_id]
+
+            trading_areas = get_field(settings, "trading_areas", [])
+            if trading_areas and order.delivery_area not in [area.delivery_area for area in trading_areas]:
+                return 0, f"delivery area {order.delivery_area} not allowed for {owner}"
+
+            net_pos = sum(self.position_book.net_pos(*key) for key in keys)
+            abs_pos = sum(self.position_book.abs_pos(*key) for key in keys)
+            working_buy = sum(self.__working.get(key, (0, 0, 0))[0] for key in keys)
+            working_sell = sum(self.__working.get(key, (0, 0, 0))[1] for key in keys)
+
+            for limit in get_field(settings, "position_limits", []):
+                if limit.delivery_area != order.delivery_area:
+                    continue
+                if order.side == "BUY" and limit.max_netpos_limit is not None:
+                    headroom = limit.max_netpos_limit - (net_pos + working_buy)
+                elif order.side == "SELL" and limit.min_netpos_limit is not None:
+                    headroom = (net_pos - working_sell) - limit.min_netpos_limit
+                else:
+                    headroom = allowed
+                if limit.abspos_limit is not None:
+                    headroom = min(headroom, limit.abspos_limit - (abs_pos + working_buy + working_sell))
+                if headroom < allowed:
+                    allowed, reason = headroom, f"position limit of {owner}"
+
+            if order.price:
+                cash = sum(self.position_book.cash(portfolio_id) for portfolio_id in portfolios)
+                working_buy_value = sum(self.__working_buy_value.get(portfolio_id, 0) for portfolio_id in portfolios)
+                for limit in get_field(settings, "cash_limits", []):
+                    # Buying lowers the cash balance, so only the negative limit can be violated by a new order.
+                    if limit.direction == "NEG" and order.side == "BUY" and order.price > 0:
+                        headroom = (cash - working_buy_value - limit.limit) / order.price
+                        if headroom < allowed:
+                            allowed, reason = headroom, f"cash limit of {owner}"
+
+        return allowed, reason
@@ -0,0 +1,230 @@
+"""
+Powerbot scheduler helpers
+(c) 2020 PowerBot GmbH
+
+Deadline aware scheduling of the algorithm cycles. Every cycle is aligned to the clock (e.g. :00, :15, :30, :45) and gets a
+time budget, measured from its scheduled start. Within a cycle the contracts are processed in the order of their gate
+closure, so the contracts closest to delivery are always processed first; when the budget runs out, the remaining
+contracts are skipped instead of delaying the next cycle. Cycles never overlap, a cycle that cannot be started in time
+is skipped as a whole.
+
+    def cycle(budget):
+        for contract in budget.by_gate_closure(order_book.contracts):
+            ...
+
+    DeadlineScheduler(cycle, interval=900, budget=600).run_forever()
+"""
+
+import logging
+import math
+import threading
+import time
+from helpers.delivery_period_helper import current_minute, to_minutes
+from helpers.event_helper import get_field
+from helpers.instrumentation_helper import METRICS
+
+LOGGER = logging.getLogger("Scheduler")
+
+
+def gate_closure(contract, lead_times=None, default_lead_time=5):
+    """
+    Helper function to determine the gate closure of a contract.
+
+    :param contract: Contract of an order book (swagger model or websocket event).
+    :param lead_times: Optional dictionary {product: minutes between gate closure and delivery start}.
+    :param default_lead_time: Minutes between gate closure and delivery start of products without explicit lead time.
+    :return: Gate closure in minutes since the epoch.
+    """
+
+    lead_time = (lead_times or {}).get(get_field(contract, "product"), default_lead_time)
+    return to_minutes(get_field(contract, "delivery_start")) - lead_time
+
+
+class CycleBudget:
+    """
+    Time budget of a single cycle.
+    """
+
+    def __init__(self, seconds=None, reserve=0.0, deadline=None, lead_times=None, default_lead_time=5):
+        """
+        :param seconds: Time budget in seconds from now (None means unlimited).
+        :param reserve: Seconds kept for the work after the prioritized contracts (e.g. submitting the orders), the budget
+                        is exhausted [reserve] seconds before the deadline.
+        :param deadline: Alternatively to [seconds], the deadline as time.monotonic() value.
+        :param lead_times: See gate_closure.
+        :param default_lead_time: See gate_closure.
+        """
+
+        self.started = time.monotonic()
+        if deadline is None and seconds is not None:
+            deadline = self.started + seconds
+        self.deadline = deadline
+        self.reserve = reserve
+        self.lead_times = lead_times
+        self.default_lead_time = default_lead_time
+        self.processed = 0
+        self.skipped = 0
+        self.closed = 0
+
+    @property
+    def remaining(self):
+        """
+        :return: Seconds until the deadline (negative after the deadline).
+        """
+
+        return math.inf if self.deadline is None else self.deadline - time.monotonic()
+
+    @property
+    def exhausted(self):
+        return self.remaining <= self.reserve
+
+    @property
+    def overrun(self):
+        return self.remaining < 0
+
+    def by_gate_closure(self, contracts, now=None):
+        """
+        Yields the contracts in the order of their gate closure (earliest first) as long as the budget is not exhausted.
+        Contracts whose gate has already closed are left out.
+
+        :param contracts: List of contracts.
+        :param now: Current time in minutes since the epoch (defaults to the current minute).
+        """
+
+        now = current_minute() if now is None else now
+        # The index keeps the order of the order book for contracts with the same gate closure.
+        ordered = sorted((gate_closure(contract, self.lead_times, self.default_lead_time), index, contract)
+                         for index, contract in enumerate(contracts))
+        for position, (closure, _, contract) in enumerate(ordered):
+            if closure <= now:
+                self.closed += 1
+                continue
+            if self.exhausted:
+                self.skipped += len(ordered) - position
+                LOGGER.warning(f"Cycle budget exhausted, skipping {len(ordered) - position} contracts.")
+                return
+            self.processed += 1
+            yield contract
+
+
+class DeadlineScheduler:
+    """
+    Runs a job in clock aligned cycles, each with its own CycleBudget. The cycles run one after another in the calling
+    thread, so they can never overlap.
+    """
+
+    def __init__(self, job, interval=900, offset=0, budget=None, reserve=0.0, min_budget=None, lead_times=None,
+                 default_lead_time=5, metrics=METRICS, name="algorithm"):
+        """
+        :param job: Function job(budget) executed every cycle.
+        :param interval: Seconds between the starts of two cycles. The cycles are aligned to the clock, e.g. 900 starts
+                         them at :00, :15, :30 and :45.
+        :param offset: Seconds after the aligned time at which the cycles start.
+        :param budget: Time budget of a cycle in seconds, measured from its scheduled start (defaults to the interval).
+        :param reserve: See CycleBudget.
+        :param min_budget: A late cycle is only started if at least this many seconds of its budget are left, otherwise
+                           it is skipped (defaults to 10% of the budget).
+        :param lead_times: See gate_closure.
+        :param default_lead_time: See gate_closure.
+        :param metrics: Metrics registry for the durations, overruns and skips (see instrumentation_helper).
+        :param name: Name of the scheduler in the logs and metrics.
+        """
+
+        self.job = job
+        self.interval = interval
+        self.offset = offset
+        self.budget = budget if budget is not None else interval
+        self.reserve = reserve
+        self.min_budget = min_budget if min_budget is not None else self.budget / 10
+        self.lead_times = lead_times
+        self.default_lead_time = default_lead_time
+        self.metrics = metrics
+        self.name = name
+        self.__stop = threading.Event()
+
+        self.cycles = 0
+        self.failures = 0
+        self.overruns = 0
+        self.skipped_cycles = 0
+        self.skipped_contracts = 0
+        self.max_duration = 0.0
+
+    def next_slot(self, now=None):
+        """
+        :param now: Unix time (defaults to the current time).
+        :return: Unix time of the next scheduled cycle start at or after [now].
+        """
+
+        now = time.time() if now is None else now
+        return math.ceil((now - self.offset) / self.interval) * self.interval + self.offset
+
+    def run_cycle(self, slot=None):
+        """
+        Runs a single cycle immediately.
+
+        :param slot: Scheduled start of the cycle as unix time (defaults to now), the deadline is [slot] + budget.
+        :return: The CycleBudget of the cycle.
+        """
+
+        slot = time.time() if slot is None else slot
+        budget = CycleBudget(deadline=time.monotonic() + slot + self.budget - time.time(), reserve=self.reserve,
+                             lead_times=self.lead_times, default_lead_time=self.default_lead_time)
+        try:
+            self.job(budget)
+        except Exception as e:
+            self.failures += 1
+            LOGGER.exception(f"Cycle of {self.name} failed: {e}")
+
+        duration = time.monotonic() - budget.started
+        self.cycles += 1
+        self.max_duration = max(self.max_duration, duration)
+        self.metrics.histogram("powerbot_scheduler_cycle_seconds", scheduler=self.name).record(duration)
+        if budget.overrun:
+            self.overruns += 1
+            self.metrics.increment("powerbot_scheduler_overruns_total", scheduler=self.name)
+            LOGGER.warning(f"Cycle of {self.name} overran its deadline by {-budget.remaining:.2f}s.")
+        if budget.skipped:
+            self.skipped_contracts += budget.skipped
+            self.metrics.increment("powerbot_scheduler_skipped_contracts_total", budget.skipped, scheduler=self.name)
+        return budget
+
+    def run_forever(self, stop_event=None, tick=1):
+        """
+        Runs the cycles until stop() is called or the [stop_event] is set.
+
+        :param stop_event: Optional threading.Event, e.g. the one of the kill switch.
+        :param tick: Maximum time in seconds between two checks of the stop conditions while waiting for the next cycle.
+        """
+
+        def stopped():
+            return self.__stop.is_set() or (stop_event is not None and stop_event.is_set())
+
+        self.__stop.clear()
+        slot = self.next_slot()
+        while not stopped():
+            delay = slot - time.time()
+            if delay > 0:
+                self.__stop.wait(min(delay, tick))
+                continue
+
+            # The remaining budget of a late cycle is reduced by its delay.
+            if self.budget + delay < self.min_budget:
+                # The previous cycle took too long, there is not enough time left for this one.
+                self.skipped_cycles += 1
+                self.metrics.increment("powerbot_scheduler_skipped_cycles_total", scheduler=self.name)
+                LOGGER.warning(f"Skipping the cycle of {self.name} scheduled at {time.strftime('%H:%M:%S', time.gmtime(slot))} "
+                               f"UTC, it is {-delay:.2f}s late.")
+            else:
+                if delay < -1:
+                    LOGGER.warning(f"Cycle of {self.name} starts {-delay:.2f}s late.")
+                self.run_cycle(slot)
+            slot += self.interval
+
+    def stop(self):
+        self.__stop.set()
+
+    @property
+    def stats(self):
+        return {"cycles": self.cycles, "failures": self.failures, "overruns": self.overruns,
+                "skipped_cycles": self.skipped_cycles, "skipped_contracts": self.skipped_contracts,
+                "max_duration": self.max_duration}
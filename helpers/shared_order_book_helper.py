@@ -0,0 +1,313 @@
+"""
+Powerbot shared order book helpers
+(c) 2020 PowerBot GmbH
+
+Order book in shared memory for strategies that are split across several processes. A single feeder process applies the
+REST order books and the websocket events into a buffer with a fixed layout, any number of worker processes read it
+without downloading and deserializing the order books themselves. A read unpacks (copies) the fixed size slot of a
+single contract, no swagger models or JSON are involved. Requires python >= 3.8 (multiprocessing.shared_memory).
+
+    # Feeder process
+    feeder = SharedOrderBookFeeder("powerbot_orderbook", capacity=2048, depth=10)
+    feeder.apply_order_book(contract_api.get_order_books(delivery_area=DELIVERY_AREA), DELIVERY_AREA)
+
+    # Worker processes
+    reader = SharedOrderBookReader("powerbot_orderbook")
+    book = reader.get(contract_id, DELIVERY_AREA)
+
+Every contract has its own slot, protected by a sequence lock: the feeder makes the sequence number odd before it changes
+the slot and even again afterwards, a reader retries if the sequence number was odd or changed while it was reading.
+This relies on the stores of the feeder becoming visible in program order (as on x86), which is the case for the
+memory copies done by struct.pack_into.
+"""
+
+import struct
+import time
+from collections import namedtuple
+from helpers.event_helper import get_field, get_timestamp
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    # python < 3.8
+    shared_memory = None
+
+MAGIC = b"PBOB"
+
+# magic | capacity | depth | number of used slots | 2 x unused (pads the header to 24 bytes, keeps the slots 8 byte aligned)
+HEADER = struct.Struct("<4sIIIII")
+# sequence | contract_id | delivery_area | product | delivery_start | delivery_end | updated | number of bids | number of asks
+SLOT_HEADER = struct.Struct("<Q32s24s40sdddII")
+SEQUENCE = struct.Struct("<Q")
+
+# The sequence numbers at the start of the slots must be 8 byte aligned to be written and read in one piece.
+assert HEADER.size % 8 == 0 and SLOT_HEADER.size % 8 == 0
+
+BookSnapshot = namedtuple("BookSnapshot", ["contract_id", "delivery_area", "product", "delivery_start", "delivery_end",
+                                           "updated", "bids", "asks"])
+
+
+class OrderBookFull(Exception):
+    """
+    Raised if all slots of the shared order book are in use.
+    """
+
+
+def _encode(value, size):
+    encoded = (value or "").encode()
+    if len(encoded) > size:
+        raise ValueError(f"{value} exceeds {size} bytes.")
+    return encoded
+
+
+def _decode(value):
+    return value.rstrip(b"\0").decode()
+
+
+def _require_shared_memory():
+    if shared_memory is None:
+        raise RuntimeError("The shared order book requires python >= 3.8 (multiprocessing.shared_memory).")
+
+
+class _SharedOrderBook:
+
+    def __init__(self, memory, capacity, depth):
+        self.memory = memory
+        self.capacity = capacity
+        self.depth = depth
+        # Best bids first (descending prices), then best asks (ascending prices), (price, quantity) per level.
+        self.levels = struct.Struct(f"<{4 * depth}d")
+        self.slot_size = SLOT_HEADER.size + self.levels.size
+
+    def offset(self, slot):
+        return HEADER.size + slot * self.slot_size
+
+    @property
+    def count(self):
+        return HEADER.unpack_from(self.memory.buf, 0)[3]
+
+    @property
+    def name(self):
+        return self.memory.name
+
+
+class SharedOrderBookFeeder(_SharedOrderBook):
+    """
+    Creates the shared memory and writes the order book into it. There must be exactly one feeder per shared order book.
+    """
+
+    def __init__(self, name, capacity=2048, depth=10):
+        """
+        :param name: Name of the shared memory block, the readers attach by this name.
+        :param capacity: Maximum number of (contract, delivery area) slots.
+        :param depth: Number of price levels per side.
+        """
+
+        _require_shared_memory()
+        levels_size = struct.calcsize(f"<{4 * depth}d")
+        memory = shared_memory.SharedMemory(name=name, create=True,
+                                            size=HEADER.size + capacity * (SLOT_HEADER.size + levels_size))
+        super().__init__(memory, capacity, depth)
+        HEADER.pack_into(self.memory.buf, 0, MAGIC, capacity, depth, 0, 0, 0)
+        # {(contract_id, delivery_area): slot}
+        self.__slots = {}
+
+    def __slot(self, contract_id, delivery_area, product, delivery_start, delivery_end):
+        slot = self.__slots.get((contract_id, delivery_area))
+        if slot is not None:
+            return slot
+        slot = len(self.__slots)
+        if slot >= self.capacity:
+            raise OrderBookFull(f"All {self.capacity} slots of {self.name} are in use.")
+        SLOT_HEADER.pack_into(self.memory.buf, self.offset(slot), 0, _encode(contract_id, 32), _encode(delivery_area, 24),
+                              _encode(product, 40), delivery_start, delivery_end, 0, 0, 0)
+        self.__slots[(contract_id, delivery_area)] = slot
+        # The slot is only visible to the readers after it has been initialized.
+        HEADER.pack_into(self.memory.buf, 0, MAGIC, self.capacity, self.depth, slot + 1, 0, 0)
+        return slot
+
+    def update(self, contract_id, delivery_area, bids, asks, product=None, delivery_start=None, delivery_end=None):
+        """
+        Replaces the price levels of a contract.
+
+        :param bids: List of (price, quantity), best (highest) price first.
+        :param asks: List of (price, quantity), best (lowest) price first.
+        """
+
+        slot = self.__slot(contract_id, delivery_area, product, get_timestamp(delivery_start), get_timestamp(delivery_end))
+        offset = self.offset(slot)
+        bids = bids[:self.depth]
+        asks = asks[:self.depth]
+        values = [0.0] * (4 * self.depth)
+        for index, (price, quantity) in enumerate(bids):
+            values[2 * index:2 * index + 2] = (price, quantity)
+        for index, (price, quantity) in enumerate(asks):
+            values[2 * (self.depth + index):2 * (self.depth + index) + 2] = (price, quantity)
+
+        buf = self.memory.buf
+        sequence, = SEQUENCE.unpack_from(buf, offset)
+        SEQUENCE.pack_into(buf, offset, sequence + 1)
+        header = SLOT_HEADER.unpack_from(buf, offset)
+        SLOT_HEADER.pack_into(buf, offset, sequence + 1, *header[1:6], time.time(), len(bids), len(asks))
+        self.levels.pack_into(buf, offset + SLOT_HEADER.size, *values)
+        SEQUENCE.pack_into(buf, offset, sequence + 2)
+
+    def apply_order_book(self, order_book, delivery_area):
+        """
+        Applies the best prices of all contracts of an order book (get_order_books). Deeper levels of a contract are
+        kept, if the best prices did not change.
+        """
+
+        for contract in order_book.contracts:
+            bids, asks = self.levels_of(contract.contract_id, delivery_area)
+            bids = self.__merge_top(bids, get_field(contract, "best_bid_price"), get_field(contract, "best_bid_quantity"))
+            asks = self.__merge_top(asks, get_field(contract, "best_ask_price"), get_field(contract, "best_ask_quantity"))
+            self.update(contract.contract_id, delivery_area, bids, asks, contract.product, contract.delivery_start,
+                        contract.delivery_end)
+
+    @staticmethod
+    def __merge_top(levels, price, quantity):
+        if price is None:
+            return []
+        if levels and levels[0][0] == price:
+            return [(price, quantity if quantity is not None else levels[0][1])] + levels[1:]
+        return [(price, quantity or 0.0)]
+
+    def apply_orders(self, contract_id, delivery_area, public_orders, product=None, delivery_start=None, delivery_end=None):
+        """
+        Applies the full depth of a contract from its public orders (get_orders), aggregated by price.
+        """
+
+        def aggregate(orders, reverse):
+            levels = {}
+            for order in orders or []:
+                price = get_field(order, "price")
+                levels[price] = levels.get(price, 0.0) + get_field(order, "quantity", 0.0)
+            return sorted(levels.items(), reverse=reverse)
+
+        self.update(contract_id, delivery_area, aggregate(get_field(public_orders, "bid"), True),
+                    aggregate(get_field(public_orders, "ask"), False), product, delivery_start, delivery_end)
+
+    def apply_event(self, event, delivery_area=None):
+        """
+        Applies the best prices of an order book changed event (as decoded by event_helper.parse_message).
+        """
+
+        delivery_area = get_field(event, "delivery_area", delivery_area)
+        bids, asks = self.levels_of(get_field(event, "contract_id"), delivery_area)
+        self.update(get_field(event, "contract_id"), delivery_area,
+                    self.__merge_top(bids, get_field(event, "best_bid_price"), get_field(event, "best_bid_quantity")),
+                    self.__merge_top(asks, get_field(event, "best_ask_price"), get_field(event, "best_ask_quantity")),
+                    get_field(event, "product"), get_field(event, "delivery_start"), get_field(event, "delivery_end"))
+
+    def levels_of(self, contract_id, delivery_area):
+        slot = self.__slots.get((contract_id, delivery_area))
+        if slot is None:
+            return [], []
+        # The feeder is the only writer, it can read its own slots without the sequence lock.
+        snapshot = _read_slot(self, slot)
+        return snapshot.bids, snapshot.asks
+
+    def close(self):
+        """
+        Releases and removes the shared memory. Readers that are still attached keep their mapping.
+        """
+
+        self.memory.close()
+        self.memory.unlink()
+
+
+def _read_slot(book, slot):
+    buf = book.memory.buf
+    offset = book.offset(slot)
+    header = SLOT_HEADER.unpack_from(buf, offset)
+    values = book.levels.unpack_from(buf, offset + SLOT_HEADER.size)
+    bid_count, ask_count = header[7], header[8]
+    depth = book.depth
+    bids = [(values[2 * i], values[2 * i + 1]) for i in range(bid_count)]
+    asks = [(values[2 * (depth + i)], values[2 * (depth + i) + 1]) for i in range(ask_count)]
+    return BookSnapshot(_decode(header[1]), _decode(header[2]), _decode(header[3]), header[4], header[5], header[6], bids, asks)
+
+
+class SharedOrderBookReader(_SharedOrderBook):
+    """
+    Attaches to the shared memory of a feeder (in any process) and reads consistent snapshots of single contracts.
+    """
+
+    def __init__(self, name, max_retries=1000):
+        """
+        :param name: Name of the shared memory block.
+        :param max_retries: Number of attempts to read a slot while the feeder is writing it.
+        """
+
+        _require_shared_memory()
+        try:
+            # The reader must not remove the shared memory when it exits (python >= 3.13).
+            memory = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            memory = shared_memory.SharedMemory(name=name)
+            # Older python versions register attached blocks with the resource tracker, which would unlink them when
+            # the reader process exits. Readers forked by the feeder share its tracker, in this case the tracker logs a
+            # harmless KeyError when the feeder unlinks the block.
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(memory._name, "shared_memory")
+
+        magic, capacity, depth = HEADER.unpack_from(memory.buf, 0)[:3]
+        if magic != MAGIC:
+            memory.close()
+            raise ValueError(f"{name} is not a shared order book.")
+        super().__init__(memory, capacity, depth)
+        self.max_retries = max_retries
+        # {(contract_id, delivery_area): slot}, the slots never change once they have been assigned.
+        self.__slots = {}
+
+    def __refresh(self):
+        for slot in range(len(self.__slots), self.count):
+            header = SLOT_HEADER.unpack_from(self.memory.buf, self.offset(slot))
+            self.__slots[(_decode(header[1]), _decode(header[2]))] = slot
+
+    def keys(self):
+        """
+        :return: List of (contract_id, delivery_area) of all contracts in the shared order book.
+        """
+
+        self.__refresh()
+        return list(self.__slots)
+
+    def get(self, contract_id, delivery_area):
+        """
+        :return: BookSnapshot of the contract or None, if the contract is not in the shared order book.
+        """
+
+        slot = self.__slots.get((contract_id, delivery_area))
+        if slot is None:
+            self.__refresh()
+            slot = self.__slots.get((contract_id, delivery_area))
+            if slot is None:
+                return None
+
+        buf = self.memory.buf
+        offset = self.offset(slot)
+        for _ in range(self.max_retries):
+            before, = SEQUENCE.unpack_from(buf, offset)
+            if before % 2 == 0:
+                snapshot = _read_slot(self, slot)
+                after, = SEQUENCE.unpack_from(buf, offset)
+                if before == after:
+                    return snapshot
+            # The feeder is writing the slot right now.
+            time.sleep(0)
+        raise TimeoutError(f"Could not read a consistent snapshot of {contract_id} in {delivery_area}.")
+
+    def version(self, contract_id, delivery_area):
+        """
+        :return: The sequence number of the contract's slot, which changes with every update (None for unknown contracts).
+        """
+
+        if (contract_id, delivery_area) not in self.__slots:
+            self.__refresh()
+        slot = self.__slots.get((contract_id, delivery_area))
+        return SEQUENCE.unpack_from(self.memory.buf, self.offset(slot))[0] if slot is not None else None
+
+    def close(self):
+        self.memory.close()
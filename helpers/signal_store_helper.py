@@ -0,0 +1,187 @@
+"""
+Powerbot signal store helpers
+(c) 2020 PowerBot GmbH
+
+Local time series of signals per (source, delivery area, portfolio, delivery period). Every signal published with
+update_signals and every signal received with the contracts (get_order_books(with_signals=True) or get_contract_signals)
+is recorded with its time, so backtests and incident analysis can look up the signal state an algorithm saw at any
+moment without asking the server.
+
+Each series is stored in columns (flat arrays of times and payload ids), the payloads themselves are interned, so a
+signal that is received unchanged every cycle costs no additional memory.
+"""
+
+import json
+import threading
+import time
+from array import array
+from bisect import bisect_right
+from helpers.event_helper import get_field, get_timestamp
+
+PUBLISHED = "PUBLISHED"
+RECEIVED = "RECEIVED"
+
+PAYLOAD_FIELDS = ("value", "position_long", "position_short")
+
+
+def get_signal_payload(signal):
+    """
+    Helper function to extract the information of a signal (BulkSignal, contract signal or dictionary).
+
+    :return: Dictionary with the value and the position fields that are set.
+    """
+
+    payload = {}
+    for field in PAYLOAD_FIELDS:
+        value = get_field(signal, field)
+        if value is not None:
+            payload[field] = value
+    return payload
+
+
+class SignalSeries:
+    """
+    Revisions of a single signal key in columnar layout, sorted by time.
+    """
+
+    __slots__ = ("times", "payload_ids")
+
+    def __init__(self):
+        self.times = array("d")
+        self.payload_ids = array("l")
+
+    def __len__(self):
+        return len(self.times)
+
+    def add(self, timestamp, payload_id):
+        """
+        :return: True if the revision was added, False if it does not change the signal.
+        """
+
+        if not self.times or timestamp >= self.times[-1]:
+            if self.payload_ids and self.payload_ids[-1] == payload_id:
+                return False
+            self.times.append(timestamp)
+            self.payload_ids.append(payload_id)
+            return True
+
+        # Late revisions (e.g. recorded from a delayed response) are inserted at their place in time.
+        position = bisect_right(self.times, timestamp)
+        self.times.insert(position, timestamp)
+        self.payload_ids.insert(position, payload_id)
+        return True
+
+    def position_at(self, timestamp):
+        return bisect_right(self.times, timestamp) - 1
+
+
+class SignalStore:
+    """
+    Signal time series, separately for published and received signals. Signals that are valid for all delivery areas or
+    portfolios (empty lists in the BulkSignal) are stored under the delivery area / portfolio id None.
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        # {(origin, source, delivery_area, portfolio_id, delivery_start, delivery_end): SignalSeries}
+        self.__series = {}
+        # Interned payloads: list of payloads and {JSON of the payload: payload id}
+        self.__payloads = []
+        self.__payload_ids = {}
+
+    def __intern(self, payload):
+        encoded = json.dumps(payload, sort_keys=True, separators=(",", ":"), default=str)
+        payload_id = self.__payload_ids.get(encoded)
+        if payload_id is None:
+            payload_id = self.__payload_ids[encoded] = len(self.__payloads)
+            self.__payloads.append(payload)
+        return payload_id
+
+    def __record(self, origin, signal, delivery_areas, portfolio_ids, delivery_start, delivery_end, timestamp):
+        timestamp = time.time() if timestamp is None else get_timestamp(timestamp)
+        period = (get_timestamp(delivery_start), get_timestamp(delivery_end))
+        added = 0
+        with self.__lock:
+            payload_id = self.__intern(get_signal_payload(signal))
+            for delivery_area in delivery_areas or [None]:
+                for portfolio_id in portfolio_ids or [None]:
+                    key = (origin, get_field(signal, "source"), delivery_area, portfolio_id) + period
+                    series = self.__series.get(key)
+                    if series is None:
+                        series = self.__series[key] = SignalSeries()
+                    added += series.add(timestamp, payload_id)
+        return added
+
+    def record_published(self, signals, timestamp=None):
+        """
+        Records signals sent with update_signals.
+
+        :param signals: List of BulkSignal objects.
+        :param timestamp: Time of the upload, defaults to now.
+        :return: Number of recorded revisions (unchanged signals are not recorded again).
+        """
+
+        return sum(self.__record(PUBLISHED, signal, get_field(signal, "delivery_areas"), get_field(signal, "portfolio_ids"),
+                                 get_field(signal, "delivery_start"), get_field(signal, "delivery_end"), timestamp)
+                   for signal in signals)
+
+    def record_received(self, contract, delivery_area, portfolio_id=None, signals=None, timestamp=None):
+        """
+        Records the signals attached to a contract.
+
+        :param contract: Contract of an order book (get_order_books(with_signals=True)).
+        :param delivery_area: The delivery area of the order book.
+        :param portfolio_id: The portfolio the order book has been requested for.
+        :param signals: Optional signals of the contract (e.g. from get_contract_signals), defaults to contract.signals.
+        :param timestamp: Time of the response, defaults to now.
+        :return: Number of recorded revisions.
+        """
+
+        signals = get_field(contract, "signals", []) if signals is None else signals
+        return sum(self.__record(RECEIVED, signal, [delivery_area], [portfolio_id] if portfolio_id else None,
+                                 get_field(contract, "delivery_start"), get_field(contract, "delivery_end"), timestamp)
+                   for signal in signals)
+
+    def record_order_book(self, order_book, delivery_area, portfolio_id=None, timestamp=None):
+        """
+        Records the signals of all contracts of an order book.
+        """
+
+        timestamp = time.time() if timestamp is None else timestamp
+        return sum(self.record_received(contract, delivery_area, portfolio_id, timestamp=timestamp)
+                   for contract in order_book.contracts)
+
+    def as_of(self, source, delivery_area, portfolio_id, delivery_start, delivery_end, timestamp, origin=RECEIVED):
+        """
+        :param timestamp: datetime, ISO 8601 string or seconds since the epoch.
+        :param origin: RECEIVED (what the algorithm saw) or PUBLISHED (what has been sent).
+        :return: The signal payload valid at the timestamp or None.
+        """
+
+        key = (origin, source, delivery_area, portfolio_id, get_timestamp(delivery_start), get_timestamp(delivery_end))
+        with self.__lock:
+            series = self.__series.get(key)
+            if series is None:
+                return None
+            position = series.position_at(get_timestamp(timestamp))
+            return self.__payloads[series.payload_ids[position]] if position >= 0 else None
+
+    def history(self, source, delivery_area, portfolio_id, delivery_start, delivery_end, origin=RECEIVED):
+        """
+        :return: List of (timestamp, payload) of all revisions of the signal.
+        """
+
+        key = (origin, source, delivery_area, portfolio_id, get_timestamp(delivery_start), get_timestamp(delivery_end))
+        with self.__lock:
+            series = self.__series.get(key)
+            if series is None:
+                return []
+            return [(t, self.__payloads[p]) for t, p in zip(series.times, series.payload_ids)]
+
+    def keys(self, origin=None):
+        """
+        :return: List of (origin, source, delivery_area, portfolio_id, delivery_start, delivery_end) of all series.
+        """
+
+        with self.__lock:
+            return [key for key in self.__series if origin is None or key[0] == origin]
@@ -0,0 +1,187 @@
+"""
+Powerbot signal upload helpers
+(c) 2020 PowerBot GmbH
+
+Upload pipeline for large lists of signals. Instead of sending all signals as one uncompressed request body with
+update_signals, the signals are serialized once to compact JSON, split into chunks of a bounded size, gzip compressed and
+sent concurrently. Every chunk is retried on its own, so a failed chunk does not force the upload of all signals again.
+"""
+
+import gzip
+import json
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from helpers.instrumentation_helper import METRICS
+from helpers.rate_limit_helper import BULK
+
+LOGGER = logging.getLogger("SignalUpload")
+
+# Status codes after which a chunk is sent again.
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+
+class SignalChunk:
+    """
+    A part of the signals, serialized as JSON array.
+    """
+
+    __slots__ = ("signals", "payload", "attempts", "status", "error")
+
+    def __init__(self, signals, payload):
+        self.signals = signals
+        self.payload = payload
+        self.attempts = 0
+        self.status = None
+        self.error = None
+
+    def __repr__(self):
+        return f"SignalChunk({len(self.signals)} signals, {len(self.payload)} bytes, status={self.status}, error={self.error})"
+
+
+class SignalUploader:
+    """
+    Sends signals in concurrent, size-bounded and compressed chunks via the connection pool of an ApiClient.
+    The requests bypass the generated SignalsApi, but use the rate limiter (BULK priority) and the metrics of the client.
+    """
+
+    def __init__(self, client, max_chunk_bytes=256 * 1024, workers=4, compress=True, max_retries=3, method="PATCH",
+                 resource_path="/signals", timeout=30):
+        """
+        :param client: The ApiClient, its configuration provides the host and the api key.
+        :param max_chunk_bytes: Maximum size of the uncompressed JSON of a chunk.
+        :param workers: Number of chunks sent in parallel (should not exceed the connection pool size of the client).
+        :param compress: Whether to send the chunks gzip compressed. Compression is switched off automatically, if the
+                         server rejects a compressed chunk (400/415) and accepts it uncompressed.
+        :param max_retries: Number of retries per chunk.
+        :param method: HTTP method of update_signals.
+        :param resource_path: Resource path of update_signals.
+        :param timeout: Timeout per request in seconds.
+        """
+
+        self.client = client
+        self.max_chunk_bytes = max_chunk_bytes
+        self.compress = compress
+        self.max_retries = max_retries
+        self.method = method
+        self.resource_path = resource_path
+        self.timeout = timeout
+        self.__executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="SignalUpload")
+
+    def serialize(self, signals):
+        """
+        Serializes the signals to compact JSON and splits them into chunks of at most [max_chunk_bytes].
+        A single signal larger than the limit is sent in a chunk of its own.
+
+        :param signals: List of BulkSignal objects (or dictionaries).
+        :return: List of SignalChunk objects.
+        """
+
+        chunks = []
+        current_signals, current_parts, current_size = [], [], 2
+        for signal in signals:
+            part = json.dumps(self.client.sanitize_for_serialization(signal), separators=(",", ":")).encode()
+            if current_parts and current_size + len(part) + 1 > self.max_chunk_bytes:
+                chunks.append(SignalChunk(current_signals, b"[" + b",".join(current_parts) + b"]"))
+                current_signals, current_parts, current_size = [], [], 2
+            current_signals.append(signal)
+            current_parts.append(part)
+            current_size += len(part) + 1
+        if current_parts:
+            chunks.append(SignalChunk(current_signals, b"[" + b",".join(current_parts) + b"]"))
+        return chunks
+
+    def upload(self, signals):
+        """
+        Uploads the signals and waits for all chunks.
+
+        :param signals: List of BulkSignal objects.
+        :return: List of the chunks that failed after all retries (empty if the upload was successful). The failed
+                 chunks can be passed to retry().
+        """
+
+        with METRICS.time("powerbot_signal_upload_seconds"):
+            chunks = self.serialize(signals)
+            return self.retry(chunks)
+
+    def retry(self, chunks):
+        """
+        Sends the given chunks (again).
+
+        :return: List of the chunks that failed.
+        """
+
+        results = list(self.__executor.map(self.__send, chunks))
+        failed = [chunk for chunk, success in zip(chunks, results) if not success]
+        if failed:
+            LOGGER.error(f"{len(failed)} of {len(chunks)} signal chunks could not be uploaded.")
+        return failed
+
+    def __send(self, chunk, compress=None):
+        configuration = self.client.configuration
+        url = configuration.host + self.resource_path
+        limiter = getattr(self.client, "limiter", None)
+
+        for attempt in range(self.max_retries + 1):
+            chunk.attempts += 1
+            compress = self.compress if compress is None else compress
+            headers = dict(self.client.default_headers)
+            headers.update({"Content-Type": "application/json", "Accept": "application/json",
+                            "api_key": configuration.api_key["api_key"]})
+            body = chunk.payload
+            if compress:
+                headers["Content-Encoding"] = "gzip"
+                body = gzip.compress(body, compresslevel=5)
+
+            if limiter:
+                limiter.acquire(BULK)
+            start = time.perf_counter()
+            try:
+                response = self.client.rest_client.pool_manager.request(self.method, url, body=body, headers=headers,
+                                                                        timeout=self.timeout, retries=False)
+                chunk.status = response.status
+                chunk.error = None
+            except Exception as e:
+                # Connection errors and timeouts are retried.
+                response = None
+                chunk.status = None
+                chunk.error = str(e)
+            finally:
+                METRICS.histogram("powerbot_api_request_seconds", endpoint=f"{self.method} {self.resource_path}").record(time.perf_counter() - start)
+                METRICS.increment("powerbot_api_requests_total", endpoint=f"{self.method} {self.resource_path}", status=str(chunk.status or "error"))
+
+            if response is not None and 200 <= response.status < 300:
+                if limiter:
+                    limiter.on_success()
+                return True
+
+            if chunk.status in (400, 415) and compress:
+                # The server might not accept compressed bodies, the chunk is sent once more without compression.
+                if self.__send(chunk, compress=False):
+                    LOGGER.warning("The server does not accept compressed signals, sending them uncompressed.")
+                    self.compress = False
+                    return True
+                return False
+            if response is not None and response.status not in RETRY_STATUS:
+                # 400 etc., sending the chunk again would not change the result.
+                chunk.error = response.data.decode(errors="replace") if response.data else None
+                return False
+
+            if attempt == self.max_retries:
+                break
+            if response is not None and response.status in (429, 503):
+                try:
+                    retry_after = float(response.headers.get("Retry-After"))
+                except (TypeError, ValueError):
+                    retry_after = 1.0
+                if limiter:
+                    # The limiter pauses all requests of the client, including the next attempt.
+                    limiter.on_throttled(retry_after)
+                else:
+                    time.sleep(retry_after)
+            else:
+                time.sleep(min(2 ** (chunk.attempts - 1), 10))
+        return False
+
+    def close(self):
+        self.__executor.shutdown(wait=True)
@@ -6,7 +6,7 @@ Powerbot helper functions
 import json
 import random
 from swagger_client.models import OrderModify, OrderModifyItem, BulkSignal
-from datetime import datetime, timedelta
+from helpers.delivery_period_helper import format_minutes, start_of_day
 
 from swagger_client.rest import ApiException
 
@@ -144,8 +144,9 @@ def create_signals(delivery_areas, portfolio_ids, position_long=False, position_
 
     # Set the delivery start/end time according to the contract for which the signal shall be valid for.
     # The timespan between delivery start/end is set to be 1 hour, because the algorithm will only trade hourly contracts.
-    delivery_start = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
-    delivery_end = delivery_start + timedelta(hours=1)
+    # The delivery periods are handled in minutes since the epoch, the formatted timestamps are cached.
+    delivery_start = start_of_day()
+    delivery_end = delivery_start + 60
 
     signals = []
 
@@ -158,8 +159,8 @@ def create_signals(delivery_areas, portfolio_ids, position_long=False, position_
             # The source is a simple string and can be chosen arbitrarily.
             source="ETRMSystem",
             # It is important to understand that the PowerBot server works with UTC time (as do the exchanges)!
-            delivery_start=delivery_start.strftime("%Y-%m-%dT%H:%M:%SZ"),
-            delivery_end=delivery_end.strftime("%Y-%m-%dT%H:%M:%SZ"),
+            delivery_start=format_minutes(delivery_start),
+            delivery_end=format_minutes(delivery_end),
             portfolio_ids=portfolio_ids,
             delivery_areas=delivery_areas,
             # If the respective flags are set, we want to create random position values.
@@ -171,8 +172,8 @@ def create_signals(delivery_areas, portfolio_ids, position_long=False, position_
         # Normally you would want to separate different signals according to their category/data source.
         fair_value_signal = BulkSignal(
             source="OptSystem",
-            delivery_start=delivery_start.strftime("%Y-%m-%dT%H:%M:%SZ"),
-            delivery_end=delivery_end.strftime("%Y-%m-%dT%H:%M:%SZ"),
+            delivery_start=format_minutes(delivery_start),
+            delivery_end=format_minutes(delivery_end),
             portfolio_ids=portfolio_ids,
             delivery_areas=delivery_areas,
             # We can add an arbitrary number of key/value pairs to the "value" field.
@@ -187,6 +188,6 @@ def create_signals(delivery_areas, portfolio_ids, position_long=False, position_
         hour += 1
 
         delivery_start = delivery_end
-        delivery_end = delivery_start + timedelta(hours=1)
+        delivery_end = delivery_start + 60
 
     return signals
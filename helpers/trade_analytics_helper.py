@@ -0,0 +1,233 @@
+"""
+Powerbot trade analytics helpers
+(c) 2020 PowerBot GmbH
+
+Streaming analytics of public trades per contract: rolling VWAP, last price, traded volume and volatility. The trades are
+kept in fixed size ring buffers and all statistics are updated in O(1) per trade, so strategies can price their orders off
+the real market activity without downloading the trade history every cycle.
+"""
+
+import math
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from helpers.event_helper import get_field, get_timestamp
+
+
+class RingBuffer:
+    """
+    Fixed capacity buffer of (timestamp, price, quantity, log return) tuples stored in flat arrays.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.timestamps = array("d", bytes(8 * capacity))
+        self.prices = array("d", bytes(8 * capacity))
+        self.quantities = array("d", bytes(8 * capacity))
+        self.returns = array("d", bytes(8 * capacity))
+        self.start = 0
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def append(self, timestamp, price, quantity, log_return):
+        """
+        :return: The evicted entry as tuple, if the buffer was full, otherwise None.
+        """
+
+        evicted = None
+        if self.size == self.capacity:
+            evicted = self.pop_oldest()
+        index = (self.start + self.size) % self.capacity
+        self.timestamps[index] = timestamp
+        self.prices[index] = price
+        self.quantities[index] = quantity
+        self.returns[index] = log_return
+        self.size += 1
+        return evicted
+
+    def oldest_timestamp(self):
+        return self.timestamps[self.start] if self.size else None
+
+    def pop_oldest(self):
+        index = self.start
+        entry = (self.timestamps[index], self.prices[index], self.quantities[index], self.returns[index])
+        self.start = (self.start + 1) % self.capacity
+        self.size -= 1
+        return entry
+
+
+class ContractTradeStats:
+    """
+    Rolling statistics of the public trades of a single contract, limited to the last [capacity] trades and
+    (optionally) to the last [window] seconds.
+    """
+
+    def __init__(self, capacity=1000, window=None):
+        self.window = window
+        self.trades = RingBuffer(capacity)
+        self.last_price = None
+        self.last_time = None
+        self.total_volume = 0.0
+        self.__sum_pq = 0.0
+        self.__sum_q = 0.0
+        self.__sum_r = 0.0
+        self.__sum_rr = 0.0
+        self.__returns = 0
+
+    def add(self, timestamp, price, quantity, now=None):
+        """
+        :param timestamp: Execution time of the trade in seconds since the epoch.
+        :param now: Current time for the expiry of the time window (defaults to the wall clock time). The window is
+                    measured from now, not from the latest trade, so the statistics also age without new trades.
+        """
+
+        # Log returns are only defined for positive prices, negative prices are possible at the power exchanges.
+        has_return = self.last_price is not None and self.last_price > 0 and price > 0
+        log_return = math.log(price / self.last_price) if has_return else 0.0
+
+        evicted = self.trades.append(timestamp, price, quantity, log_return if has_return else math.nan)
+        if evicted:
+            self.__remove(evicted)
+
+        self.__sum_pq += price * quantity
+        self.__sum_q += quantity
+        if has_return:
+            self.__sum_r += log_return
+            self.__sum_rr += log_return * log_return
+            self.__returns += 1
+
+        self.last_price = price
+        self.last_time = timestamp
+        self.total_volume += quantity
+        self.expire(time.time() if now is None else now)
+
+    def expire(self, now):
+        """
+        Removes the trades which are older than the time window.
+
+        :param now: Current time in seconds since the epoch.
+        """
+
+        if self.window is None:
+            return
+        while self.trades.size and self.trades.oldest_timestamp() < now - self.window:
+            self.__remove(self.trades.pop_oldest())
+
+    def __remove(self, entry):
+        _, price, quantity, log_return = entry
+        self.__sum_pq -= price * quantity
+        self.__sum_q -= quantity
+        if not math.isnan(log_return):
+            self.__sum_r -= log_return
+            self.__sum_rr -= log_return * log_return
+            self.__returns -= 1
+
+    @property
+    def vwap(self):
+        return self.__sum_pq / self.__sum_q if self.__sum_q > 1e-9 else None
+
+    @property
+    def volume(self):
+        """
+        Traded volume within the window.
+        """
+        return max(self.__sum_q, 0.0)
+
+    @property
+    def volatility(self):
+        """
+        Standard deviation of the log returns of the trades within the window (each relative to its preceding trade).
+        """
+
+        n = self.__returns
+        if n < 2:
+            return None
+        mean = self.__sum_r / n
+        return math.sqrt(max(self.__sum_rr / n - mean * mean, 0.0) * n / (n - 1))
+
+
+class TradeAnalytics:
+    """
+    ContractTradeStats per (contract_id, delivery_area), fed by public trade events and a paginated REST backfill.
+    """
+
+    def __init__(self, capacity=1000, window=None):
+        """
+        :param capacity: Maximum number of trades per contract considered by the statistics.
+        :param window: Optional time window in seconds.
+        """
+
+        self.capacity = capacity
+        self.window = window
+        self.__lock = threading.Lock()
+        self.__stats = {}
+        # {(contract_id, delivery_area): OrderedDict of the ids of the most recent trades}, trades received via REST and
+        # websocket are only added once.
+        self.__trade_ids = {}
+
+    def stats(self, contract_id, delivery_area):
+        """
+        :return: ContractTradeStats or None, if there were no trades yet. Trades that left the time window in the
+                 meantime are removed first.
+        """
+
+        stats = self.__stats.get((contract_id, delivery_area))
+        if stats is not None and self.window is not None:
+            with self.__lock:
+                stats.expire(time.time())
+        return stats
+
+    def on_public_trade(self, trade, delivery_area):
+        """
+        Adds a public trade (REST model or websocket event).
+
+        :return: True if the trade was added, False if it has already been added or if it is older than the last trade
+                 of the contract (the rolling statistics are calculated in the order of the trades).
+        """
+
+        key = (get_field(trade, "contract_id"), delivery_area)
+        timestamp = get_timestamp(get_field(trade, "exec_time"))
+        price = get_field(trade, "price")
+        quantity = get_field(trade, "quantity")
+        trade_id = get_field(trade, "trade_id")
+        if trade_id is None:
+            trade_id = (timestamp, price, quantity)
+        with self.__lock:
+            trade_ids = self.__trade_ids.setdefault(key, OrderedDict())
+            if trade_id in trade_ids:
+                return False
+            stats = self.__stats.get(key)
+            if stats is not None and stats.last_time is not None and timestamp < stats.last_time:
+                return False
+            trade_ids[trade_id] = None
+            if len(trade_ids) > self.capacity:
+                # Trades older than the buffered ones are rejected by the check above anyway.
+                trade_ids.popitem(last=False)
+            if stats is None:
+                stats = self.__stats[key] = ContractTradeStats(self.capacity, self.window)
+            stats.add(timestamp, price, quantity)
+        return True
+
+    def backfill(self, contract_api, contract_id, delivery_area, page_size=500):
+        """
+        Loads the most recent public trades of a contract (up to the capacity) via get_public_trades.
+        Maximum limit of trades that can be retrieved with a single request is 500, therefore a loop is used.
+
+        :return: Number of added trades.
+        """
+
+        trades = []
+        offset = 0
+        more_trades = True
+        while more_trades and len(trades) < self.capacity:
+            public_trades = contract_api.get_public_trades(contract_id=contract_id, delivery_area=delivery_area,
+                                                           offset=offset, limit=page_size)
+            trades.extend(public_trades)
+            offset += page_size
+            more_trades = len(public_trades) == page_size
+
+        trades.sort(key=lambda t: get_timestamp(get_field(t, "exec_time")))
+        return sum(self.on_public_trade(trade, delivery_area) for trade in trades[-self.capacity:])
@@ -9,13 +9,15 @@ from datetime import datetime
 
 class PowerBotWebSocket():
 
-    def __init__(self, api_key, base_url, subscriptions, data_queue):
+    def __init__(self, api_key, base_url, subscriptions, data_queue, on_disconnect=None):
         self.__logger = logging.getLogger("PowerBotWebSocketClass")
         self.__logger.setLevel(logging.INFO)
         self.__active = False
         self.__wss = base_url.replace('https', 'wss').replace('api', 'subscription') + f'?api_key={api_key}'
         self.__subscriptions = subscriptions
         self.__receipt = uuid.uuid4()
+        self.__on_disconnect = on_disconnect
+        self.__last_message_time = time.monotonic()
 
         self.__websocket = websocket.WebSocketApp(self.__wss,
                                                   on_close=lambda w: self.__on_close(w),
@@ -27,6 +29,11 @@ class PowerBotWebSocket():
     def is_active(self):
         return self.__active
 
+    @property
+    def last_message_time(self):
+        # time.monotonic() of the last received frame (including heartbeats).
+        return self.__last_message_time
+
     def start(self):
         thread.start_new_thread(self.__websocket.run_forever, ())
         # It takes some time before the connection is established.
@@ -37,6 +44,7 @@ class PowerBotWebSocket():
         self.__websocket.send(stomper.disconnect(self.__receipt))
 
     def __on_message(self, ws, message, data_queue):
+        self.__last_message_time = time.monotonic()
         if message == "\n":
             self.__logger.info("<<< PONG: {}".format(datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%fZ")))
         else:
@@ -63,6 +71,11 @@ class PowerBotWebSocket():
 
     def __on_close(self, ws):
         self.__logger.info("CONNECTION CLOSED")
+        if self.__active:
+            # The connection was not closed by us.
+            self.__active = False
+            if self.__on_disconnect:
+                self.__on_disconnect()
 
     def __on_open(self, ws):
 